@@ -1,5 +1,5 @@
 from django.contrib import admin
 
-from .models import User, ListingCategory, Listing, Bid, Comment
+from .models import User, ListingCategory, Listing, Bid, Comment, UserStats, CategoryStats, CategoryPriceBucket
 
-admin.site.register([User, ListingCategory, Listing, Bid, Comment])
\ No newline at end of file
+admin.site.register([User, ListingCategory, Listing, Bid, Comment, UserStats, CategoryStats, CategoryPriceBucket])
\ No newline at end of file
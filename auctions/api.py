@@ -0,0 +1,280 @@
+import json
+import logging
+from functools import wraps
+from itertools import chain
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import Http404, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
+from django.views.decorators.http import require_GET
+
+from .archive import ArchivedBids
+from .models import User, ListingCategory, Listing, Bid
+from .utils import InvalidCursor, KeysetPaginator
+
+
+# Read-only JSON API. Every endpoint accepts "?fields=a,b,c" to pick the
+# returned fields; only the columns (and joins) needed for them are queried.
+# Lists are paginated with forward cursors ("next" in the response) and
+# streamed row by row from a server-side iterator. A stream failing after
+# the first row ends with an "error" key, the status can no longer change.
+
+API_PAGE_SIZE = 50
+API_MAX_PAGE_SIZE = 500
+PRICES_MAX_IDS = 500
+STREAM_CHUNK_SIZE = 100
+
+logger = logging.getLogger(__name__)
+
+# API field name -> ORM lookup
+LISTING_FIELDS = {
+    "id": "pk",
+    "title": "title",
+    "description": "description",
+    "image": "image",
+    "author": "author__username",
+    "category": "category__slug",
+    "starting_bid": "starting_bid",
+    "current_price": "current_price",
+    "bid_count": "bid_count",
+    "winner": "user_with_max_bid__username",
+    "watcher_count": "watcher_count",
+    "active": "active",
+    "date_added": "date_added",
+    "ends_at": "ends_at",
+    "last_modified": "last_modified",
+}
+LISTING_DEFAULT_FIELDS = ("id", "title", "author", "category", "current_price", "bid_count", "active", "ends_at")
+PRICE_FIELDS = {
+    "id": "pk",
+    "current_price": "current_price",
+    "bid_count": "bid_count",
+    "active": "active",
+    "ends_at": "ends_at",
+    "version": "version",
+}
+PRICE_DEFAULT_FIELDS = ("id", "current_price", "bid_count", "active")
+BID_FIELDS = {
+    "id": "pk",
+    "user": "from_user__username",
+    "amount": "amount",
+    "date_added": "date_added",
+}
+CATEGORY_FIELDS = {
+    "id": "pk",
+    "name": "name",
+    "slug": "slug",
+    "parent": "parent__slug",
+    "path": "path",
+    # Own active listings, from CategoryStats
+    "listing_count": "stats__active_count",
+    "min_price": "stats__min_price",
+    "max_price": "stats__max_price",
+}
+USER_FIELDS = {
+    "username": "username",
+    "first_name": "first_name",
+    "last_name": "last_name",
+    "avatar": "avatar",
+    "date_joined": "date_joined",
+    "listing_count": "stats__listing_count",
+    "bid_count": "stats__bid_count",
+    "leading_count": "stats__leading_count",
+    "won_count": "stats__won_count",
+    "total_spent": "stats__total_spent",
+}
+
+
+class ApiError(Exception):
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def api_view(view):
+    @require_GET
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        try:
+            return view(request, *args, **kwargs)
+        except Http404:
+            return JsonResponse({"error": "Not found"}, status=404)
+        except ApiError as e:
+            return JsonResponse({"error": str(e)}, status=e.status)
+    return wrapper
+
+
+def get_fields(request, available, default=None):
+    # [(api name, ORM lookup)] for the requested "fields" parameter
+    names = request.GET.get("fields")
+    names = names.split(",") if names else list(default or available)
+    unknown = [name for name in names if name not in available]
+    if unknown:
+        raise ApiError(f"Unknown field(s): {', '.join(unknown)}")
+    return [(name, available[name]) for name in dict.fromkeys(names)]
+
+
+def get_limit(request):
+    try:
+        limit = int(request.GET.get("limit", API_PAGE_SIZE))
+    except ValueError:
+        raise ApiError("limit must be an integer")
+    return min(max(limit, 1), API_MAX_PAGE_SIZE)
+
+
+def encode(data):
+    return json.dumps(data, cls=DjangoJSONEncoder)
+
+
+def select(row, fields):
+    return {name: row[lookup] for name, lookup in fields}
+
+
+def stream_page(request, queryset, fields):
+    paginator = KeysetPaginator(queryset, get_limit(request))
+    try:
+        queryset, number, backwards, seeking = paginator.seek(request.GET.get("cursor"))
+    except InvalidCursor:
+        raise ApiError("Invalid cursor")
+    if backwards:
+        raise ApiError("Invalid cursor")
+    # The ordering fields are fetched too, the next cursor is built from the last row
+    lookups = dict.fromkeys([lookup for name, lookup in fields] + [name for name, descending in paginator.fields])
+    rows = queryset.values(*lookups)[:paginator.per_page + 1].iterator(chunk_size=STREAM_CHUNK_SIZE)
+    # Run the query before the response starts, so a failing one is an error
+    # status rather than a 200 with a broken body
+    first = next(rows, None)
+
+    def serialize():
+        yield '{"results": ['
+        last = None
+        has_next = False
+        try:
+            for i, row in enumerate(chain([first] if first is not None else [], rows)):
+                if i == paginator.per_page:
+                    has_next = True
+                    break
+                yield ("," if i else "") + encode(select(row, fields))
+                last = row
+        except Exception:
+            # The status is already sent, end the JSON with an error clients can see
+            logger.exception("API stream of %s failed", queryset.model._meta.label)
+            yield '], "next": null, "error": "Internal error"}'
+            return
+        next_cursor = paginator.encode_cursor(last, number + 1) if has_next else None
+        yield '], "next": ' + encode(next_cursor) + "}"
+
+    return StreamingHttpResponse(serialize(), content_type="application/json")
+
+
+def filter_listings(request, listings):
+    # Same conventions as the search page: active listings unless "?active=0" or "?active=all"
+    active = {"0": False, "all": None}.get(request.GET.get("active"), True)
+    if active is not None:
+        listings = listings.filter(active=active)
+    if request.GET.get("category"):
+        category = get_object_or_404(ListingCategory, slug=request.GET["category"])
+        listings = listings.filter(category=category)
+    if request.GET.get("author"):
+        author = get_object_or_404(User, username=request.GET["author"])
+        listings = listings.filter(author=author)
+    return listings
+
+
+@api_view
+def listing_list(request):
+    fields = get_fields(request, LISTING_FIELDS, LISTING_DEFAULT_FIELDS)
+    return stream_page(request, filter_listings(request, Listing.objects.all()), fields)
+
+
+@api_view
+def listing_detail(request, id):
+    fields = get_fields(request, LISTING_FIELDS)
+    row = Listing.objects.filter(pk=id).values(*(lookup for name, lookup in fields)).first()
+    if row is None:
+        raise Http404
+    return JsonResponse(select(row, fields), encoder=DjangoJSONEncoder)
+
+
+@api_view
+def listing_bids(request, id):
+    fields = get_fields(request, BID_FIELDS)
+    listing = get_object_or_404(Listing.objects.only("pk", "bids_archived"), pk=id)
+    if listing.bids_archived:
+        return archived_bids_page(request, ArchivedBids(listing), fields)
+    return stream_page(request, listing.bids.all(), fields)
+
+
+def archived_bids_page(request, history, fields):
+    # Same cursors as stream_page() over Bid, the last value is the bid pk
+    paginator = KeysetPaginator(Bid.objects.all(), get_limit(request))
+    start, number = 0, 1
+    if request.GET.get("cursor"):
+        try:
+            values, number, backwards = paginator.decode_cursor(request.GET["cursor"])
+            start = history.index(values[-1]) + 1
+        except (InvalidCursor, ValueError):
+            raise ApiError("Invalid cursor")
+        if backwards:
+            raise ApiError("Invalid cursor")
+    bids = history[start:start + paginator.per_page + 1]
+    rows = [
+        {
+            "pk": bid.pk,
+            "from_user__username": bid.from_user.username if bid.from_user else None,
+            "amount": bid.amount,
+            "date_added": bid.date_added,
+        }
+        for bid in bids
+    ]
+    next_cursor = None
+    if len(rows) > paginator.per_page:
+        rows = rows[:paginator.per_page]
+        next_cursor = paginator.encode_cursor(rows[-1], number + 1)
+    return JsonResponse({
+        "results": [select(row, fields) for row in rows],
+        "next": next_cursor,
+    }, encoder=DjangoJSONEncoder)
+
+
+@api_view
+def listing_prices(request):
+    # Current prices of many listings in one query: "?ids=1,2,3" or "?ids=1&ids=2"
+    fields = get_fields(request, PRICE_FIELDS, PRICE_DEFAULT_FIELDS)
+    try:
+        ids = {int(pk) for value in request.GET.getlist("ids") for pk in value.split(",") if pk}
+    except ValueError:
+        raise ApiError("ids must be integers")
+    if not ids:
+        raise ApiError("ids is required")
+    if len(ids) > PRICES_MAX_IDS:
+        raise ApiError(f"At most {PRICES_MAX_IDS} ids per request")
+
+    lookups = dict.fromkeys([lookup for name, lookup in fields] + ["pk"])
+    rows = Listing.objects.filter(pk__in=ids).order_by().values(*lookups)
+    results = {}
+    for row in rows:
+        results[str(row["pk"])] = select(row, fields)
+    return JsonResponse({
+        "results": results,
+        "missing": sorted(ids - {int(pk) for pk in results}),
+    }, encoder=DjangoJSONEncoder)
+
+
+@api_view
+def category_list(request):
+    fields = get_fields(request, CATEGORY_FIELDS)
+    categories = ListingCategory.objects.order_by("path")
+    rows = categories.values(*(lookup for name, lookup in fields))
+    return JsonResponse({"results": [select(row, fields) for row in rows]}, encoder=DjangoJSONEncoder)
+
+
+@api_view
+def user_detail(request, username):
+    fields = get_fields(request, USER_FIELDS)
+    # Totals come from UserStats, one join instead of aggregates over Listing and Bid
+    users = User.objects.filter(username=username)
+    row = users.values(*(lookup for name, lookup in fields)).first()
+    if row is None:
+        raise Http404
+    return JsonResponse(select(row, fields), encoder=DjangoJSONEncoder)
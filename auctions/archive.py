@@ -0,0 +1,125 @@
+import json
+import zlib
+from collections import Counter
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from .models import Bid, BidArchive, Listing, User, UserStats
+
+
+# Bids of listings closed for longer than BID_ARCHIVE_AFTER_DAYS are moved
+# out of the Bid table into one compressed BidArchive segment per listing.
+# Only the leading bid stays in Bid (Listing.leading_bid points at it), the
+# price and bid count are already inline on Listing. The listing page and
+# the API read archived histories through ArchivedBids, transparently.
+
+
+def archive_after():
+    return timedelta(days=getattr(settings, "BID_ARCHIVE_AFTER_DAYS", 30))
+
+
+def encode_bids(rows):
+    # rows: (pk, from_user_id, amount, date_added) tuples, newest first
+    lines = (json.dumps([pk, user_id, amount, date_added.isoformat()]) for pk, user_id, amount, date_added in rows)
+    return zlib.compress("\n".join(lines).encode())
+
+
+def decode_bids(data):
+    text = zlib.decompress(bytes(data)).decode()
+    for line in text.splitlines():
+        pk, user_id, amount, date_added = json.loads(line)
+        yield pk, user_id, amount, datetime.fromisoformat(date_added)
+
+
+def archive_bids(before=None, batch_size=100):
+    # Archive the bids of up to batch_size listings closed before `before`.
+    # Returns the ids of the archived listings, empty when there is nothing left.
+    before = before or timezone.now() - archive_after()
+    with transaction.atomic():
+        listings = (
+            Listing.objects.filter(active=False, bids_archived=False, closed_at__lte=before)
+            .order_by("closed_at")
+            .values_list("pk", "leading_bid_id")[:batch_size]
+        )
+        leading_bids = dict(listings)
+        if not leading_bids:
+            return []
+
+        # One query for the whole batch, already grouped and in history order
+        rows = (
+            Bid.objects.filter(on_listing__in=leading_bids)
+            .order_by("on_listing", "-date_added", "pk")
+            .values_list("on_listing_id", "pk", "from_user_id", "amount", "date_added")
+        )
+        histories = {pk: [] for pk in leading_bids}
+        for listing_id, *row in rows.iterator():
+            histories[listing_id].append(row)
+
+        BidArchive.objects.bulk_create([
+            BidArchive(listing_id=listing_id, bid_count=len(history), data=encode_bids(history))
+            for listing_id, history in histories.items()
+        ])
+
+        # Users keep the removed bids in their bid_count, see UserStats.rebuild()
+        removed = Counter(
+            user_id
+            for listing_id, history in histories.items()
+            for pk, user_id, amount, date_added in history
+            if pk != leading_bids[listing_id]
+        )
+        for user_id, count in removed.items():
+            UserStats.add(user_id, archived_bid_count=count)
+
+        # Raw delete: no Bid signals, the feeds and fragments don't change.
+        # The leading bids are kept, nothing else references a bid.
+        Bid.objects.filter(on_listing__in=leading_bids).exclude(
+            pk__in=[pk for pk in leading_bids.values() if pk]
+        )._raw_delete(Bid.objects.db)
+        Listing.objects.filter(pk__in=leading_bids).update(bids_archived=True)
+    return list(leading_bids)
+
+
+class ArchivedBids:
+    # The archived history of a listing, sliced like listing.bids.with_users().
+    # The segment is only read when a slice is taken, and the bidders of the
+    # slice are loaded with one query.
+
+    def __init__(self, listing):
+        self.listing = listing
+
+    @cached_property
+    def rows(self):
+        archive = BidArchive.objects.filter(listing=self.listing).values_list("data", flat=True).first()
+        return list(decode_bids(archive)) if archive is not None else []
+
+    def __len__(self):
+        return len(self.rows)
+
+    def index(self, pk):
+        # Position of a bid in the history, for cursors. ValueError if it isn't there.
+        return [row[0] for row in self.rows].index(pk)
+
+    def __getitem__(self, index):
+        rows = self.rows[index] if isinstance(index, slice) else [self.rows[index]]
+        users = User.objects.in_bulk({user_id for pk, user_id, amount, date_added in rows})
+        bids = [
+            Bid(
+                pk=pk,
+                from_user=users.get(user_id),
+                on_listing=self.listing,
+                amount=amount,
+                date_added=date_added
+            )
+            for pk, user_id, amount, date_added in rows
+        ]
+        return bids if isinstance(index, slice) else bids[0]
+
+
+def bid_history(listing):
+    if listing.bids_archived:
+        return ArchivedBids(listing)
+    return listing.bids.with_users()
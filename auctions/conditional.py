@@ -0,0 +1,100 @@
+from functools import wraps
+from hashlib import md5
+
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+
+from . import cache
+from .models import Listing
+from .watchlist import watched_ids, watchlist_generation
+
+
+# Conditional GET for the listing and feed pages. Validators are computed
+# from Listing.last_modified and the feed cache generations (see cache.py),
+# so a matching If-None-Match / If-Modified-Since is answered with 304 before
+# the page queries run or the templates render.
+#
+# Pages look different for every user (navbar, watchlist button), so the
+# ETag also covers who is asking. Reading request.user marks the session as
+# accessed, which makes SessionMiddleware add "Vary: Cookie" to the 200 and
+# the 304 alike.
+
+
+def make_etag(request, *parts):
+    user = request.user.pk if request.user.is_authenticated else "anonymous"
+    digest = md5(":".join(str(part) for part in (user,) + parts).encode()).hexdigest()
+    # Weak, the HTML differs in the CSRF token mask between renders
+    return "W/" + quote_etag(digest)
+
+
+def conditional_response(request, etag, last_modified, get_response):
+    timestamp = int(last_modified.timestamp()) if last_modified else None
+    response = get_conditional_response(request, etag=etag, last_modified=timestamp)
+    if response is None:
+        response = get_response()
+
+    if response.status_code in (200, 304):
+        if etag and not response.has_header("ETag"):
+            response["ETag"] = etag
+        if timestamp and not response.has_header("Last-Modified"):
+            response["Last-Modified"] = http_date(timestamp)
+        # Let browsers and the proxy keep a copy but revalidate it every time
+        patch_cache_control(response, no_cache=True, private=request.user.is_authenticated)
+    return response
+
+
+class ConditionalGetMixin:
+    # For feed views using FeedCacheMixin, versioned on their cache generations
+
+    def get_etag_parts(self):
+        names = list(self.get_cache_generations())
+        if self.request.user.is_authenticated:
+            # The cards carry the user's "watched" badges
+            names.append(watchlist_generation(self.request.user.pk))
+        parts = cache.get_generations(*names)
+        clock = self.get_cache_clock()
+        if clock is not None:
+            parts.append(f"t{clock}")
+        return parts
+
+    def get_last_modified(self):
+        return None
+
+    def dispatch(self, request, *args, **kwargs):
+        if request.method not in ("GET", "HEAD"):
+            return super().dispatch(request, *args, **kwargs)
+        return conditional_response(
+            request,
+            make_etag(request, *self.get_etag_parts()),
+            self.get_last_modified(),
+            lambda: super(ConditionalGetMixin, self).dispatch(request, *args, **kwargs)
+        )
+
+
+def listing_validators(request, id):
+    # The listing version and the state of the watchlist button, which
+    # changes without touching the listing
+    last_modified = Listing.objects.filter(pk=id).values_list("last_modified", flat=True).first()
+    if last_modified is None:
+        return None
+    return last_modified, id in watched_ids(request)
+
+
+def condition_on_listing(view):
+    @wraps(view)
+    def wrapper(request, id, *args, **kwargs):
+        if request.method not in ("GET", "HEAD"):
+            return view(request, id, *args, **kwargs)
+        row = listing_validators(request, id)
+        if row is None:
+            # Let the view answer 404
+            return view(request, id, *args, **kwargs)
+        # If-Modified-Since can't tell users apart, only anonymous pages get Last-Modified
+        last_modified = None if request.user.is_authenticated else row[0]
+        return conditional_response(
+            request,
+            make_etag(request, *row),
+            last_modified,
+            lambda: view(request, id, *args, **kwargs)
+        )
+    return wrapper
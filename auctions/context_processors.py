@@ -0,0 +1,9 @@
+from django.conf import settings
+
+
+def fragment_cache(request):
+    # Arguments of the {% cache %} tags in listing_card.html and listing_detail.html
+    return {
+        "fragment_cache_alias": getattr(settings, "FRAGMENT_CACHE_ALIAS", "default"),
+        "fragment_cache_timeout": getattr(settings, "FRAGMENT_CACHE_TIMEOUT", 3600),
+    }
@@ -0,0 +1,175 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Count, Sum
+from django.utils import timezone
+from django.utils.functional import cached_property
+
+from .forms import ListingFilterForm, price_bucket_label
+from .models import PRICE_BUCKETS, CategoryPriceBucket, Listing, ListingCategory, price_bucket_expression
+
+
+# Sorting, price filters and facet counts of the listing feeds. Every sort
+# is an index walk (see the Listing indexes) and the price filter is a range
+# on current_price, so a page costs the same however many listings there are.
+# The facet counts, which also serve as the page count, are one grouped query
+# over CategoryPriceBucket, or over the end time index range for "ending soon".
+
+ORDERINGS = {
+    "newest": ["-date_added", "title"],
+    "price": ["current_price"],
+    "-price": ["-current_price"],
+    "bids": ["-bid_count"],
+    "ending": ["ends_at"],
+}
+
+DEFAULT_FILTERS = {"sort": "newest", "price": None}
+
+# Listings enter and leave "ending soon" with the clock rather than with a
+# write, so its cached pages and ETags also change every this many seconds
+ENDING_SOON_CLOCK_SECONDS = 60
+
+
+def ending_soon_until():
+    return timezone.now() + timedelta(hours=getattr(settings, "LISTING_ENDING_SOON_HOURS", 24))
+
+
+def filter_listings(listings, filters):
+    price = filters["price"]
+    if price is not None:
+        listings = listings.filter(current_price__gte=PRICE_BUCKETS[price])
+        if price + 1 < len(PRICE_BUCKETS):
+            listings = listings.filter(current_price__lt=PRICE_BUCKETS[price + 1])
+    if filters["sort"] == "ending":
+        listings = listings.filter(ends_at__isnull=False, ends_at__lte=ending_soon_until())
+    return listings.order_by(*ORDERINGS[filters["sort"]])
+
+
+def facet_rows(scope, filters):
+    # [(category path or None, price bucket, active listings)] within the scope
+    # category's subtree, all listings for no scope. Ignores the price filter,
+    # the price facet shows the other buckets too.
+    if filters["sort"] == "ending":
+        rows = (
+            Listing.objects.filter(active=True, ends_at__isnull=False, ends_at__lte=ending_soon_until())
+            .order_by()
+            .annotate(bucket=price_bucket_expression())
+            .values("category__path", "bucket")
+            .annotate(n=Count("pk"))
+        )
+    else:
+        rows = (
+            CategoryPriceBucket.objects.filter(active_count__gt=0)
+            .order_by()
+            .values("category__path", "bucket")
+            .annotate(n=Sum("active_count"))
+        )
+    if scope is not None:
+        rows = rows.filter(category__path__startswith=scope.path)
+    return [(row["category__path"], row["bucket"], row["n"]) for row in rows]
+
+
+class Facets:
+    def __init__(self, rows, scope, filters, subcategories):
+        self.rows = rows
+        self.scope = scope
+        self.price = filters["price"]
+        self.subcategories = subcategories
+
+    @cached_property
+    def total(self):
+        return sum(n for path, bucket, n in self.rows if self.price in (None, bucket))
+
+    @cached_property
+    def prices(self):
+        counts = [0] * len(PRICE_BUCKETS)
+        for path, bucket, n in self.rows:
+            counts[bucket] += n
+        return [(bucket, price_bucket_label(bucket), count) for bucket, count in enumerate(counts) if count]
+
+    @cached_property
+    def categories(self):
+        # Subcategories of the scope (root categories of the whole feed) with
+        # the listings of their own subtree in the selected price range
+        counts = {category.pk: 0 for category in self.subcategories}
+        depth = len(self.scope.ancestor_ids()) if self.scope is not None else 0
+        for path, bucket, n in self.rows:
+            if path is None or self.price not in (None, bucket):
+                continue
+            ancestor_ids = [int(pk) for pk in path.strip("/").split("/")]
+            if len(ancestor_ids) > depth and ancestor_ids[depth] in counts:
+                counts[ancestor_ids[depth]] += n
+        return [(category, counts[category.pk]) for category in self.subcategories if counts[category.pk]]
+
+
+class ListingFilterMixin:
+    # For keyset paginated listing feeds: ?sort= and ?price= through
+    # ListingFilterForm, facet counts in the context and the page count
+    # taken from the facets instead of a COUNT query. Goes before
+    # FeedCacheMixin in the bases, its get_cache_clock() overrides that one.
+
+    def get_facet_scope(self):
+        # Category whose subtree is listed, None for the whole feed
+        return None
+
+    @cached_property
+    def filter_form(self):
+        return ListingFilterForm(self.request.GET)
+
+    @cached_property
+    def filters(self):
+        # Invalid combinations fall back to the plain feed, the form shows why
+        return self.filter_form.cleaned_data if self.filter_form.is_valid() else DEFAULT_FILTERS
+
+    def filter_listings(self, listings):
+        return filter_listings(listings, self.filters)
+
+    def get_cache_clock(self):
+        if self.filters["sort"] == "ending":
+            return int(timezone.now().timestamp()) // ENDING_SOON_CLOCK_SECONDS
+        return super().get_cache_clock()
+
+    @cached_property
+    def facets(self):
+        scope = self.get_facet_scope()
+        subcategories = ListingCategory.objects.filter(parent=scope).order_by("path")
+        return Facets(facet_rows(scope, self.filters), scope, self.filters, list(subcategories))
+
+    def get_keyset_count(self):
+        return self.facets.total
+
+    def facet_query(self, **changes):
+        # The current query string with `changes` applied, from the first page
+        params = self.request.GET.copy()
+        for name in ("cursor", "page", *changes):
+            params.pop(name, None)
+        for name, value in changes.items():
+            if value is not None:
+                params[name] = str(value)
+        return params.urlencode()
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        sort, price = self.filters["sort"], self.filters["price"]
+        price_sort = sort in ListingFilterForm.PRICE_SORTS
+        context["filter_form"] = self.filter_form
+        # (label, query string, selected) links, switching sort drops a price range it can't serve
+        context["sorts"] = [
+            (label, self.facet_query(sort=name, price=price if name in ListingFilterForm.PRICE_SORTS else None), name == sort)
+            for name, label in ListingFilterForm.SORTS
+        ]
+        # (label, count, query string, selected), picking a range sorts by price
+        context["price_facets"] = [
+            (
+                label,
+                count,
+                self.facet_query(price=None if bucket == price else bucket, sort=sort if price_sort else None),
+                bucket == price
+            )
+            for bucket, label, count in self.facets.prices
+        ]
+        # (category, count, query string), for links to the category pages
+        context["category_facets"] = [
+            (category, count, self.facet_query()) for category, count in self.facets.categories
+        ]
+        return context
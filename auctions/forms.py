@@ -1,9 +1,10 @@
 from django import forms
 from django.core.exceptions import ValidationError
 from django.db.utils import IntegrityError
+from django.utils import timezone
 from django.utils.text import slugify
 
-from .models import User, ListingCategory, Listing, Bid, Comment
+from .models import PRICE_BUCKETS, User, ListingCategory, Listing, Bid, Comment
 
 
 class UserForm(forms.ModelForm):
@@ -39,7 +40,8 @@ class ListingForm(forms.ModelForm):
             "description",
             "category",            
             "image",
-            "starting_bid"
+            "starting_bid",
+            "ends_at"
         ]
         widgets = {
             "title": forms.TextInput(attrs={
@@ -62,11 +64,84 @@ class ListingForm(forms.ModelForm):
             "image": forms.TextInput(attrs={
                 "class": "form-control",
                 "placeholder": "Paste your image link here"                
+            }),
+            "ends_at": forms.DateTimeInput(format="%Y-%m-%dT%H:%M", attrs={
+                "class": "form-control",
+                "type": "datetime-local"
             })
         }
+
+    def clean_ends_at(self):
+        ends_at = self.cleaned_data["ends_at"]
+        if ends_at is not None and ends_at <= timezone.now() and ends_at != self.initial.get("ends_at"):
+            raise ValidationError("The end time has to be in the future")
+        return ends_at
     
     def disable_starting_bid(self):            
         self.fields["starting_bid"].widget.attrs["readonly"] = True
+
+
+class ListingImportForm(ListingForm):
+    # ListingForm rules for one imported row. The category is given by slug and
+    # resolved against a preloaded {slug: ListingCategory} map, the model field
+    # would cost a query per row.
+    category = forms.SlugField(required=False)
+
+    class Meta(ListingForm.Meta):
+        fields = [field for field in ListingForm.Meta.fields if field != "category"]
+
+    def __init__(self, *args, categories, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.categories = categories
+
+    def clean_category(self):
+        slug = self.cleaned_data["category"]
+        if not slug:
+            return None
+        try:
+            return self.categories[slug]
+        except KeyError:
+            raise ValidationError(f"Unknown category '{slug}'")
+    
+
+def price_bucket_label(bucket):
+    low = PRICE_BUCKETS[bucket]
+    if bucket + 1 < len(PRICE_BUCKETS):
+        return f"${low} \u2013 ${PRICE_BUCKETS[bucket + 1]}"
+    return f"${low}+"
+
+
+class ListingFilterForm(forms.Form):
+    # Sort and filter of the listing feeds. Only combinations an index serves
+    # are accepted: price ranges seek the price index, so they are sorted by
+    # price, and "ending soon" walks the end time index.
+    SORTS = [
+        ("newest", "Newest"),
+        ("price", "Lowest price"),
+        ("-price", "Highest price"),
+        ("bids", "Most bids"),
+        ("ending", "Ending soon"),
+    ]
+    PRICE_SORTS = ("price", "-price")
+
+    sort = forms.ChoiceField(choices=SORTS, required=False)
+    price = forms.TypedChoiceField(
+        choices=[(i, price_bucket_label(i)) for i in range(len(PRICE_BUCKETS))],
+        coerce=int,
+        empty_value=None,
+        required=False
+    )
+
+    def clean(self):
+        cleaned_data = super().clean()
+        sort = cleaned_data.get("sort")
+        if cleaned_data.get("price") is not None:
+            if not sort:
+                sort = "price"
+            elif sort not in self.PRICE_SORTS:
+                raise ValidationError("Price ranges can only be sorted by price")
+        cleaned_data["sort"] = sort or "newest"
+        return cleaned_data
     
 
 class BidForm(forms.ModelForm):
@@ -0,0 +1,326 @@
+import hashlib
+import ipaddress
+import json
+import os
+import re
+import socket
+import tempfile
+import threading
+from collections import defaultdict
+from io import BytesIO
+from urllib.error import URLError
+from urllib.parse import urlencode, urlsplit
+from urllib.request import HTTPRedirectHandler, Request, build_opener
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.signing import BadSignature, Signer
+from django.urls import reverse
+
+try:
+    from PIL import Image, UnidentifiedImageError
+except ImportError:  # Thumbnails need Pillow, without it originals are proxied as they are
+    Image = None
+
+
+# Image proxy for the external Listing.image and User.avatar URLs. The first
+# request for a URL fetches the origin once and renders every thumbnail size
+# from it. Thumbnails are stored content-addressed on disk:
+#
+#   <IMAGE_CACHE_DIR>/blobs/ab/abcdef...  the image bytes, named by their sha256
+#   <IMAGE_CACHE_DIR>/refs/12/123456...   JSON {size: [blob hash, content type]}, named by sha256(url)
+#
+# Identical images behind different URLs share blobs. Hits refresh the blob's
+# mtime, and when the blobs outgrow IMAGE_CACHE_MAX_BYTES the least recently
+# used ones are deleted. A ref pointing at a deleted blob is a miss.
+#
+# A failed fetch is remembered for IMAGE_PROXY_FAILURE_TTL seconds in the
+# default cache, requests for a dead or slow origin fail fast meanwhile.
+#
+# Finding the blobs to delete walks the whole cache, so it only runs when
+# the size, as of the last walk plus what this process wrote since, passes
+# the limit, or every EVICT_CHECK_WRITES writes for those of other processes.
+
+# Bounding boxes, thumbnails keep the aspect ratio
+SIZES = {
+    "card": (600, 450),
+    "detail": (1200, 1200),
+    "avatar": (240, 240),
+}
+
+FETCH_CHUNK_SIZE = 64 * 1024
+EVICT_CHECK_WRITES = 100
+
+signer = Signer(salt="auctions.images")
+
+
+class ImageProxyError(Exception):
+    def __init__(self, message, status=502):
+        super().__init__(message)
+        self.status = status
+
+
+def cache_dir():
+    return getattr(settings, "IMAGE_CACHE_DIR", os.path.join(settings.BASE_DIR, "image-cache"))
+
+
+def thumbnail_url(url, size):
+    # Signed, so the proxy only fetches URLs the site itself rendered
+    if not url:
+        return ""
+    return reverse("image", kwargs={"size": size}) + "?" + urlencode({"url": signer.sign(url)})
+
+
+def unsign_url(value):
+    try:
+        return signer.unsign(value)
+    except BadSignature:
+        raise ImageProxyError("Bad signature", status=403)
+
+
+def _hash(data):
+    return hashlib.sha256(data).hexdigest()
+
+
+def _path(kind, key):
+    return os.path.join(cache_dir(), kind, key[:2], key)
+
+
+def _write(path, data):
+    # Atomic, a concurrent reader sees the old file or the whole new one
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def check_host(url):
+    parts = urlsplit(url)
+    if parts.scheme not in ("http", "https") or not parts.hostname:
+        raise ImageProxyError("Only http and https URLs are proxied", status=400)
+    if getattr(settings, "IMAGE_PROXY_ALLOW_PRIVATE", False):
+        return
+    try:
+        addresses = {info[4][0] for info in socket.getaddrinfo(parts.hostname, None)}
+    except OSError:
+        raise ImageProxyError("Unknown host")
+    for address in addresses:
+        ip = ipaddress.ip_address(address.split("%")[0])
+        if not ip.is_global:
+            raise ImageProxyError("Private addresses aren't proxied", status=400)
+
+
+class CheckedRedirectHandler(HTTPRedirectHandler):
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        check_host(newurl)
+        return super().redirect_request(req, fp, code, msg, headers, newurl)
+
+
+def fetch(url):
+    check_host(url)
+    max_bytes = getattr(settings, "IMAGE_PROXY_MAX_BYTES", 10 * 1024 * 1024)
+    timeout = getattr(settings, "IMAGE_PROXY_TIMEOUT", 10)
+    request = Request(url, headers={"User-Agent": "commerce-image-proxy"})
+    try:
+        with build_opener(CheckedRedirectHandler).open(request, timeout=timeout) as response:
+            content_type = response.headers.get_content_type()
+            if not content_type.startswith("image/"):
+                raise ImageProxyError(f"Not an image: {content_type}")
+            data = bytearray()
+            while True:
+                chunk = response.read(FETCH_CHUNK_SIZE)
+                if not chunk:
+                    break
+                data += chunk
+                if len(data) > max_bytes:
+                    raise ImageProxyError("Image too large")
+    except (URLError, OSError, ValueError) as e:
+        raise ImageProxyError(f"Fetching failed: {e}")
+    return bytes(data), content_type
+
+
+def render_thumbnails(data, content_type):
+    # {size: (bytes, content type)} for every size in SIZES
+    if Image is None:
+        return {size: (data, content_type) for size in SIZES}
+    try:
+        original = Image.open(BytesIO(data))
+        original.load()
+    except (UnidentifiedImageError, OSError, Image.DecompressionBombError):
+        raise ImageProxyError("Unreadable image")
+    # Keep transparency in PNG, everything else becomes JPEG
+    keep_alpha = original.mode in ("RGBA", "LA") or "transparency" in original.info
+    thumbnails = {}
+    for size, box in SIZES.items():
+        image = original.copy()
+        image.thumbnail(box)
+        out = BytesIO()
+        if keep_alpha:
+            image.convert("RGBA").save(out, "PNG", optimize=True)
+            thumbnails[size] = (out.getvalue(), "image/png")
+        else:
+            image.convert("RGB").save(out, "JPEG", quality=85, optimize=True, progressive=True)
+            thumbnails[size] = (out.getvalue(), "image/jpeg")
+    return thumbnails
+
+
+_url_locks = defaultdict(threading.Lock)
+_url_locks_guard = threading.Lock()
+
+
+def _url_lock(key):
+    with _url_locks_guard:
+        return _url_locks[key]
+
+
+def _lookup(ref_path, size):
+    # (blob path, blob hash, content type) of a cached thumbnail, None on a miss
+    try:
+        with open(ref_path) as f:
+            blob, content_type = json.load(f)[size]
+    except (OSError, ValueError, KeyError):
+        return None
+    path = _path("blobs", blob)
+    try:
+        os.utime(path)  # Mark as recently used
+    except OSError:
+        return None
+    return path, blob, content_type
+
+
+def _failure_key(key):
+    return f"image-failed:{key}"
+
+
+def _raise_failure(key):
+    failure = cache.get(_failure_key(key))
+    if failure is not None:
+        raise ImageProxyError(*failure)
+
+
+def get_thumbnail(url, size):
+    # Path, content hash and content type of the thumbnail, fetching the origin on a miss
+    if size not in SIZES:
+        raise ImageProxyError(f"Unknown size: {size}", status=404)
+    key = _hash(url.encode())
+    ref_path = _path("refs", key)
+    found = _lookup(ref_path, size)
+    if found:
+        return found
+    _raise_failure(key)
+
+    # One fetch per URL in this process, concurrent requests wait for it
+    try:
+        with _url_lock(key):
+            found = _lookup(ref_path, size)
+            if found:
+                return found
+            _raise_failure(key)
+            try:
+                data, content_type = fetch(url)
+                thumbnails = render_thumbnails(data, content_type)
+            except ImageProxyError as e:
+                cache.set(_failure_key(key), (str(e), e.status), getattr(settings, "IMAGE_PROXY_FAILURE_TTL", 60))
+                raise
+            refs, written = {}, 0
+            for name, (thumbnail, thumbnail_type) in thumbnails.items():
+                blob = _hash(thumbnail)
+                blob_path = _path("blobs", blob)
+                if os.path.exists(blob_path):
+                    os.utime(blob_path)
+                else:
+                    _write(blob_path, thumbnail)
+                    written += len(thumbnail)
+                refs[name] = [blob, thumbnail_type]
+            _write(ref_path, json.dumps(refs).encode())
+    finally:
+        with _url_locks_guard:
+            _url_locks.pop(key, None)
+    if written:
+        maybe_evict(written)
+    blob, content_type = refs[size]
+    return _path("blobs", blob), blob, content_type
+
+
+def open_thumbnail(url, size):
+    # get_thumbnail() with the file opened. A blob evicted between the lookup
+    # and open() leaves a ref to a missing blob, which the retry renders again.
+    for attempt in range(3):
+        path, blob, content_type = get_thumbnail(url, size)
+        try:
+            return open(path, "rb"), blob, content_type
+        except FileNotFoundError:
+            continue
+    raise ImageProxyError("Thumbnail evicted while serving it", status=503)
+
+
+def max_cache_bytes():
+    return getattr(settings, "IMAGE_CACHE_MAX_BYTES", 512 * 1024 * 1024)
+
+
+_sizes = {}  # cache dir -> [bytes at the last walk plus those written since, writes since]
+_sizes_lock = threading.Lock()
+
+
+def maybe_evict(written):
+    # Count `written` new blob bytes, evict() once the estimate is over the limit
+    with _sizes_lock:
+        size = _sizes.setdefault(cache_dir(), [None, 0])
+        if size[0] is not None:
+            size[0] += written
+        size[1] += 1
+        due = size[0] is None or size[0] > max_cache_bytes() or size[1] >= EVICT_CHECK_WRITES
+    if due:
+        evict()
+
+
+def evict(max_bytes=None):
+    # Delete the least recently used blobs until the cache fits its size limit
+    if max_bytes is None:
+        max_bytes = max_cache_bytes()
+    directory = cache_dir()
+    blobs = []
+    for root, dirs, files in os.walk(os.path.join(directory, "blobs")):
+        for name in files:
+            try:
+                stat = os.stat(os.path.join(root, name))
+            except OSError:
+                continue
+            blobs.append((stat.st_mtime, stat.st_size, os.path.join(root, name)))
+    total = sum(size for mtime, size, path in blobs)
+    for mtime, size, path in sorted(blobs):
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        total -= size
+    with _sizes_lock:
+        _sizes[directory] = [total, 0]
+    return total
+
+
+RANGE_RE = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def parse_range(header, length):
+    # (start, end) inclusive for a single "bytes=" range, None to serve it all.
+    # ValueError when the range can't be satisfied.
+    match = RANGE_RE.match(header or "")
+    if not match or match.groups() == ("", ""):
+        return None
+    start, end = match.groups()
+    if start == "":
+        # Suffix range, the last `end` bytes
+        start, end = max(length - int(end), 0), length - 1
+    else:
+        start, end = int(start), min(int(end), length - 1) if end else length - 1
+    if start >= length or start > end:
+        raise ValueError(header)
+    return start, end
@@ -0,0 +1,36 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from auctions.archive import archive_after, archive_bids
+
+
+class Command(BaseCommand):
+    help = "Move the bids of listings closed for a while into compressed archive segments"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--days",
+            type=float,
+            help="Archive listings closed at least this many days ago (BID_ARCHIVE_AFTER_DAYS by default)"
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=100,
+            help="Listings archived per transaction"
+        )
+
+    def handle(self, *args, **options):
+        age = timedelta(days=options["days"]) if options["days"] is not None else archive_after()
+        before = timezone.now() - age
+
+        total = 0
+        while True:
+            ids = archive_bids(before, batch_size=options["batch_size"])
+            if not ids:
+                break
+            total += len(ids)
+            self.stdout.write(f"Archived bids of {total} listing(s)")
+        self.stdout.write(self.style.SUCCESS(f"Archived bids of {total} listing(s) closed before {before:%Y-%m-%d %H:%M}"))
@@ -0,0 +1,134 @@
+import json
+import statistics
+import subprocess
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, reset_queries
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+
+from auctions.models import User, ListingCategory, Listing
+
+
+class Command(BaseCommand):
+    help = (
+        "Drive the main views through the test client against the configured database "
+        "and report latency percentiles, queries per request and throughput"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--requests", type=int, default=200, help="Requests per scenario")
+        parser.add_argument("--warmup", type=int, default=10, help="Unmeasured requests per scenario")
+        parser.add_argument(
+            "--scenario",
+            action="append",
+            dest="scenarios",
+            help="Run only this scenario, can be repeated"
+        )
+        parser.add_argument(
+            "--no-writes",
+            action="store_true",
+            help="Skip the scenarios that place bids and post comments"
+        )
+        parser.add_argument("--json", dest="json_path", help="Also write the results to this JSON file")
+
+    def handle(self, *args, **options):
+        listing = Listing.objects.filter(active=True).order_by("-bid_count").first()
+        category = ListingCategory.objects.filter(listings__active=True).first()
+        user = User.objects.filter(watchlist_listings__isnull=False).exclude(pk=getattr(listing, "author_id", None)).first()
+        if listing is None or category is None or user is None:
+            raise CommandError("Not enough data, run generate_data first")
+
+        anonymous = Client(HTTP_HOST="localhost")
+        client = Client(HTTP_HOST="localhost")
+        client.force_login(user)
+        listing_url = listing.get_absolute_url()
+        comments_url = reverse("listing_comments", args=[listing.pk])
+
+        scenarios = {
+            "index_anonymous": lambda i: anonymous.get(reverse("index")),
+            "index": lambda i: client.get(reverse("index")),
+            "category": lambda i: client.get(category.get_absolute_url()),
+            "listing": lambda i: client.get(listing_url),
+            "watchlist": lambda i: client.get(reverse("watchlist")),
+            "comments": lambda i: client.get(comments_url, {"format": "json"}),
+        }
+        if not options["no_writes"]:
+            scenarios["bid"] = lambda i: client.post(listing_url, {
+                "makebid": "Place Bid",
+                "amount": Listing.objects.values_list("current_price", flat=True).get(pk=listing.pk) + 1,
+            })
+            # What the listing page's script sends
+            scenarios["comment"] = lambda i: client.post(
+                comments_url,
+                {"text": f"Benchmark comment {i}"},
+                HTTP_X_REQUESTED_WITH="XMLHttpRequest"
+            )
+        if options["scenarios"]:
+            unknown = set(options["scenarios"]) - set(scenarios)
+            if unknown:
+                raise CommandError(f"Unknown scenario(s): {', '.join(sorted(unknown))}")
+            scenarios = {name: scenarios[name] for name in options["scenarios"]}
+
+        results = {}
+        # One client bids and comments far faster than the rate limits allow,
+        # the scenarios measure the views rather than 429 responses
+        with override_settings(RATE_LIMITS={}):
+            for name, request in scenarios.items():
+                results[name] = self.measure(request, options["requests"], options["warmup"])
+                self.report(name, results[name])
+
+        if options["json_path"]:
+            with open(options["json_path"], "w") as f:
+                json.dump({
+                    "commit": self.git_commit(),
+                    "database": connection.vendor,
+                    "requests": options["requests"],
+                    "results": results,
+                }, f, indent=2)
+            self.stdout.write(f"Results written to {options['json_path']}")
+
+    def measure(self, request, count, warmup):
+        for i in range(warmup):
+            request(i)
+
+        latencies, queries, errors = [], [], 0
+        started = time.perf_counter()
+        for i in range(count):
+            with CaptureQueriesContext(connection) as context:
+                start = time.perf_counter()
+                response = request(i)
+                latencies.append((time.perf_counter() - start) * 1000)
+            queries.append(len(context))
+            if response.status_code >= 400:
+                errors += 1
+        elapsed = time.perf_counter() - started
+        reset_queries()
+
+        percentiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+        return {
+            "p50_ms": round(percentiles[49], 3),
+            "p95_ms": round(percentiles[94], 3),
+            "p99_ms": round(percentiles[98], 3),
+            "queries_per_request": round(statistics.mean(queries), 2),
+            "max_queries": max(queries),
+            "throughput_rps": round(count / elapsed, 1),
+            "errors": errors,
+        }
+
+    def report(self, name, result):
+        self.stdout.write(
+            f"{name:<16} p50 {result['p50_ms']:>8.2f} ms  p95 {result['p95_ms']:>8.2f} ms  "
+            f"p99 {result['p99_ms']:>8.2f} ms  {result['queries_per_request']:>6.1f} queries  "
+            f"{result['throughput_rps']:>8.1f} req/s  {result['errors']} errors"
+        )
+
+    def git_commit(self):
+        try:
+            return subprocess.run(
+                ["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
@@ -0,0 +1,89 @@
+import random
+import statistics
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection
+
+from auctions.models import User, Listing
+from auctions.services import BidConflict, BidTooLow, place_bid
+
+
+class Command(BaseCommand):
+    help = (
+        "Place bids from concurrent threads through place_bid() and report accepted bids "
+        "per second and bid latency, on one hot listing or spread over several"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--threads", type=int, default=8, help="Bidding threads, one user each")
+        parser.add_argument("--duration", type=float, default=5, help="Seconds to bid for")
+        parser.add_argument(
+            "--listings",
+            type=int,
+            default=1,
+            help="Active listings the bids go to, 1 puts every bid on the same row"
+        )
+
+    def handle(self, *args, **options):
+        listings = list(Listing.objects.filter(active=True, ends_at=None).order_by("-bid_count")[:options["listings"]])
+        authors = {listing.author_id for listing in listings}
+        users = list(User.objects.exclude(pk__in=authors).order_by("?")[:options["threads"]])
+        if len(listings) < options["listings"] or len(users) < options["threads"]:
+            raise CommandError("Not enough data, run generate_data first")
+
+        stop = threading.Event()
+        barrier = threading.Barrier(options["threads"])
+        latencies = []
+        outcomes = {"accepted": 0, "too_low": 0, "conflicts": 0, "locked": 0}
+        lock = threading.Lock()
+
+        def bidder(user):
+            rng = random.Random(user.pk)
+            done, counts = [], dict.fromkeys(outcomes, 0)
+            try:
+                barrier.wait()
+                while not stop.is_set():
+                    listing = rng.choice(listings)
+                    price = Listing.objects.values_list("current_price", flat=True).get(pk=listing.pk)
+                    start = time.perf_counter()
+                    try:
+                        place_bid(listing, user, price + rng.randint(1, 5))
+                        counts["accepted"] += 1
+                    except BidTooLow:
+                        # Outbid between reading the price and bidding
+                        counts["too_low"] += 1
+                    except BidConflict:
+                        counts["conflicts"] += 1
+                    except OperationalError as e:
+                        if "locked" not in str(e):
+                            raise
+                        counts["locked"] += 1
+                    done.append((time.perf_counter() - start) * 1000)
+            finally:
+                with lock:
+                    latencies.extend(done)
+                    for name, n in counts.items():
+                        outcomes[name] += n
+                connection.close()
+
+        threads = [threading.Thread(target=bidder, args=(user,)) for user in users]
+        started = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        time.sleep(options["duration"])
+        stop.set()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - started
+
+        if not latencies:
+            raise CommandError("No bids were placed")
+        percentiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+        self.stdout.write(
+            f"{connection.vendor}, {options['threads']} threads, {len(listings)} listing(s): "
+            f"{outcomes['accepted'] / elapsed:.1f} accepted bids/s, {len(latencies) / elapsed:.1f} attempts/s, "
+            f"p50 {percentiles[49]:.2f} ms, p95 {percentiles[94]:.2f} ms "
+            f"({outcomes['too_low']} outbid, {outcomes['conflicts']} conflicts, {outcomes['locked']} locked)"
+        )
@@ -0,0 +1,125 @@
+import random
+import statistics
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, models, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from auctions.models import User, ListingCategory, Listing, CategoryPriceBucket, CategoryStats
+
+
+TITLE_PREFIX = "benchmark-feed"
+
+
+class Command(BaseCommand):
+    help = (
+        "Grow the listing table step by step with synthetic active listings and report the "
+        "latency of the feed sorts, price filters and facets at each size, to check it stays flat"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sizes",
+            type=int,
+            nargs="+",
+            default=[1000, 10000, 50000],
+            help="Listing table sizes to measure at, ascending"
+        )
+        parser.add_argument("--requests", type=int, default=30, help="Requests per scenario and size")
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument(
+            "--keep",
+            action="store_true",
+            help="Keep the synthetic listings instead of deleting them at the end"
+        )
+
+    def handle(self, *args, **options):
+        user = User.objects.first()
+        categories = list(ListingCategory.objects.values_list("pk", flat=True))
+        if user is None or not categories:
+            raise CommandError("Not enough data, run generate_data first")
+        self.rng = random.Random(options["seed"])
+
+        client = Client(HTTP_HOST="localhost")
+        # Logged in, so responses come from the views rather than the feed cache
+        client.force_login(user)
+        category = ListingCategory.objects.filter(parent=None).first()
+        scenarios = {
+            "newest": (reverse("index"), {}),
+            "price": (reverse("index"), {"sort": "price"}),
+            "price_range": (reverse("index"), {"price": 2}),
+            "bids": (reverse("index"), {"sort": "bids"}),
+            "ending": (reverse("index"), {"sort": "ending"}),
+            "category_price": (category.get_absolute_url(), {"sort": "-price"}),
+        }
+
+        first_pk = (Listing.objects.aggregate(models.Max("pk"))["pk__max"] or 0) + 1
+        try:
+            self.stdout.write(f"{'listings':>10}  " + "  ".join(f"{name:>22}" for name in scenarios))
+            for size in options["sizes"]:
+                self.grow(size, user, categories, first_pk, options["batch_size"])
+                row = []
+                for name, (url, params) in scenarios.items():
+                    p50, p95, queries = self.measure(client, url, params, options["requests"])
+                    row.append(f"{p50:>6.2f}/{p95:>6.2f} ms {queries:>2}q")
+                self.stdout.write(f"{Listing.objects.count():>10}  " + "  ".join(f"{cell:>22}" for cell in row))
+        finally:
+            if not options["keep"]:
+                self.clean_up(first_pk)
+
+    def grow(self, size, user, categories, first_pk, batch_size):
+        missing = size - Listing.objects.count()
+        next_pk = (Listing.objects.aggregate(models.Max("pk"))["pk__max"] or 0) + 1
+        now = timezone.now()
+        while missing > 0:
+            listings = []
+            for i in range(min(batch_size, missing)):
+                price = round(self.rng.lognormvariate(3, 1.2), 2)
+                listings.append(Listing(
+                    pk=next_pk,
+                    author=user,
+                    title=f"{TITLE_PREFIX} {next_pk}",
+                    description="Synthetic listing",
+                    category_id=self.rng.choice(categories + [None]),
+                    starting_bid=price,
+                    current_price=price,
+                    bid_count=int(self.rng.paretovariate(1.16)) - 1,
+                    ends_at=now + timedelta(hours=self.rng.uniform(0, 24 * 14)) if self.rng.random() < 0.5 else None
+                ))
+                next_pk += 1
+            with transaction.atomic():
+                Listing.objects.bulk_create(listings)
+            missing -= len(listings)
+        # Bulk inserts skip the incremental updates
+        CategoryPriceBucket.rebuild()
+        with connection.cursor() as cursor:
+            if connection.vendor == "sqlite":
+                cursor.execute("ANALYZE")
+
+    def measure(self, client, url, params, count):
+        client.get(url, params)  # Warm up
+        latencies, queries = [], []
+        for i in range(count):
+            with CaptureQueriesContext(connection) as context:
+                start = time.perf_counter()
+                response = client.get(url, params)
+                latencies.append((time.perf_counter() - start) * 1000)
+            queries.append(len(context))
+            if response.status_code != 200:
+                raise CommandError(f"{url} answered {response.status_code}")
+        percentiles = statistics.quantiles(latencies, n=100) if len(latencies) > 1 else latencies * 99
+        return percentiles[49], percentiles[94], max(queries)
+
+    def clean_up(self, first_pk):
+        with transaction.atomic():
+            # Raw delete: the synthetic rows have no bids, comments, watchers or search entries
+            Listing.objects.filter(pk__gte=first_pk, title__startswith=TITLE_PREFIX)._raw_delete(Listing.objects.db)
+            CategoryPriceBucket.rebuild()
+            CategoryStats.rebuild()
+        self.stdout.write("Removed the synthetic listings")
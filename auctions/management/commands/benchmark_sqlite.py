@@ -0,0 +1,123 @@
+import random
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import OperationalError, connection, connections
+from django.test.utils import override_settings
+
+from auctions.models import User, Listing, Comment
+from auctions.services import BidConflict, BidTooLow, place_bid
+from auctions.sqlite import PROFILES, serialized_writes
+
+
+class Command(BaseCommand):
+    help = (
+        "Run concurrent readers and bid/comment writers against the SQLite database "
+        "under each SQLite profile and report read throughput and write success rates"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--readers", type=int, default=4, help="Reader threads")
+        parser.add_argument("--writers", type=int, default=4, help="Writer threads")
+        parser.add_argument("--duration", type=float, default=5, help="Seconds per profile")
+        parser.add_argument(
+            "--profile",
+            action="append",
+            dest="profiles",
+            choices=sorted(PROFILES),
+            help="Profile to measure, can be repeated (default and production by default)"
+        )
+
+    def handle(self, *args, **options):
+        if connection.vendor != "sqlite":
+            raise CommandError("The configured database isn't SQLite")
+        listing = Listing.objects.filter(active=True).order_by("-bid_count").first()
+        users = list(User.objects.exclude(pk=getattr(listing, "author_id", None)).order_by("?")[:options["writers"]])
+        if listing is None or len(users) < options["writers"]:
+            raise CommandError("Not enough data, run generate_data first")
+
+        for profile in options["profiles"] or ["default", "production"]:
+            with override_settings(SQLITE_PROFILE=profile):
+                # Start over with connections configured by this profile
+                connections.close_all()
+                if profile == "default":
+                    # WAL sticks to the database file, measure the baseline in rollback journal mode
+                    with connection.cursor() as cursor:
+                        cursor.execute("PRAGMA journal_mode = delete")
+                result = self.run(listing, users, options)
+                connections.close_all()
+            self.report(profile, result, options["duration"])
+
+    def run(self, listing, users, options):
+        stop = threading.Event()
+        barrier = threading.Barrier(options["readers"] + options["writers"])
+        reads = []
+        writes = {"bids": 0, "too_low": 0, "comments": 0, "conflicts": 0, "locked": 0}
+        lock = threading.Lock()
+
+        def count(name, n=1):
+            with lock:
+                writes[name] += n
+
+        def reader():
+            done = 0
+            try:
+                barrier.wait()
+                while not stop.is_set():
+                    # What the listing page reads
+                    Listing.objects.with_related().get(pk=listing.pk)
+                    list(listing.bids.with_users()[:10])
+                    list(listing.comments.with_authors()[:10])
+                    done += 1
+            finally:
+                with lock:
+                    reads.append(done)
+                connection.close()
+
+        def writer(user):
+            rng = random.Random(user.pk)
+            try:
+                barrier.wait()
+                while not stop.is_set():
+                    try:
+                        if rng.random() < 0.7:
+                            price = Listing.objects.values_list("current_price", flat=True).get(pk=listing.pk)
+                            place_bid(listing, user, price + rng.randint(1, 5))
+                            count("bids")
+                        else:
+                            with serialized_writes():
+                                Comment.objects.create(author=user, on_listing=listing, text="Benchmark")
+                            count("comments")
+                    except BidTooLow:
+                        # Outbid in between, a normal outcome
+                        count("too_low")
+                    except BidConflict:
+                        count("conflicts")
+                    except OperationalError as e:
+                        if "locked" not in str(e):
+                            raise
+                        count("locked")
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=reader) for _ in range(options["readers"])]
+        threads += [threading.Thread(target=writer, args=(user,)) for user in users]
+        for thread in threads:
+            thread.start()
+        time.sleep(options["duration"])
+        stop.set()
+        for thread in threads:
+            thread.join()
+        return {"reads": sum(reads), **writes}
+
+    def report(self, profile, result, duration):
+        attempts = sum(result[name] for name in ("bids", "too_low", "comments", "conflicts", "locked"))
+        failed = result["conflicts"] + result["locked"]
+        success = 100 * (attempts - failed) / attempts if attempts else 0
+        self.stdout.write(
+            f"{profile:<12} reads {result['reads'] / duration:>9.1f}/s  "
+            f"writes {attempts / duration:>7.1f}/s  success {success:>6.2f}%  "
+            f"({result['bids']} bids, {result['too_low']} outbid, {result['comments']} comments, "
+            f"{result['conflicts']} conflicts, {result['locked']} locked)"
+        )
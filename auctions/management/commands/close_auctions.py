@@ -0,0 +1,55 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import close_old_connections
+from django.utils import timezone
+
+from auctions.services import close_due_listings, next_deadline
+
+
+class Command(BaseCommand):
+    help = "Close listings whose end time has passed, then sleep until the next deadline"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--once",
+            action="store_true",
+            help="Close the listings that are due now and exit"
+        )
+        parser.add_argument(
+            "--batch-size",
+            type=int,
+            default=500,
+            help="Listings closed per UPDATE statement"
+        )
+        parser.add_argument(
+            "--max-sleep",
+            type=float,
+            default=30,
+            help="Longest sleep in seconds, bounds the delay for end times added while asleep"
+        )
+
+    def handle(self, *args, **options):
+        while True:
+            closed = self.close_due(options["batch_size"])
+            if options["once"]:
+                break
+
+            deadline = next_deadline()
+            close_old_connections()
+            delay = options["max_sleep"]
+            if deadline is not None:
+                delay = min(delay, max((deadline - timezone.now()).total_seconds(), 0))
+            if delay:
+                time.sleep(delay)
+
+    def close_due(self, batch_size):
+        total = 0
+        while True:
+            ids = close_due_listings(batch_size=batch_size)
+            total += len(ids)
+            if len(ids) < batch_size:
+                break
+        if total:
+            self.stdout.write(f"Closed {total} listing(s)")
+        return total
@@ -0,0 +1,81 @@
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+
+from auctions.models import ListingCategory, Listing, Bid, Comment
+
+
+class Command(BaseCommand):
+    help = (
+        "Print query plans and timings of the hot listing, bid and comment queries, "
+        "with the access path indexes and, for comparison, without them"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--seed",
+            type=int,
+            default=0,
+            help="Generate this many listings with generate_data before measuring"
+        )
+        parser.add_argument(
+            "--repeat",
+            type=int,
+            default=20,
+            help="Times each query is run for the timing"
+        )
+
+    def handle(self, *args, **options):
+        if options["seed"]:
+            call_command("generate_data", listings=options["seed"], stdout=self.stdout)
+
+        listing = Listing.objects.order_by("-bid_count").first()
+        if listing is None:
+            self.stderr.write("No listings, run with --seed or generate_data first")
+            return
+        category = listing.category or ListingCategory.objects.first()
+
+        queries = {
+            "feed": lambda: Listing.objects.filter(active=True)[:7],
+            "category feed": lambda: Listing.objects.filter(category=category, active=True)[:7],
+            "bid history": lambda: Bid.objects.filter(on_listing=listing)[:11],
+            "max bid": lambda: Bid.objects.filter(on_listing=listing).order_by("-amount")[:1],
+            "comments": lambda: Comment.objects.filter(on_listing=listing)[:11],
+        }
+
+        self.stdout.write(self.style.MIGRATE_HEADING("With access path indexes"))
+        self.report(queries, options["repeat"], "indexed")
+
+        # Drop the indexes inside a transaction that is rolled back afterwards
+        # (DDL is transactional on SQLite and PostgreSQL)
+        with transaction.atomic():
+            schema_editor = connection.SchemaEditorClass(connection)
+            with connection.cursor() as cursor:
+                for model in (Listing, Bid, Comment):
+                    for index in model._meta.indexes:
+                        cursor.execute(str(index.remove_sql(model, schema_editor)))
+            self.stdout.write(self.style.MIGRATE_HEADING("Without access path indexes"))
+            self.report(queries, options["repeat"], "unindexed")
+            transaction.set_rollback(True)
+
+    def report(self, queries, repeat, phase):
+        for name, query in queries.items():
+            start = time.perf_counter()
+            for _ in range(repeat):
+                list(query())
+            elapsed = (time.perf_counter() - start) / repeat * 1000
+            self.stdout.write(self.style.SQL_KEYWORD(f"{name}: {elapsed:.3f} ms"))
+            self.stdout.write(self.explain(query(), phase))
+            self.stdout.write("")
+
+    def explain(self, queryset, phase):
+        if connection.vendor != "sqlite":
+            return queryset.explain()
+        # sqlite3 caches prepared statements by SQL text and would report the
+        # plan made before the indexes were dropped, hence the phase comment
+        sql, params = queryset.query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute(f"EXPLAIN QUERY PLAN /* {phase} */ {sql}", params)
+            return "\n".join(" ".join(str(column) for column in row) for row in cursor.fetchall())
@@ -0,0 +1,172 @@
+import csv
+import json
+import os
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.serializers.json import DjangoJSONEncoder
+
+from auctions.archive import decode_bids
+from auctions.models import Listing, Bid, BidArchive, Comment, User
+
+
+# Exported columns -> ORM lookups. Related rows are exported by natural key.
+EXPORTS = {
+    "listings": (Listing, {
+        "id": "pk",
+        "title": "title",
+        "description": "description",
+        "author": "author__username",
+        "category": "category__slug",
+        "image": "image",
+        "starting_bid": "starting_bid",
+        "current_price": "current_price",
+        "bid_count": "bid_count",
+        "winner": "user_with_max_bid__username",
+        "active": "active",
+        "date_added": "date_added",
+        "ends_at": "ends_at",
+    }),
+    "bids": (Bid, {
+        "id": "pk",
+        "listing": "on_listing_id",
+        "user": "from_user__username",
+        "amount": "amount",
+        "date_added": "date_added",
+    }),
+    # The bids moved to BidArchive segments by archive_bids, with the same
+    # columns. Rows are in listing order, --after-pk and checkpoints are
+    # listing ids. Leading bids stay in Bid and are only in "bids".
+    "archived_bids": (BidArchive, {
+        "id": "pk",
+        "listing": "on_listing_id",
+        "user": "from_user__username",
+        "amount": "amount",
+        "date_added": "date_added",
+    }),
+    "comments": (Comment, {
+        "id": "pk",
+        "listing": "on_listing_id",
+        "author": "author__username",
+        "text": "text",
+        "date_added": "date_added",
+    }),
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream listings, bids, archived bids or comments to CSV or JSON lines in pk order. "
+        "With --checkpoint an interrupted export continues where it stopped."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("model", choices=sorted(EXPORTS))
+        parser.add_argument("--output", help="Output file, stdout by default")
+        parser.add_argument("--format", choices=["csv", "jsonl"], default="jsonl")
+        parser.add_argument("--chunk-size", type=int, default=2000, help="Rows fetched per round trip")
+        parser.add_argument("--after-pk", type=int, default=0, help="Export only rows with a greater pk")
+        parser.add_argument(
+            "--checkpoint",
+            help="File holding the last exported pk and output offset. Read on start to resume --output."
+        )
+
+    def handle(self, *args, **options):
+        model, columns = EXPORTS[options["model"]]
+        checkpoint = options["checkpoint"]
+        if checkpoint and not options["output"]:
+            raise CommandError("--checkpoint needs --output")
+
+        after_pk, offset = options["after_pk"], 0
+        resuming = bool(checkpoint and os.path.exists(checkpoint))
+        if resuming:
+            with open(checkpoint) as f:
+                position = json.load(f)
+            after_pk, offset = position["pk"], position["offset"]
+
+        if model is BidArchive:
+            rows = self.archived_bid_rows(after_pk, options["chunk_size"])
+        else:
+            rows = (
+                (row["pk"], {name: row[lookup] for name, lookup in columns.items()})
+                for row in model.objects.filter(pk__gt=after_pk)
+                .order_by("pk")
+                .values(*columns.values())
+                .iterator(chunk_size=options["chunk_size"])
+            )
+
+        out = sys.stdout
+        if options["output"]:
+            out = open(options["output"], "r+" if resuming else "w", encoding="utf-8", newline="")
+            if resuming:
+                # Drop whatever was written after the last checkpoint
+                out.seek(offset)
+                out.truncate()
+        try:
+            write = self.writer(out, options["format"], list(columns), header=not resuming)
+            exported = saved = 0
+            last_pk = None
+            for pk, row in rows:
+                write(row)
+                exported += 1
+                # pk is None within an archive segment, which can't be resumed halfway
+                if pk is not None:
+                    last_pk = pk
+                    if checkpoint and exported - saved >= options["chunk_size"]:
+                        self.save_checkpoint(out, checkpoint, pk)
+                        saved = exported
+            if checkpoint and exported > saved:
+                self.save_checkpoint(out, checkpoint, last_pk)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+        self.stderr.write(f"Exported {exported} {options['model']} after pk {after_pk}")
+        if model is Bid and BidArchive.objects.exists():
+            self.stderr.write("Closed listings have archived bids, export them with archived_bids")
+
+    def archived_bid_rows(self, after_pk, chunk_size):
+        # (listing id on the last row of a segment else None, row), a chunk of
+        # segments and their bidders' usernames per round trip
+        while True:
+            segments = list(
+                BidArchive.objects.filter(pk__gt=after_pk)
+                .order_by("pk")
+                .values_list("pk", "listing__leading_bid_id", "data")[:chunk_size]
+            )
+            if not segments:
+                return
+            histories = [
+                (listing_id, [bid for bid in decode_bids(data) if bid[0] != leading_bid_id])
+                for listing_id, leading_bid_id, data in segments
+            ]
+            usernames = dict(User.objects.filter(
+                pk__in={user_id for listing_id, bids in histories for pk, user_id, amount, date_added in bids}
+            ).values_list("pk", "username"))
+            for listing_id, bids in histories:
+                # Oldest first, like the bids export
+                for i, (pk, user_id, amount, date_added) in enumerate(reversed(bids)):
+                    yield listing_id if i == len(bids) - 1 else None, {
+                        "id": pk,
+                        "listing": listing_id,
+                        "user": usernames.get(user_id),
+                        "amount": amount,
+                        "date_added": date_added,
+                    }
+            after_pk = segments[-1][0]
+
+    def writer(self, out, fmt, fieldnames, header):
+        if fmt == "csv":
+            writer = csv.DictWriter(out, fieldnames=fieldnames)
+            if header:
+                writer.writeheader()
+            return writer.writerow
+        return lambda row: out.write(json.dumps(row, cls=DjangoJSONEncoder) + "\n")
+
+    def save_checkpoint(self, out, path, pk):
+        # Rows up to pk must be on disk before the checkpoint says so
+        out.flush()
+        os.fsync(out.fileno())
+        tmp = f"{path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({"pk": pk, "offset": out.tell()}, f)
+        os.replace(tmp, path)
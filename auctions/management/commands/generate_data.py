@@ -0,0 +1,208 @@
+import random
+import time
+from datetime import timedelta
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand
+from django.core.management.color import no_style
+from django.db import connection, models, transaction
+from django.utils import timezone
+from django.utils.text import slugify
+
+from auctions import cache, search
+from auctions.models import User, ListingCategory, Listing, Bid, Comment, UserStats, CategoryStats, CategoryPriceBucket
+
+
+WORDS = (
+    "vintage rare antique mint boxed signed handmade classic retro limited "
+    "camera guitar bicycle watch lamp chair novel poster jacket vinyl "
+    "leather wooden silver brass ceramic wool carbon steel glass oak"
+).split()
+
+
+class Command(BaseCommand):
+    help = (
+        "Bulk-generate users, categories, listings with skewed bid counts, comments "
+        "and watchlists for benchmarking"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000)
+        parser.add_argument("--categories", type=int, default=20)
+        parser.add_argument("--listings", type=int, default=10000)
+        parser.add_argument(
+            "--max-bids",
+            type=int,
+            default=500,
+            help="Cap of the Pareto distributed number of bids per listing"
+        )
+        parser.add_argument(
+            "--comments",
+            type=float,
+            default=3,
+            help="Average number of comments per listing"
+        )
+        parser.add_argument(
+            "--watchlist",
+            type=int,
+            default=10,
+            help="Average number of watched listings per user"
+        )
+        parser.add_argument(
+            "--active",
+            type=float,
+            default=0.3,
+            help="Share of listings that are still active"
+        )
+        parser.add_argument(
+            "--closed-days",
+            type=float,
+            default=90,
+            help="Closed listings closed up to this many days ago, so archive_bids has work"
+        )
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--seed", type=int, default=0, help="Random seed, for reproducible data")
+
+    def handle(self, *args, **options):
+        self.rng = random.Random(options["seed"])
+        self.batch_size = options["batch_size"]
+        started = time.perf_counter()
+
+        users = self.generate_users(options["users"])
+        categories = self.generate_categories(options["categories"])
+        self.generate_listings(options, users, categories)
+        self.generate_watchlists(options["watchlist"], users)
+        self.reset_sequences()
+        # Rows were bulk inserted, past the incremental updates
+        UserStats.rebuild(users)
+        CategoryStats.rebuild()
+        CategoryPriceBucket.rebuild()
+
+        cache.bump(
+            cache.FEED,
+            cache.CATEGORIES,
+            *(cache.category_generation(category.slug) for category in categories)
+        )
+        self.stdout.write(self.style.SUCCESS(f"Done in {time.perf_counter() - started:.1f}s"))
+
+    def next_pk(self, model):
+        return (model.objects.aggregate(models.Max("pk"))["pk__max"] or 0) + 1
+
+    def title(self, words=3):
+        return " ".join(self.rng.choice(WORDS) for _ in range(words)).capitalize()
+
+    def generate_users(self, count):
+        # Hashing once keeps generation fast, every user gets the password "password"
+        password = make_password("password")
+        start = self.next_pk(User)
+        users = [
+            User(
+                pk=start + i,
+                username=f"user{start + i}",
+                email=f"user{start + i}@example.com",
+                first_name=self.rng.choice(["Alex", "Sam", "Kim", "Lee", "Max"]),
+                last_name=self.rng.choice(["Smith", "Ivanov", "Chen", "Garcia", "Khan"]),
+                password=password
+            )
+            for i in range(count)
+        ]
+        User.objects.bulk_create(users, batch_size=self.batch_size)
+        self.stdout.write(f"Created {count} users")
+        return [user.pk for user in users]
+
+    def generate_categories(self, count):
+        existing = set(ListingCategory.objects.values_list("slug", flat=True))
+        created = []
+        for i in range(count):
+            category = ListingCategory(name=f"{self.title(1)} {i}")
+            if slugify(category.name) in existing:
+                continue
+            # About a third become subcategories, saved one by one for their paths
+            if created and self.rng.random() < 0.35:
+                category.parent = self.rng.choice(created)
+            category.save()
+            created.append(category)
+        categories = list(ListingCategory.objects.all())
+        self.stdout.write(f"Using {len(categories)} categories")
+        return categories
+
+    def bid_count(self, max_bids):
+        # Most listings get a few bids, a handful get hundreds
+        return min(int(3 * self.rng.paretovariate(1.16)) - 3, max_bids)
+
+    def generate_listings(self, options, users, categories):
+        count = options["listings"]
+        listing_pk, bid_pk, comment_pk = self.next_pk(Listing), self.next_pk(Bid), self.next_pk(Comment)
+        now = timezone.now()
+
+        for offset in range(0, count, self.batch_size):
+            listings, bids, comments = [], [], []
+            for i in range(min(self.batch_size, count - offset)):
+                author = self.rng.choice(users)
+                starting_bid = round(self.rng.lognormvariate(3, 1), 2)
+                listing = Listing(
+                    pk=listing_pk,
+                    author_id=author,
+                    title=self.title(),
+                    description=" ".join(self.rng.choice(WORDS) for _ in range(self.rng.randint(10, 60))),
+                    category=self.rng.choice(categories + [None]),
+                    starting_bid=starting_bid,
+                    current_price=starting_bid,
+                    active=self.rng.random() < options["active"]
+                )
+                if not listing.active:
+                    listing.closed_at = now - timedelta(days=self.rng.uniform(0, options["closed_days"]))
+                amount = starting_bid
+                for _ in range(self.bid_count(options["max_bids"])):
+                    amount = round(amount + self.rng.uniform(0.5, 0.1 * amount + 1), 2)
+                    bid = Bid(pk=bid_pk, from_user_id=self.rng.choice(users), on_listing_id=listing_pk, amount=amount)
+                    bids.append(bid)
+                    bid_pk += 1
+                    listing.bid_count += 1
+                    listing.current_price = amount
+                    listing.leading_bid_id = bid.pk
+                    listing.user_with_max_bid_id = bid.from_user_id
+                for _ in range(int(self.rng.expovariate(1 / options["comments"])) if options["comments"] else 0):
+                    comments.append(Comment(
+                        pk=comment_pk,
+                        author_id=self.rng.choice(users),
+                        on_listing_id=listing_pk,
+                        text=self.title(self.rng.randint(3, 12))
+                    ))
+                    comment_pk += 1
+                listings.append(listing)
+                listing_pk += 1
+
+            # Listing.leading_bid points at bids inserted right after it, the
+            # FK constraints are deferred until the end of the transaction
+            with transaction.atomic():
+                Listing.objects.bulk_create(listings)
+                Bid.objects.bulk_create(bids, batch_size=self.batch_size)
+                Comment.objects.bulk_create(comments, batch_size=self.batch_size)
+                search.index_listings(listings)
+            self.stdout.write(
+                f"Created {offset + len(listings)}/{count} listings, {len(bids)} bids, {len(comments)} comments"
+            )
+
+    def generate_watchlists(self, average, users):
+        if not average:
+            return
+        Watch = Listing.watchlisted_by.through
+        listing_ids = list(Listing.objects.filter(active=True).values_list("pk", flat=True))
+        if not listing_ids:
+            return
+        watches = []
+        for user in users:
+            for listing in self.rng.sample(listing_ids, min(len(listing_ids), int(self.rng.expovariate(1 / average)))):
+                watches.append(Watch(user_id=user, listing_id=listing))
+        Watch.objects.bulk_create(watches, batch_size=self.batch_size, ignore_conflicts=True)
+        # Bulk inserts skip the m2m_changed signal, and duplicates were ignored
+        Listing.refresh_watcher_counts()
+        self.stdout.write(f"Created {len(watches)} watchlist entries")
+
+    def reset_sequences(self):
+        # Rows were inserted with explicit pks, move the sequences past them
+        statements = connection.ops.sequence_reset_sql(no_style(), [User, ListingCategory, Listing, Bid, Comment])
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
@@ -0,0 +1,133 @@
+import csv
+import json
+import sys
+import time
+from collections import defaultdict
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, models, transaction
+
+from auctions import cache, search
+from auctions.forms import ListingImportForm
+from auctions.models import User, ListingCategory, Listing, UserStats, CategoryStats, CategoryPriceBucket
+
+
+class Command(BaseCommand):
+    help = (
+        "Stream listings from a CSV or JSON lines file into the database in batches. "
+        "Rows are validated with the ListingForm rules, categories are given by slug."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("path", help="CSV or JSON lines file, '-' for stdin")
+        parser.add_argument("--author", required=True, help="Username of the seller the listings belong to")
+        parser.add_argument(
+            "--format",
+            choices=["csv", "jsonl"],
+            help="Input format, guessed from the file extension by default"
+        )
+        parser.add_argument("--batch-size", type=int, default=1000)
+
+    def handle(self, *args, **options):
+        try:
+            self.author = User.objects.get(username=options["author"])
+        except User.DoesNotExist:
+            raise CommandError(f"Unknown user '{options['author']}'")
+        fmt = options["format"] or ("csv" if options["path"].endswith(".csv") else "jsonl")
+        # Categories are few, rows may be millions: only the categories are kept in memory
+        self.categories = {category.slug: category for category in ListingCategory.objects.all()}
+        self.touched_categories = set()
+
+        started = time.perf_counter()
+        created = errors = 0
+        batch = []
+        with self.open(options["path"]) as f:
+            rows = self.read_csv(f) if fmt == "csv" else self.read_jsonl(f)
+            for line, row in rows:
+                listing = self.build(line, row)
+                if listing is None:
+                    errors += 1
+                    continue
+                batch.append(listing)
+                if len(batch) == options["batch_size"]:
+                    created += self.save(batch)
+                    batch = []
+            if batch:
+                created += self.save(batch)
+
+        if created:
+            cache.bump(
+                cache.FEED,
+                cache.CATEGORIES,
+                *(
+                    cache.category_generation(category.slug)
+                    for category in ListingCategory.with_ancestors(
+                        self.categories[slug].pk for slug in self.touched_categories
+                    )
+                )
+            )
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {created} listing(s), skipped {errors} invalid row(s) "
+            f"in {time.perf_counter() - started:.1f}s"
+        ))
+
+    def open(self, path):
+        if path == "-":
+            return open(sys.stdin.fileno(), encoding="utf-8", newline="", closefd=False)
+        return open(path, encoding="utf-8", newline="")
+
+    def read_csv(self, f):
+        for i, row in enumerate(csv.DictReader(f), start=2):
+            yield i, row
+
+    def read_jsonl(self, f):
+        for i, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError as e:
+                self.stderr.write(f"Line {i}: invalid JSON ({e})")
+                row = None
+            yield i, row
+
+    def build(self, line, row):
+        if not isinstance(row, dict):
+            return None
+        data = {key: "" if value is None else value for key, value in row.items()}
+        form = ListingImportForm(data, categories=self.categories)
+        if not form.is_valid():
+            messages = "; ".join(
+                f"{field}: {' '.join(field_errors)}" for field, field_errors in form.errors.items()
+            )
+            self.stderr.write(f"Line {line}: {messages}")
+            return None
+        listing = form.save(commit=False)
+        listing.author = self.author
+        listing.category = form.cleaned_data["category"]
+        # Listing.save() is bypassed by bulk_create
+        listing.current_price = listing.starting_bid
+        if listing.category is not None:
+            self.touched_categories.add(listing.category.slug)
+        return listing
+
+    def save(self, batch):
+        with transaction.atomic():
+            if not connection.features.can_return_rows_from_bulk_insert:
+                # SQLite doesn't report the ids of bulk inserted rows and the search
+                # index needs them. A concurrent insert makes the batch fail on the
+                # primary key rather than mix up rows.
+                start = (Listing.objects.aggregate(models.Max("pk"))["pk__max"] or 0) + 1
+                for i, listing in enumerate(batch):
+                    listing.pk = start + i
+            Listing.objects.bulk_create(batch)
+            search.index_listings(batch)
+            UserStats.add(self.author.pk, listing_count=len(batch))
+            prices = defaultdict(list)
+            for listing in batch:
+                if listing.active:
+                    prices[listing.category_id].append(listing.current_price)
+            for category_id, category_prices in prices.items():
+                CategoryStats.listings_added(category_id, len(category_prices), min(category_prices), max(category_prices))
+                CategoryPriceBucket.add(category_id, category_prices)
+        return len(batch)
@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from auctions.models import Listing
+
+
+class Command(BaseCommand):
+    help = "Rebuild denormalized current price, bid count and leading bid of listings from Bid"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "ids",
+            nargs="*",
+            type=int,
+            help="Listing ids to rebuild (all listings by default)"
+        )
+
+    def handle(self, *args, **options):
+        listings = Listing.objects.all()
+        if options["ids"]:
+            listings = listings.filter(pk__in=options["ids"])
+
+        rebuilt = 0
+        for listing in listings.iterator():
+            with transaction.atomic():
+                listing.refresh_bid_stats()
+            rebuilt += 1
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt bid stats of {rebuilt} listing(s)"))
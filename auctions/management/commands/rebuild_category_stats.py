@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from auctions import cache
+from auctions.models import CategoryPriceBucket, CategoryStats, ListingCategory
+
+
+class Command(BaseCommand):
+    help = "Rebuild per-category active listing counts, price ranges and price buckets from Listing"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "slugs",
+            nargs="*",
+            help="Categories to rebuild (all categories by default)"
+        )
+
+    def handle(self, *args, **options):
+        categories = ListingCategory.objects.all()
+        if options["slugs"]:
+            categories = categories.filter(slug__in=options["slugs"])
+        category_ids = list(categories.values_list("pk", flat=True))
+
+        with transaction.atomic():
+            CategoryStats.rebuild(category_ids)
+            # All buckets when no categories are given, including uncategorized listings
+            CategoryPriceBucket.rebuild(category_ids if options["slugs"] else None)
+        cache.bump(cache.CATEGORIES)
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt stats of {len(category_ids)} category(ies)"))
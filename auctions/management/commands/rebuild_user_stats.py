@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from auctions.models import User, UserStats
+
+
+class Command(BaseCommand):
+    help = "Rebuild per-user listing, bid, leading and won totals from Listing and Bid"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "usernames",
+            nargs="*",
+            help="Users to rebuild (all users by default)"
+        )
+
+    def handle(self, *args, **options):
+        user_ids = None
+        if options["usernames"]:
+            user_ids = list(User.objects.filter(username__in=options["usernames"]).values_list("pk", flat=True))
+
+        with transaction.atomic():
+            UserStats.rebuild(user_ids)
+        rebuilt = len(user_ids) if user_ids is not None else UserStats.objects.count()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt stats of {rebuilt} user(s)"))
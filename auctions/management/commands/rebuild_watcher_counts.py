@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from auctions.models import Listing
+
+
+class Command(BaseCommand):
+    help = "Rebuild denormalized watcher counts of listings from the watchlist table"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "ids",
+            nargs="*",
+            type=int,
+            help="Listing ids to rebuild (all listings by default)"
+        )
+
+    def handle(self, *args, **options):
+        ids = options["ids"] or None
+        with transaction.atomic():
+            Listing.refresh_watcher_counts(ids)
+        rebuilt = len(ids) if ids is not None else Listing.objects.count()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt watcher counts of {rebuilt} listing(s)"))
@@ -0,0 +1,31 @@
+import sqlite3
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from auctions.routers import replica_aliases
+
+
+class Command(BaseCommand):
+    help = "Copy the primary SQLite database into the SQLite files standing in for read replicas"
+
+    def handle(self, *args, **options):
+        aliases = replica_aliases()
+        if not aliases:
+            raise CommandError("No replicas configured, set DATABASE_REPLICAS")
+        for alias in [DEFAULT_DB_ALIAS] + aliases:
+            if connections[alias].vendor != "sqlite":
+                raise CommandError(f"{alias} isn't a SQLite database, replicate it with the database's own tools")
+
+        primary = connections[DEFAULT_DB_ALIAS]
+        primary.ensure_connection()
+        for alias in aliases:
+            # Replicas may hold persistent connections, the next request reconnects
+            connections[alias].close()
+            target = sqlite3.connect(connections[alias].settings_dict["NAME"])
+            try:
+                # Online backup, consistent even while the primary takes writes
+                primary.connection.backup(target)
+            finally:
+                target.close()
+            self.stdout.write(self.style.SUCCESS(f"Copied {DEFAULT_DB_ALIAS} to {alias}"))
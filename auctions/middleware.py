@@ -0,0 +1,141 @@
+import json
+import logging
+import math
+import time
+from collections import Counter
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from django.http import HttpResponse
+from django.utils.functional import empty
+
+from . import ratelimit, routers
+
+
+logger = logging.getLogger("auctions.queries")
+
+
+class QueryRecorder:
+    def __init__(self):
+        self.queries = []
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.queries.append((sql, repr(params)))
+
+    @property
+    def count(self):
+        return len(self.queries)
+
+    @property
+    def duplicates(self):
+        # Same SQL with the same parameters, run more than once
+        return sum(n - 1 for n in Counter(self.queries).values())
+
+    @property
+    def similar(self):
+        # Same SQL with different parameters, a typical N+1 pattern
+        return sum(n - 1 for n in Counter(sql for sql, params in self.queries).values())
+
+    def most_repeated(self):
+        if not self.queries:
+            return None
+        sql, n = Counter(sql for sql, params in self.queries).most_common(1)[0]
+        return sql if n > 1 else None
+
+
+class QueryInstrumentationMiddleware:
+    # Records query count, DB time and repeated SQL for each request,
+    # reports them in a Server-Timing header and one structured log line.
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.warning_threshold = getattr(settings, "QUERY_COUNT_WARNING_THRESHOLD", 50)
+
+    def __call__(self, request):
+        recorder = QueryRecorder()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            response = self.get_response(request)
+
+        if self.shows_timing(request):
+            response["Server-Timing"] = (
+                f'db;dur={recorder.duration * 1000:.2f};'
+                f'desc="{recorder.count} queries, {recorder.duplicates} duplicate, {recorder.similar} similar"'
+            )
+
+        # Every request at DEBUG, only those over the threshold are shown by default
+        level = logging.WARNING if recorder.count > self.warning_threshold else logging.DEBUG
+        logger.log(level, json.dumps({
+            "method": request.method,
+            "path": request.path,
+            "status": response.status_code,
+            "queries": recorder.count,
+            "db_ms": round(recorder.duration * 1000, 2),
+            "duplicates": recorder.duplicates,
+            "similar": recorder.similar,
+            "most_repeated": recorder.most_repeated(),
+        }))
+        return response
+
+    def shows_timing(self, request):
+        if settings.DEBUG:
+            return True
+        # Only asks a user the request already loaded (login() sets a plain
+        # one), looking one up just for the header would add queries and
+        # Vary: Cookie to cached responses
+        user = getattr(request, "user", None)
+        return user is not None and getattr(user, "_wrapped", None) is not empty and user.is_staff
+
+
+class ReplicaRoutingMiddleware:
+    # Sends the reads of replica_reads views to a replica (see routers.py) and
+    # keeps a user who just wrote on the primary. Sessions are always read and
+    # saved on the primary, and saving one doesn't count as a write.
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        with routers.routing_state() as state:
+            response = self.get_response(request)
+
+        if state.wrote and routers.replica_aliases():
+            sticky = routers.sticky_seconds()
+            response.set_cookie(routers.STICKY_COOKIE, str(time.time() + sticky), max_age=sticky, httponly=True)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if (
+            request.method in ("GET", "HEAD")
+            and routers.reads_from_replica(view_func)
+            and not routers.is_sticky(request)
+        ):
+            routers.use_replica()
+
+
+class RateLimitMiddleware:
+    # Applies settings.RATE_LIMITS (see ratelimit.py) by URL name. Runs in
+    # process_view after AuthenticationMiddleware, so the URL is resolved and
+    # request.user available, but no view or password hash has run yet when
+    # a request is turned away.
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        retry_after = ratelimit.check(request, request.resolver_match.url_name, view_kwargs)
+        if retry_after is not None:
+            response = HttpResponse("Too many requests, try again later.", status=429, content_type="text/plain")
+            response["Retry-After"] = str(max(1, math.ceil(retry_after)))
+            return response
@@ -0,0 +1,40 @@
+# Generated by Django 3.2.7 on 2026-10-18 19:22
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_bid_stats(apps, schema_editor):
+    Listing = apps.get_model('auctions', 'Listing')
+    for listing in Listing.objects.all().iterator():
+        top_bid = listing.bids.order_by('-amount', 'date_added').first()
+        listing.bid_count = listing.bids.count()
+        listing.leading_bid = top_bid
+        listing.current_price = top_bid.amount if top_bid else listing.starting_bid
+        listing.save(update_fields=['bid_count', 'leading_bid', 'current_price'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auctions', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='listing',
+            name='bid_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='listing',
+            name='current_price',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddField(
+            model_name='listing',
+            name='leading_bid',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='auctions.bid'),
+        ),
+        migrations.RunPython(populate_bid_stats, migrations.RunPython.noop),
+    ]
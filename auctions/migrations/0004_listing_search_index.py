@@ -0,0 +1,48 @@
+from django.db import migrations
+
+
+# The index as it was when this migration was written, kept here rather than
+# imported from auctions.search so later changes there don't rewrite history
+
+PG_VECTOR_SQL = (
+    "setweight(to_tsvector('english', coalesce(title, '')), 'A') || "
+    "setweight(to_tsvector('english', coalesce(description, '')), 'B')"
+)
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        schema_editor.execute(
+            "CREATE VIRTUAL TABLE auctions_listing_fts USING fts5(title, description, tokenize='porter unicode61')"
+        )
+        schema_editor.execute(
+            "INSERT INTO auctions_listing_fts(rowid, title, description) "
+            "SELECT id, title, description FROM auctions_listing"
+        )
+    elif vendor == "postgresql":
+        schema_editor.execute("ALTER TABLE auctions_listing ADD COLUMN search_vector tsvector")
+        schema_editor.execute(
+            "CREATE INDEX auctions_listing_search_vector_idx ON auctions_listing USING GIN (search_vector)"
+        )
+        schema_editor.execute(f"UPDATE auctions_listing SET search_vector = {PG_VECTOR_SQL}")
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == "sqlite":
+        schema_editor.execute("DROP TABLE IF EXISTS auctions_listing_fts")
+    elif vendor == "postgresql":
+        schema_editor.execute("DROP INDEX IF EXISTS auctions_listing_search_vector_idx")
+        schema_editor.execute("ALTER TABLE auctions_listing DROP COLUMN IF EXISTS search_vector")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auctions', '0003_listing_version'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,25 @@
+from django.db import migrations, models
+from django.db.models.functions import Coalesce
+
+
+def populate_watcher_counts(apps, schema_editor):
+    Listing = apps.get_model('auctions', 'Listing')
+    watches = Listing.watchlisted_by.through.objects.filter(listing=models.OuterRef('pk'))
+    count = watches.order_by().values('listing').annotate(count=models.Count('pk')).values('count')
+    Listing.objects.update(watcher_count=Coalesce(models.Subquery(count), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auctions', '0007_listing_last_modified'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='listing',
+            name='watcher_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(populate_watcher_counts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,63 @@
+# Generated by Django 3.2.7 on 2026-10-18 20:15
+
+from django.db import migrations, models
+import django.db.models.deletion
+from django.db.models.functions import Coalesce
+
+
+def populate_user_stats(apps, schema_editor):
+    User = apps.get_model('auctions', 'User')
+    UserStats = apps.get_model('auctions', 'UserStats')
+    Listing = apps.get_model('auctions', 'Listing')
+    Bid = apps.get_model('auctions', 'Bid')
+    UserStats.objects.bulk_create(
+        [UserStats(user_id=pk) for pk in User.objects.values_list('pk', flat=True).iterator()],
+        batch_size=1000
+    )
+
+    def aggregate(queryset, field, value=models.Count('pk'), default=0):
+        rows = queryset.filter(**{field: models.OuterRef('pk')}).order_by().values(field)
+        return Coalesce(models.Subquery(rows.annotate(value=value).values('value')), default)
+
+    won = Listing.objects.filter(active=False)
+    UserStats.objects.update(
+        listing_count=aggregate(Listing.objects.all(), 'author'),
+        bid_count=aggregate(Bid.objects.all(), 'from_user'),
+        leading_count=aggregate(Listing.objects.filter(active=True), 'user_with_max_bid'),
+        won_count=aggregate(won, 'user_with_max_bid'),
+        total_spent=aggregate(won, 'user_with_max_bid', models.Sum('current_price'), default=0.0)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auctions', '0008_listing_watcher_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserStats',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='auctions.user')),
+                ('listing_count', models.PositiveIntegerField(default=0)),
+                ('bid_count', models.PositiveIntegerField(default=0)),
+                ('leading_count', models.PositiveIntegerField(default=0)),
+                ('won_count', models.PositiveIntegerField(default=0)),
+                ('total_spent', models.FloatField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='bid',
+            index=models.Index(fields=['from_user', '-date_added'], name='bid_user_history_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='listing',
+            index=models.Index(fields=['author', '-date_added', 'title'], name='listing_author_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='listing',
+            index=models.Index(fields=['user_with_max_bid', '-date_added', 'title'], name='listing_max_bidder_idx'),
+        ),
+        migrations.RunPython(populate_user_stats, migrations.RunPython.noop),
+    ]
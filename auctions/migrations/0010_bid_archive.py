@@ -0,0 +1,49 @@
+# Generated by Django 3.2.7 on 2026-10-18 20:18
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_closed_at(apps, schema_editor):
+    # The close time wasn't recorded so far, the last change is the closest guess
+    Listing = apps.get_model('auctions', 'Listing')
+    Listing.objects.filter(active=False).update(closed_at=models.F('last_modified'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auctions', '0009_user_stats'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BidArchive',
+            fields=[
+                ('listing', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='bid_archive', serialize=False, to='auctions.listing')),
+                ('bid_count', models.PositiveIntegerField()),
+                ('data', models.BinaryField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='listing',
+            name='bids_archived',
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name='listing',
+            name='closed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='userstats',
+            name='archived_bid_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='listing',
+            index=models.Index(condition=models.Q(('active', False), ('bids_archived', False)), fields=['closed_at'], name='listing_archivable_idx'),
+        ),
+        migrations.RunPython(populate_closed_at, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,67 @@
+# Generated by Django 3.2.7 on 2026-10-18 20:29
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_category_tree(apps, schema_editor):
+    # Existing categories become roots, then their stats are counted once
+    ListingCategory = apps.get_model('auctions', 'ListingCategory')
+    CategoryStats = apps.get_model('auctions', 'CategoryStats')
+    Listing = apps.get_model('auctions', 'Listing')
+    for pk in ListingCategory.objects.values_list('pk', flat=True):
+        ListingCategory.objects.filter(pk=pk).update(path=f'/{pk}/')
+    rows = (
+        Listing.objects.filter(active=True, category__isnull=False)
+        .order_by()
+        .values('category')
+        .annotate(n=models.Count('pk'), low=models.Min('current_price'), high=models.Max('current_price'))
+    )
+    stats = {row['category']: row for row in rows}
+    CategoryStats.objects.bulk_create([
+        CategoryStats(
+            category_id=pk,
+            active_count=stats.get(pk, {}).get('n', 0),
+            min_price=stats.get(pk, {}).get('low'),
+            max_price=stats.get(pk, {}).get('high')
+        )
+        for pk in ListingCategory.objects.values_list('pk', flat=True)
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auctions', '0010_bid_archive'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategoryStats',
+            fields=[
+                ('category', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stats', serialize=False, to='auctions.listingcategory')),
+                ('active_count', models.PositiveIntegerField(default=0)),
+                ('min_price', models.FloatField(blank=True, null=True)),
+                ('max_price', models.FloatField(blank=True, null=True)),
+            ],
+        ),
+        migrations.AlterModelOptions(
+            name='listingcategory',
+            options={'ordering': ['path']},
+        ),
+        migrations.AddField(
+            model_name='listingcategory',
+            name='parent',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='children', to='auctions.listingcategory'),
+        ),
+        migrations.AddField(
+            model_name='listingcategory',
+            name='path',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=255),
+        ),
+        migrations.AddIndex(
+            model_name='listing',
+            index=models.Index(condition=models.Q(('active', True)), fields=['category', 'current_price'], name='listing_category_price_idx'),
+        ),
+        migrations.RunPython(populate_category_tree, migrations.RunPython.noop),
+    ]
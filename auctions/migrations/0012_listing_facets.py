@@ -0,0 +1,67 @@
+# Generated by Django 3.2.7 on 2026-10-18 20:36
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_price_buckets(apps, schema_editor):
+    # PRICE_BUCKETS as of this migration
+    bounds = [10, 50, 100, 500, 1000]
+    Listing = apps.get_model('auctions', 'Listing')
+    CategoryPriceBucket = apps.get_model('auctions', 'CategoryPriceBucket')
+    bucket = models.Case(
+        *(models.When(current_price__lt=bound, then=models.Value(i)) for i, bound in enumerate(bounds)),
+        default=models.Value(len(bounds)),
+        output_field=models.PositiveSmallIntegerField()
+    )
+    counts = (
+        Listing.objects.filter(active=True)
+        .order_by()
+        .annotate(bucket=bucket)
+        .values('category', 'bucket')
+        .annotate(n=models.Count('pk'))
+    )
+    CategoryPriceBucket.objects.bulk_create([
+        CategoryPriceBucket(category_id=row['category'], bucket=row['bucket'], active_count=row['n'])
+        for row in counts
+    ])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auctions', '0011_category_tree'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CategoryPriceBucket',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('bucket', models.PositiveSmallIntegerField()),
+                ('active_count', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='listing',
+            index=models.Index(condition=models.Q(('active', True)), fields=['current_price'], name='listing_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='listing',
+            index=models.Index(condition=models.Q(('active', True)), fields=['-bid_count'], name='listing_bid_count_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='listing',
+            index=models.Index(condition=models.Q(('active', True)), fields=['category', '-bid_count'], name='listing_category_bid_count_idx'),
+        ),
+        migrations.AddField(
+            model_name='categorypricebucket',
+            name='category',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='price_buckets', to='auctions.listingcategory'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='categorypricebucket',
+            unique_together={('category', 'bucket')},
+        ),
+        migrations.RunPython(populate_price_buckets, migrations.RunPython.noop),
+    ]
@@ -1,6 +1,12 @@
+from bisect import bisect_right
+from collections import Counter
+
 from django.contrib.auth.models import AbstractUser
+from django.core.exceptions import ValidationError
 from django.db import models
+from django.db.models.functions import Coalesce, Concat, Greatest, Least, Substr
 from django.urls import reverse
+from django.utils import timezone
 from django.utils.text import slugify
 
 
@@ -32,6 +38,19 @@ class ListingCategory(models.Model):
         max_length=63,
         unique=True
     )
+    parent = models.ForeignKey(
+        "self",
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name="children"
+    )
+    # Materialized path of ancestor ids down to this category, "/1/5/12/".
+    # Descendants are the categories whose path starts with this one's.
+    path = models.CharField(max_length=255, blank=True, editable=False, db_index=True)
+
+    class Meta:
+        ordering = ['path']
 
     def __str__(self):
         return self.name
@@ -39,11 +58,68 @@ class ListingCategory(models.Model):
     def get_absolute_url(self):
         return reverse("category", kwargs={"slug": self.slug})
 
+    def ancestor_ids(self):
+        return [int(pk) for pk in self.path.strip("/").split("/") if pk]
+
+    @property
+    def depth(self):
+        return self.path.count("/") - 2
+
+    def descendants(self, include_self=True):
+        categories = ListingCategory.objects.filter(path__startswith=self.path)
+        return categories if include_self else categories.exclude(pk=self.pk)
+
+    @classmethod
+    def with_ancestors(cls, category_ids):
+        # The given categories and all categories above them
+        paths = cls.objects.filter(pk__in=[pk for pk in category_ids if pk]).values_list("path", flat=True)
+        ancestor_ids = {int(pk) for path in paths for pk in path.strip("/").split("/") if pk}
+        return cls.objects.filter(pk__in=ancestor_ids)
+
+    def clean(self):
+        if self.parent_id and self.pk and self.pk in self.parent.ancestor_ids():
+            raise ValidationError({"parent": "A category can't be moved below itself."})
+
     def save(self, *args, **kwargs):
         self.slug = slugify(self.name)
+        # Paths as stored, the ones in memory may predate a move further up
+        paths = dict(ListingCategory.objects.filter(pk__in=[self.pk, self.parent_id]).values_list("pk", "path"))
+        parent_path = paths.get(self.parent_id, "/")
+        if self.pk is None:
+            super(ListingCategory, self).save(*args, **kwargs)
+            self.path = f"{parent_path}{self.pk}/"
+            ListingCategory.objects.filter(pk=self.pk).update(path=self.path)
+            return
+
+        if f"/{self.pk}/" in parent_path:
+            raise ValueError("A category can't be moved below itself")
+        old_path, self.path = paths.get(self.pk), f"{parent_path}{self.pk}/"
+        if old_path and old_path != self.path:
+            # Move the subtree along, one UPDATE rewriting the path prefix
+            ListingCategory.objects.filter(path__startswith=old_path).exclude(pk=self.pk).update(
+                path=Concat(models.Value(self.path), Substr("path", len(old_path) + 1))
+            )
         super(ListingCategory, self).save(*args, **kwargs)
     
 
+class ListingQuerySet(models.QuerySet):
+    def with_related(self):
+        return self.select_related("author", "category", "user_with_max_bid")
+
+    def scheduled(self):
+        return self.filter(active=True, ends_at__isnull=False)
+
+    def due(self, now=None):
+        return self.scheduled().filter(ends_at__lte=now or timezone.now())
+
+    def with_watched(self, user):
+        # is_watched: whether the listing is on user's watchlist, without a query per listing
+        if not user.is_authenticated:
+            return self.annotate(is_watched=models.Value(False, output_field=models.BooleanField()))
+        watches = Listing.watchlisted_by.through.objects.filter(listing=models.OuterRef("pk"), user=user)
+        return self.annotate(is_watched=models.Exists(watches))
+
+
 class Listing(models.Model):
     author = models.ForeignKey(
         User,        
@@ -76,6 +152,34 @@ class Listing(models.Model):
         null=True      
     )
     active = models.BooleanField(default=True)
+    ends_at = models.DateTimeField(null=True, blank=True)
+    closed_at = models.DateTimeField(null=True, blank=True)
+    # Set once the bid history has been moved to BidArchive, only the leading bid stays in Bid
+    bids_archived = models.BooleanField(default=False)
+
+    BID_STAT_FIELDS = ("current_price", "bid_count", "leading_bid", "user_with_max_bid", "version", "bids_archived")
+
+    # Denormalized bid stats, kept in sync by record_bid() and refresh_bid_stats()
+    current_price = models.FloatField(default=0)
+    bid_count = models.PositiveIntegerField(default=0)
+    leading_bid = models.ForeignKey(
+        "Bid",
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name="+"
+    )
+    # Bumped on every accepted bid, used for compare-and-swap bid placement
+    version = models.PositiveIntegerField(default=0)
+    # Changes on edit, bid, comment and close, versions the template fragment cache
+    last_modified = models.DateTimeField(auto_now=True)
+
+    COUNTER_FIELDS = ("watcher_count",)
+
+    # Number of users watching the listing, kept in sync by refresh_watcher_counts()
+    watcher_count = models.PositiveIntegerField(default=0)
+
+    objects = ListingQuerySet.as_manager()
 
     def __str__(self):
         return f"{self.title} by {self.author}"
@@ -89,15 +193,152 @@ class Listing(models.Model):
     def get_close_url(self):
         return reverse("close_listing", kwargs={"id": self.pk})
     
+    def has_ended(self):
+        return self.ends_at is not None and self.ends_at <= timezone.now()
+
     def calculate_current_price(self):
-        return self.bids.aggregate(models.Max('amount'))["amount__max"] or self.starting_bid
+        return self.current_price
     
     def calculate_max_bid(self):
-        return self.bids.aggregate(models.Max('amount'))["amount__max"] or 0
+        return self.current_price if self.bid_count else 0
+
+    def save(self, *args, **kwargs):
+        if not self.active and self.closed_at is None:
+            self.closed_at = timezone.now()
+        if self._state.adding:
+            self.current_price = self.starting_bid
+            return super(Listing, self).save(*args, **kwargs)
+        if kwargs.get("update_fields") is None:
+            # Bid stats are owned by record_bid() and counters by their own updates,
+            # never overwrite them from a stale instance
+            kwargs["update_fields"] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in self.BID_STAT_FIELDS + self.COUNTER_FIELDS
+            ]
+        super(Listing, self).save(*args, **kwargs)
+        Listing.objects.filter(pk=self.pk, bid_count=0).update(current_price=self.starting_bid)
+
+    @classmethod
+    def touch(cls, pk):
+        cls.objects.filter(pk=pk).update(last_modified=timezone.now())
+
+    def record_bid(self, bid, expected_version=None):
+        # Must be called inside the transaction that created the bid.
+        # Returns False if expected_version is given and the row has moved on.
+        listings = Listing.objects.filter(pk=self.pk)
+        if expected_version is not None:
+            listings = listings.filter(version=expected_version)
+        updated = listings.update(
+            current_price=bid.amount,
+            bid_count=models.F("bid_count") + 1,
+            leading_bid=bid,
+            user_with_max_bid=bid.from_user,
+            version=models.F("version") + 1,
+            last_modified=timezone.now()
+        )
+        if not updated:
+            return False
+        self.current_price = bid.amount
+        self.bid_count += 1
+        self.leading_bid = bid
+        self.user_with_max_bid = bid.from_user
+        self.version += 1
+        return True
+
+    def refresh_bid_stats(self):
+        if self.bids_archived:
+            # The history is in BidArchive and the stats were final when it was archived
+            return
+        top_bid = self.bids.order_by("-amount", "date_added").first()
+        self.bid_count = self.bids.count()
+        self.leading_bid = top_bid
+        if top_bid:
+            self.current_price = top_bid.amount
+            self.user_with_max_bid = top_bid.from_user
+        else:
+            self.current_price = self.starting_bid
+            self.user_with_max_bid = None
+        Listing.objects.filter(pk=self.pk).update(
+            current_price=self.current_price,
+            bid_count=self.bid_count,
+            leading_bid=self.leading_bid,
+            user_with_max_bid=self.user_with_max_bid,
+            last_modified=timezone.now()
+        )
+
+    @classmethod
+    def refresh_watcher_counts(cls, ids=None):
+        # Recount from the M2M table in one UPDATE, exact however the rows changed.
+        # All listings when ids is None. The count is on the listing page, so
+        # it's a new version of the listing.
+        watches = Listing.watchlisted_by.through.objects.filter(listing=models.OuterRef("pk"))
+        count = watches.order_by().values("listing").annotate(count=models.Count("pk")).values("count")
+        listings = cls.objects.all() if ids is None else cls.objects.filter(pk__in=ids)
+        listings.update(
+            watcher_count=Coalesce(models.Subquery(count), 0),
+            last_modified=timezone.now()
+        )
 
     class Meta:    
         ordering = ['-date_added', 'title']
         get_latest_by = 'date_added'
+        indexes = [
+            # Active feed and category feed, in Meta.ordering order. Partial rather
+            # than (active, ...) composites: the planner can't use a composite
+            # for Django's bare "WHERE active" test on SQLite.
+            models.Index(
+                fields=['-date_added', 'title'],
+                name='listing_feed_idx',
+                condition=models.Q(active=True)
+            ),
+            models.Index(
+                fields=['category', '-date_added', 'title'],
+                name='listing_category_feed_idx',
+                condition=models.Q(active=True)
+            ),
+            # Lowest and highest price of a category, see CategoryStats.refresh_prices(),
+            # and the feed sorts and price filters of facets.py
+            models.Index(
+                fields=['category', 'current_price'],
+                name='listing_category_price_idx',
+                condition=models.Q(active=True)
+            ),
+            models.Index(
+                fields=['current_price'],
+                name='listing_price_idx',
+                condition=models.Q(active=True)
+            ),
+            models.Index(
+                fields=['-bid_count'],
+                name='listing_bid_count_idx',
+                condition=models.Q(active=True)
+            ),
+            models.Index(
+                fields=['category', '-bid_count'],
+                name='listing_category_bid_count_idx',
+                condition=models.Q(active=True)
+            ),
+            # Scheduler lookups for listings due to close, see close_due_listings()
+            models.Index(
+                fields=['ends_at'],
+                name='listing_scheduled_end_idx',
+                condition=models.Q(active=True, ends_at__isnull=False)
+            ),
+            # Sub-lists of the user page: created, leading and won listings
+            models.Index(fields=['author', '-date_added', 'title'], name='listing_author_idx'),
+            models.Index(fields=['user_with_max_bid', '-date_added', 'title'], name='listing_max_bidder_idx'),
+            # Closed listings whose bids are still to be archived, see archive.archive_bids()
+            models.Index(
+                fields=['closed_at'],
+                name='listing_archivable_idx',
+                condition=models.Q(active=False, bids_archived=False)
+            ),
+        ]
+
+
+class BidQuerySet(models.QuerySet):
+    def with_users(self):
+        return self.select_related("from_user")
 
 
 class Bid(models.Model):
@@ -114,12 +355,44 @@ class Bid(models.Model):
     amount = models.FloatField()
     date_added = models.DateTimeField(blank=True ,auto_now_add=True)
 
+    objects = BidQuerySet.as_manager()
+
     def __str__(self):
         return f"On {self.on_listing.title} from {self.from_user} [amount={self.amount}]"
     
     class Meta:    
         ordering = ['-date_added']
         get_latest_by = 'date_added'
+        indexes = [
+            # Bid history of a listing, and its highest bid
+            models.Index(fields=['on_listing', '-date_added'], name='bid_listing_history_idx'),
+            models.Index(fields=['on_listing', '-amount'], name='bid_listing_amount_idx'),
+            # Bids of a user, on the user page
+            models.Index(fields=['from_user', '-date_added'], name='bid_user_history_idx'),
+        ]
+
+
+class BidArchive(models.Model):
+    # The full bid history of a closed listing as one compressed segment,
+    # written by archive.archive_bids() and read by archive.ArchivedBids
+    listing = models.OneToOneField(
+        Listing,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="bid_archive"
+    )
+    bid_count = models.PositiveIntegerField()
+    # zlib compressed JSON lines of [pk, from_user_id, amount, date_added], newest first
+    data = models.BinaryField()
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.bid_count} archived bid(s) on listing {self.listing_id}"
+
+
+class CommentQuerySet(models.QuerySet):
+    def with_authors(self):
+        return self.select_related("author")
 
 
 class Comment(models.Model):
@@ -136,9 +409,297 @@ class Comment(models.Model):
     text = models.TextField()
     date_added = models.DateTimeField(auto_now_add=True)
 
+    objects = CommentQuerySet.as_manager()
+
     def __str__(self):
         return f"From {self.author} on {self.on_listing.title}"
     
     class Meta:    
         ordering = ['-date_added']
-        get_latest_by = 'date_added'
\ No newline at end of file
+        get_latest_by = 'date_added'
+        indexes = [
+            models.Index(fields=['on_listing', '-date_added'], name='comment_listing_history_idx'),
+        ]
+
+class UserStats(models.Model):
+    # Per-user totals for the profile page, kept in sync incrementally by the
+    # bid and close services. rebuild() recomputes them from scratch.
+    user = models.OneToOneField(
+        User,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="stats"
+    )
+    listing_count = models.PositiveIntegerField(default=0)
+    bid_count = models.PositiveIntegerField(default=0)
+    # Active listings the user is the highest bidder on
+    leading_count = models.PositiveIntegerField(default=0)
+    won_count = models.PositiveIntegerField(default=0)
+    total_spent = models.FloatField(default=0)
+    # Bids removed from Bid by archiving, still part of bid_count. Only
+    # archive_bids() writes it, rebuild() keeps it.
+    archived_bid_count = models.PositiveIntegerField(default=0)
+
+    COUNT_FIELDS = ("listing_count", "bid_count", "leading_count", "won_count", "archived_bid_count")
+
+    def __str__(self):
+        return f"Stats of {self.user}"
+
+    @property
+    def listed_bid_count(self):
+        # Bids still in Bid, those the profile's bids tab lists
+        return max(self.bid_count - self.archived_bid_count, 0)
+
+    @classmethod
+    def add(cls, user_id, create=True, **deltas):
+        # Apply increments (or decrements) in one UPDATE, creating the row on first use
+        values = {}
+        for name, delta in deltas.items():
+            value = models.F(name) + delta
+            if delta < 0 and name in cls.COUNT_FIELDS:
+                # Never fail a bid over a counter that drifted, rebuild() fixes it
+                value = Greatest(value, 0)
+            values[name] = value
+        if not cls.objects.filter(user_id=user_id).update(**values) and create:
+            cls.objects.get_or_create(user_id=user_id)
+            cls.objects.filter(user_id=user_id).update(**values)
+
+    @classmethod
+    def record_bid(cls, bid, previous_leader_id=None):
+        # Must be called inside the transaction that recorded the bid on its listing
+        if previous_leader_id != bid.from_user_id:
+            if previous_leader_id is not None:
+                cls.add(previous_leader_id, leading_count=-1)
+            cls.add(bid.from_user_id, bid_count=1, leading_count=1)
+        else:
+            cls.add(bid.from_user_id, bid_count=1)
+
+    @classmethod
+    def record_wins(cls, listing_ids):
+        # Move just closed listings from their winners' leading to won totals.
+        # Three queries however many winners: their ids, the missing stats
+        # rows, and one UPDATE summing each winner's listings in subqueries.
+        closed = Listing.objects.filter(pk__in=listing_ids, user_with_max_bid__isnull=False)
+        winner_ids = set(closed.values_list("user_with_max_bid", flat=True))
+        if not winner_ids:
+            return
+        cls.objects.bulk_create([cls(user_id=pk) for pk in winner_ids], ignore_conflicts=True)
+
+        def total(value):
+            won = closed.filter(user_with_max_bid=models.OuterRef("pk")).order_by().values("user_with_max_bid")
+            return models.Subquery(won.annotate(value=value).values("value"))
+
+        won = total(models.Count("pk"))
+        cls.objects.filter(user_id__in=winner_ids).update(
+            leading_count=Greatest(models.F("leading_count") - won, 0),
+            won_count=models.F("won_count") + won,
+            total_spent=models.F("total_spent") + total(models.Sum("current_price"))
+        )
+
+    @classmethod
+    def rebuild(cls, user_ids=None):
+        # Recompute from Listing and Bid with one INSERT and one UPDATE
+        users = User.objects.all() if user_ids is None else User.objects.filter(pk__in=user_ids)
+        cls.objects.bulk_create(
+            [cls(user_id=pk) for pk in users.values_list("pk", flat=True).iterator()],
+            batch_size=1000,
+            ignore_conflicts=True
+        )
+
+        def aggregate(queryset, field, value=models.Count("pk"), default=0):
+            rows = queryset.filter(**{field: models.OuterRef("pk")}).order_by().values(field)
+            return Coalesce(models.Subquery(rows.annotate(value=value).values("value")), default)
+
+        stats = cls.objects.all() if user_ids is None else cls.objects.filter(pk__in=user_ids)
+        won = Listing.objects.filter(active=False)
+        stats.update(
+            listing_count=aggregate(Listing.objects.all(), "author"),
+            bid_count=aggregate(Bid.objects.all(), "from_user") + models.F("archived_bid_count"),
+            leading_count=aggregate(Listing.objects.filter(active=True), "user_with_max_bid"),
+            won_count=aggregate(won, "user_with_max_bid"),
+            total_spent=aggregate(won, "user_with_max_bid", models.Sum("current_price"), default=0.0)
+        )
+
+
+class CategoryStats(models.Model):
+    # Active listings and their price range per category, own listings only.
+    # Kept in sync incrementally by signals.py and the services, totals over
+    # subcategories are summed from these rows by CategoryList.
+    category = models.OneToOneField(
+        ListingCategory,
+        on_delete=models.CASCADE,
+        primary_key=True,
+        related_name="stats"
+    )
+    active_count = models.PositiveIntegerField(default=0)
+    min_price = models.FloatField(null=True, blank=True)
+    max_price = models.FloatField(null=True, blank=True)
+
+    def __str__(self):
+        return f"Stats of {self.category}"
+
+    @classmethod
+    def _update(cls, category_id, **values):
+        if not cls.objects.filter(category_id=category_id).update(**values):
+            cls.objects.get_or_create(category_id=category_id)
+            cls.objects.filter(category_id=category_id).update(**values)
+
+    @classmethod
+    def listings_added(cls, category_id, count, min_price, max_price):
+        if category_id is None:
+            return
+        cls._update(
+            category_id,
+            active_count=models.F("active_count") + count,
+            min_price=Least(Coalesce("min_price", min_price), min_price),
+            max_price=Greatest(Coalesce("max_price", max_price), max_price)
+        )
+
+    @classmethod
+    def listings_removed(cls, category_id, count, min_price, max_price):
+        if category_id is None:
+            return
+        cls._update(category_id, active_count=Greatest(models.F("active_count") - count, 0))
+        # The range only needs a look at the listings if a bound left
+        cls.refresh_prices([category_id], min_price, max_price)
+
+    @classmethod
+    def listings_closed(cls, listing_ids):
+        # Must be called inside the transaction that closed the listings
+        closed = (
+            Listing.objects.filter(pk__in=listing_ids, category__isnull=False)
+            .order_by()
+            .values("category")
+            .annotate(n=models.Count("pk"), low=models.Min("current_price"), high=models.Max("current_price"))
+        )
+        for row in closed:
+            cls.listings_removed(row["category"], row["n"], row["low"], row["high"])
+
+    @classmethod
+    def price_changed(cls, category_id, old_price, new_price):
+        # Bids only raise prices: the max follows, the min moves if the cheapest listing got a bid
+        if category_id is None:
+            return
+        cls._update(category_id, max_price=Greatest(Coalesce("max_price", new_price), new_price))
+        cls.refresh_prices([category_id], old_price, None)
+
+    @classmethod
+    def refresh_prices(cls, category_ids, low=None, high=None):
+        # Recompute the range of categories whose min is >= low or max is <= high,
+        # all given categories without bounds. Two index seeks per category.
+        stats = cls.objects.filter(category_id__in=category_ids)
+        if low is not None or high is not None:
+            bounds = models.Q()
+            if low is not None:
+                bounds |= models.Q(min_price__gte=low)
+            if high is not None:
+                bounds |= models.Q(max_price__lte=high)
+            stats = stats.filter(bounds)
+        active = Listing.objects.filter(category=models.OuterRef("pk"), active=True).order_by()
+        stats.update(
+            min_price=models.Subquery(active.order_by("current_price").values("current_price")[:1]),
+            max_price=models.Subquery(active.order_by("-current_price").values("current_price")[:1])
+        )
+
+    @classmethod
+    def rebuild(cls, category_ids=None):
+        categories = ListingCategory.objects.all()
+        if category_ids is not None:
+            categories = categories.filter(pk__in=category_ids)
+        cls.objects.bulk_create(
+            [cls(category_id=pk) for pk in categories.values_list("pk", flat=True)],
+            ignore_conflicts=True
+        )
+        stats = cls.objects.all() if category_ids is None else cls.objects.filter(pk__in=category_ids)
+        active = Listing.objects.filter(category=models.OuterRef("pk"), active=True).order_by().values("category")
+        stats.update(active_count=Coalesce(models.Subquery(active.annotate(n=models.Count("pk")).values("n")), 0))
+        cls.refresh_prices(list(stats.values_list("pk", flat=True)))
+
+
+# Lower bounds of the price facet buckets, the last one is open ended.
+# CategoryPriceBucket rows are counted with these, run rebuild_category_stats
+# after changing them.
+PRICE_BUCKETS = [0, 10, 50, 100, 500, 1000]
+
+
+def price_bucket(price):
+    return bisect_right(PRICE_BUCKETS, price) - 1 if price >= 0 else 0
+
+
+def price_bucket_expression(field="current_price"):
+    # price_bucket() in SQL
+    return models.Case(
+        *(models.When(**{f"{field}__lt": bound}, then=models.Value(i)) for i, bound in enumerate(PRICE_BUCKETS[1:])),
+        default=models.Value(len(PRICE_BUCKETS) - 1),
+        output_field=models.PositiveSmallIntegerField()
+    )
+
+
+class CategoryPriceBucket(models.Model):
+    # Active listings per category and price bucket, the facet counts of the
+    # listing feeds (see facets.py). Listings without a category are counted
+    # under category NULL. Updated next to CategoryStats.
+    category = models.ForeignKey(
+        ListingCategory,
+        on_delete=models.CASCADE,
+        null=True,
+        blank=True,
+        related_name="price_buckets"
+    )
+    bucket = models.PositiveSmallIntegerField()
+    active_count = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        unique_together = [['category', 'bucket']]
+
+    def __str__(self):
+        return f"{self.category} from ${PRICE_BUCKETS[self.bucket]}: {self.active_count}"
+
+    @classmethod
+    def add(cls, category_id, prices, sign=1):
+        counts = Counter(price_bucket(price) for price in prices)
+        for bucket, count in counts.items():
+            rows = cls.objects.filter(category_id=category_id, bucket=bucket)
+            if sign < 0:
+                rows.update(active_count=Greatest(models.F("active_count") - count, 0))
+            elif not rows.update(active_count=models.F("active_count") + count):
+                cls.objects.create(category_id=category_id, bucket=bucket, active_count=count)
+
+    @classmethod
+    def price_changed(cls, category_id, old_price, new_price):
+        if price_bucket(old_price) != price_bucket(new_price):
+            cls.add(category_id, [old_price], sign=-1)
+            cls.add(category_id, [new_price])
+
+    @classmethod
+    def listings_closed(cls, listing_ids):
+        # Must be called inside the transaction that closed the listings
+        closed = (
+            Listing.objects.filter(pk__in=listing_ids)
+            .order_by()
+            .annotate(bucket=price_bucket_expression())
+            .values("category", "bucket")
+            .annotate(n=models.Count("pk"))
+        )
+        for row in closed:
+            cls.objects.filter(category_id=row["category"], bucket=row["bucket"]).update(
+                active_count=Greatest(models.F("active_count") - row["n"], 0)
+            )
+
+    @classmethod
+    def rebuild(cls, category_ids=None):
+        rows = cls.objects.all()
+        listings = Listing.objects.filter(active=True)
+        if category_ids is not None:
+            rows = rows.filter(category__in=category_ids)
+            listings = listings.filter(category__in=category_ids)
+        rows.delete()
+        counts = (
+            listings.order_by()
+            .annotate(bucket=price_bucket_expression())
+            .values("category", "bucket")
+            .annotate(n=models.Count("pk"))
+        )
+        cls.objects.bulk_create([
+            cls(category_id=row["category"], bucket=row["bucket"], active_count=row["n"]) for row in counts
+        ])
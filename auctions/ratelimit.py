@@ -0,0 +1,161 @@
+import math
+import threading
+import time
+from collections import Counter, OrderedDict
+from functools import lru_cache
+
+from django.conf import settings
+from django.core.cache import caches
+from django.utils.module_loading import import_string
+
+
+# Token bucket rate limits, checked by RateLimitMiddleware once the URL is
+# resolved and before the view runs. A rejected request costs no password
+# hash and no query beyond the session and user lookups of "user" rules.
+# Rules are listed per URL name in settings.RATE_LIMITS:
+#
+#   "listing": [{"scope": "user", "rate": "10/m", "burst": 5, "methods": ["POST"], "param": "makebid"}]
+#
+# scope: "ip" is the client address, "user" the logged in user (the address
+#   for anonymous requests, so made up session cookies don't get fresh
+#   buckets), "listing" the view's id argument, "post:<field>" the value of a
+#   POST field, such as the username of a login attempt.
+# rate: tokens refilled per second, minute or hour. burst: the bucket size,
+#   the rate's count by default.
+# methods, param: only requests with these methods or this POST field count.
+# name: tells two rules of a URL with the same scope apart in the counters.
+
+PERIODS = {"s": 1, "m": 60, "h": 3600}
+
+_stats = Counter()
+_stats_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def parse_rate(rate):
+    # "10/m" -> (10, 60)
+    count, _, period = rate.partition("/")
+    return int(count), PERIODS[period]
+
+
+class LocalBucketStore:
+    # Buckets in this process, the default. Each server process limits on its
+    # own, so the effective limit is the configured one times the processes.
+
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, updated), least recently used first
+        self._lock = threading.Lock()
+
+    def take(self, key, capacity, refill_rate, now=None):
+        # Take one token. Returns (allowed, seconds until a token is back).
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * refill_rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+        return allowed, 0 if allowed else (1 - tokens) / refill_rate
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+class CacheBucketStore:
+    # Buckets in a Django cache shared by all processes. Read and write aren't
+    # atomic, two processes racing on a bucket may let an extra request through.
+
+    def __init__(self, alias="default", prefix="ratelimit"):
+        self.alias = alias
+        self.prefix = prefix
+
+    def take(self, key, capacity, refill_rate, now=None):
+        now = time.time() if now is None else now
+        cache = caches[self.alias]
+        cache_key = f"{self.prefix}:{key}"
+        tokens, updated = cache.get(cache_key, (capacity, now))
+        tokens = min(capacity, tokens + (now - updated) * refill_rate)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        # Gone once it would be full again, a missing bucket is a full one
+        cache.set(cache_key, (tokens, now), math.ceil((capacity - tokens) / refill_rate) + 1)
+        return allowed, 0 if allowed else (1 - tokens) / refill_rate
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                backend = getattr(settings, "RATE_LIMIT_STORE", "auctions.ratelimit.LocalBucketStore")
+                options = getattr(settings, "RATE_LIMIT_STORE_OPTIONS", {})
+                _store = import_string(backend)(**options)
+    return _store
+
+
+def client_ip(request):
+    header = getattr(settings, "RATE_LIMIT_IP_HEADER", None)
+    if header and request.META.get(header):
+        # Behind a proxy, the first address is the client's
+        return request.META[header].split(",")[0].strip()
+    return request.META.get("REMOTE_ADDR", "")
+
+
+def bucket_key(request, scope, view_kwargs):
+    # None when the request has nothing to key this scope on
+    if scope == "ip":
+        return f"ip:{client_ip(request)}"
+    if scope == "user":
+        if request.user.is_authenticated:
+            return f"user:{request.user.pk}"
+        return f"ip:{client_ip(request)}"
+    if scope == "listing":
+        listing_id = view_kwargs.get("id")
+        return f"listing:{listing_id}" if listing_id is not None else None
+    if scope.startswith("post:"):
+        value = request.POST.get(scope[5:])
+        return f"{scope}:{value.lower()}" if value else None
+    raise ValueError(f"Unknown rate limit scope: {scope}")
+
+
+def check(request, url_name, view_kwargs):
+    # Seconds to wait if a rule of url_name rejects the request, None if all allow it
+    for rule in getattr(settings, "RATE_LIMITS", {}).get(url_name, ()):
+        if "methods" in rule and request.method not in rule["methods"]:
+            continue
+        if "param" in rule and rule["param"] not in request.POST:
+            continue
+        key = bucket_key(request, rule["scope"], view_kwargs)
+        if key is None:
+            continue
+        count, period = parse_rate(rule["rate"])
+        name = f"{url_name}:{rule.get('name', rule['scope'])}"
+        allowed, retry_after = get_store().take(f"{name}:{key}", rule.get("burst", count), count / period)
+        record(name, "allowed" if allowed else "rejected")
+        if not allowed:
+            return retry_after
+    return None
+
+
+def record(rule, outcome):
+    with _stats_lock:
+        _stats[rule, outcome] += 1
+
+
+def stats():
+    # {"listing:user": {"allowed": 12, "rejected": 3}, ...} since the process started
+    with _stats_lock:
+        counters = {}
+        for (rule, outcome), n in _stats.items():
+            counters.setdefault(rule, {"allowed": 0, "rejected": 0})[outcome] = n
+        return counters
@@ -0,0 +1,119 @@
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, connections
+
+
+# Read replicas. GET and HEAD requests to views marked with replica_reads
+# read from one of settings.REPLICA_DATABASES, everything else uses the
+# primary. A request that writes makes ReplicaRoutingMiddleware set a
+# cookie, and for REPLICA_STICKY_SECONDS that user reads from the primary
+# again, so they see their own bids and comments despite replication lag.
+# Sessions always live on the primary and saving one isn't a write here:
+# most GETs of logged in users store something in their session (see
+# watchlist.py), they would never read from a replica otherwise.
+
+STICKY_COOKIE = "primary_until"
+
+_state = ContextVar("replica_routing", default=None)
+
+
+class RoutingState:
+    def __init__(self):
+        self.replica = None  # Alias the reads of this request go to, None for the primary
+        self.wrote = False
+
+
+def replica_aliases():
+    return list(getattr(settings, "REPLICA_DATABASES", []))
+
+
+def sticky_seconds():
+    return getattr(settings, "REPLICA_STICKY_SECONDS", 10)
+
+
+def replica_reads(view):
+    # Mark a view function or class as safe to serve GET and HEAD from a replica
+    view.replica_reads = True
+    return view
+
+
+def reads_from_replica(view_func):
+    view_class = getattr(view_func, "view_class", None)
+    return getattr(view_func, "replica_reads", False) or getattr(view_class, "replica_reads", False)
+
+
+@contextmanager
+def routing_state():
+    token = _state.set(RoutingState())
+    try:
+        yield _state.get()
+    finally:
+        _state.reset(token)
+
+
+def use_replica():
+    # Send the remaining reads of the current request to a random replica
+    state = _state.get()
+    aliases = replica_aliases()
+    if state is None or not aliases:
+        return None
+    state.replica = random.choice(aliases)
+    check_connection(state.replica)
+    return state.replica
+
+
+def is_sticky(request):
+    try:
+        return float(request.COOKIES.get(STICKY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+def is_session(model):
+    return model._meta.label == "sessions.Session"
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        state = _state.get()
+        if state is not None and state.replica and not state.wrote and not is_session(model):
+            return state.replica
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        state = _state.get()
+        if state is not None and not is_session(model):
+            state.wrote = True
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same rows as the primary
+        databases = {DEFAULT_DB_ALIAS, *replica_aliases()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Replicas are copies of the migrated primary
+        return db not in replica_aliases()
+
+
+def check_connection(alias):
+    # Drop a persistent connection that went bad while idle, Django itself
+    # only notices errors raised during a request
+    connection = connections[alias]
+    if connection.connection is not None and not connection.is_usable():
+        connection.close()
+
+
+def check_connections():
+    # Before each request, the connections every request may use. A replica
+    # is checked by use_replica() when the request picks it.
+    replicas = set(replica_aliases())
+    for alias in connections:
+        if alias not in replicas:
+            check_connection(alias)
@@ -0,0 +1,166 @@
+import re
+
+from django.db import connection
+from django.db.models import Case, Q, Value, When
+
+from .models import Listing
+
+
+# Full-text index over Listing.title and Listing.description.
+# SQLite keeps a separate FTS5 table keyed by listing id, PostgreSQL a
+# weighted tsvector column on auctions_listing with a GIN index.
+# Both are created by migration 0004_listing_search_index. Other databases
+# have neither and fall back to a slower icontains search.
+
+FTS_TABLE = "auctions_listing_fts"
+SEARCH_CONFIG = "english"
+TITLE_WEIGHT = 10.0  # Relative weight of title matches over description matches
+INDEXED_VENDORS = ("sqlite", "postgresql")
+
+
+def _pg_vector_sql():
+    return (
+        f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(title, '')), 'A') || "
+        f"setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(description, '')), 'B')"
+    )
+
+
+def index_listing(listing):
+    index_listings([listing])
+
+
+def index_listings(listings):
+    with connection.cursor() as cursor:
+        if connection.vendor == "sqlite":
+            for start in range(0, len(listings), 500):
+                batch = listings[start:start + 500]
+                cursor.execute(
+                    f"DELETE FROM {FTS_TABLE} WHERE rowid IN ({', '.join(['%s'] * len(batch))})",
+                    [listing.pk for listing in batch]
+                )
+            cursor.executemany(
+                f"INSERT INTO {FTS_TABLE}(rowid, title, description) VALUES (%s, %s, %s)",
+                [(listing.pk, listing.title, listing.description) for listing in listings]
+            )
+        elif connection.vendor == "postgresql":
+            cursor.execute(
+                f"UPDATE auctions_listing SET search_vector = {_pg_vector_sql()} WHERE id = ANY(%s)",
+                [[listing.pk for listing in listings]]
+            )
+
+
+def unindex_listing(listing_id):
+    if connection.vendor == "sqlite":
+        with connection.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [listing_id])
+
+
+def _fts5_query(text):
+    # Quote every word so user input can never be parsed as FTS5 syntax,
+    # the last word is matched as a prefix for search-as-you-type
+    words = re.findall(r"\w+", text)
+    if not words:
+        return None
+    terms = [f'"{word}"' for word in words]
+    terms[-1] += "*"
+    return " ".join(terms)
+
+
+class SearchResults:
+    # Ranked, lazily sliced search results usable with Django's Paginator
+
+    def __init__(self, text, category=None, active=True):
+        self.text = text
+        self.category = category
+        self.active = active
+        self._count = None
+
+    def _filters(self):
+        conditions, params = [], []
+        if self.category is not None:
+            # The category and its subcategories, see ListingCategory.path
+            conditions.append("l.category_id IN (SELECT id FROM auctions_listingcategory WHERE path LIKE %s)")
+            params.append(self.category.path + "%")
+        if self.active is not None:
+            conditions.append("l.active = %s")
+            params.append(self.active)
+        return "".join(f" AND {condition}" for condition in conditions), params
+
+    def _sql(self, select, ordered):
+        filters, filter_params = self._filters()
+        if connection.vendor == "sqlite":
+            query = _fts5_query(self.text)
+            if query is None:
+                return None, None
+            sql = (
+                f"SELECT {select} FROM {FTS_TABLE} JOIN auctions_listing l ON l.id = {FTS_TABLE}.rowid "
+                f"WHERE {FTS_TABLE} MATCH %s{filters}"
+            )
+            if ordered:
+                sql += f" ORDER BY bm25({FTS_TABLE}, {TITLE_WEIGHT}, 1.0), l.id"
+            return sql, [query] + filter_params
+        if connection.vendor == "postgresql":
+            sql = (
+                f"SELECT {select} FROM auctions_listing l "
+                f"WHERE l.search_vector @@ websearch_to_tsquery('{SEARCH_CONFIG}', %s){filters}"
+            )
+            params = [self.text] + filter_params
+            if ordered:
+                sql += (
+                    f" ORDER BY ts_rank(l.search_vector, websearch_to_tsquery('{SEARCH_CONFIG}', %s)) DESC, l.id"
+                )
+                params.append(self.text)
+            return sql, params
+
+    def _fallback(self):
+        # Listings with every word in the title or description, those with all
+        # of them in the title first. Scans the table, no index to rank with.
+        words = re.findall(r"\w+", self.text)
+        if not words:
+            return Listing.objects.none()
+        listings = Listing.objects.with_related()
+        in_title = Q()
+        for word in words:
+            listings = listings.filter(Q(title__icontains=word) | Q(description__icontains=word))
+            in_title &= Q(title__icontains=word)
+        if self.category is not None:
+            listings = listings.filter(category__path__startswith=self.category.path)
+        if self.active is not None:
+            listings = listings.filter(active=self.active)
+        return listings.annotate(
+            title_match=Case(When(in_title, then=Value(0)), default=Value(1))
+        ).order_by("title_match", "id")
+
+    def count(self):
+        if self._count is None and connection.vendor not in INDEXED_VENDORS:
+            self._count = self._fallback().count()
+        elif self._count is None:
+            sql, params = self._sql("COUNT(*)", ordered=False)
+            if sql is None:
+                self._count = 0
+            else:
+                with connection.cursor() as cursor:
+                    cursor.execute(sql, params)
+                    self._count = cursor.fetchone()[0]
+        return self._count
+
+    def __len__(self):
+        return self.count()
+
+    def __getitem__(self, k):
+        if not isinstance(k, slice):
+            return self[k:k + 1][0]
+        if connection.vendor not in INDEXED_VENDORS:
+            return list(self._fallback()[k])
+        start = k.start or 0
+        stop = k.stop if k.stop is not None else self.count()
+        sql, params = self._sql("l.id", ordered=True)
+        if sql is None or stop <= start:
+            return []
+        sql += " LIMIT %s OFFSET %s"
+        params += [stop - start, start]
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            ids = [row[0] for row in cursor.fetchall()]
+        listings = Listing.objects.with_related().in_bulk(ids)
+        return [listings[pk] for pk in ids if pk in listings]
@@ -0,0 +1,148 @@
+import random
+import time
+
+from django.db import OperationalError, connection, transaction
+from django.db.models import F, OuterRef, Subquery
+from django.utils import timezone
+
+from . import cache
+from .models import Bid, CategoryPriceBucket, CategoryStats, Listing, ListingCategory, UserStats
+from .sqlite import serialized_writes
+from .streaming import publish_listing_event
+
+
+# How many times an optimistic bid is retried after losing a race
+MAX_BID_ATTEMPTS = 5
+# Upper bound of the random pause before a retry, in seconds, grows with each attempt
+BID_RETRY_BACKOFF = 0.005
+
+
+class BidRejected(Exception):
+    pass
+
+
+class BidTooLow(BidRejected):
+    pass
+
+
+class ListingClosed(BidRejected):
+    pass
+
+
+class BidConflict(BidRejected):
+    pass
+
+
+class _StaleListing(Exception):
+    pass
+
+
+def place_bid(listing, user, amount):
+    # Atomically check a bid against the current price and record it.
+    # Backends that support SELECT ... FOR UPDATE lock the listing row,
+    # others (SQLite) fall back to a compare-and-swap on Listing.version.
+    if connection.features.has_select_for_update:
+        return _place_bid_locked(listing.pk, user, amount)
+    return _place_bid_optimistic(listing.pk, user, amount)
+
+
+def _check_bid(listing, amount):
+    if not listing.active or listing.has_ended():
+        raise ListingClosed
+    if (amount <= listing.calculate_max_bid()) or (amount < listing.starting_bid):
+        raise BidTooLow
+
+
+def _place_bid_locked(listing_id, user, amount):
+    with transaction.atomic():
+        listing = Listing.objects.select_for_update().get(pk=listing_id)
+        _check_bid(listing, amount)
+        previous_leader_id, previous_price = listing.user_with_max_bid_id, listing.current_price
+        bid = Bid.objects.create(from_user=user, on_listing=listing, amount=amount)
+        listing.record_bid(bid)
+        UserStats.record_bid(bid, previous_leader_id)
+        CategoryStats.price_changed(listing.category_id, previous_price, amount)
+        CategoryPriceBucket.price_changed(listing.category_id, previous_price, amount)
+    return bid
+
+
+def _place_bid_optimistic(listing_id, user, amount):
+    for attempt in range(MAX_BID_ATTEMPTS):
+        try:
+            with serialized_writes(), transaction.atomic():
+                listing = Listing.objects.get(pk=listing_id)
+                _check_bid(listing, amount)
+                previous_leader_id, previous_price = listing.user_with_max_bid_id, listing.current_price
+                bid = Bid.objects.create(from_user=user, on_listing=listing, amount=amount)
+                if not listing.record_bid(bid, expected_version=listing.version):
+                    raise _StaleListing
+                UserStats.record_bid(bid, previous_leader_id)
+                CategoryStats.price_changed(listing.category_id, previous_price, amount)
+                CategoryPriceBucket.price_changed(listing.category_id, previous_price, amount)
+        except _StaleListing:
+            pass
+        except OperationalError as e:
+            # SQLite reports write contention as "database (table) is locked"
+            if "locked" not in str(e):
+                raise
+        else:
+            return bid
+        time.sleep(random.uniform(0, BID_RETRY_BACKOFF * (attempt + 1)))
+    raise BidConflict
+
+
+def close_due_listings(now=None, batch_size=500):
+    # Close up to batch_size listings whose end time has passed, in one UPDATE.
+    # The winner is taken from the top bid, and the version bump makes any
+    # compare-and-swap bid that raced with the close fail.
+    now = now or timezone.now()
+    with serialized_writes(), transaction.atomic():
+        due = Listing.objects.due(now).order_by("ends_at")
+        if connection.features.has_select_for_update:
+            due = due.select_for_update(skip_locked=connection.features.has_select_for_update_skip_locked)
+        ids = list(due.values_list("pk", flat=True)[:batch_size])
+        if not ids:
+            return []
+        top_bidder = Bid.objects.filter(on_listing=OuterRef("pk")).order_by("-amount", "date_added")
+        Listing.objects.filter(pk__in=ids, active=True).update(
+            active=False,
+            user_with_max_bid=Subquery(top_bidder.values("from_user")[:1]),
+            version=F("version") + 1,
+            closed_at=now,
+            last_modified=now
+        )
+        UserStats.record_wins(ids)
+        CategoryStats.listings_closed(ids)
+        CategoryPriceBucket.listings_closed(ids)
+        category_ids = Listing.objects.filter(pk__in=ids).values_list("category_id", flat=True).distinct()
+        category_slugs = ListingCategory.with_ancestors(category_ids).values_list("slug", flat=True)
+        generations = [cache.FEED, cache.CATEGORIES] + [cache.category_generation(slug) for slug in category_slugs]
+        transaction.on_commit(lambda: cache.bump(*generations))
+        for listing_id in ids:
+            transaction.on_commit(lambda listing_id=listing_id: publish_listing_event(listing_id, "close"))
+    return ids
+
+
+def close_listing(listing):
+    # Close a listing by hand. Returns False if it was already closed.
+    # Like close_due_listings() the version bump fails a racing optimistic bid.
+    with serialized_writes(), transaction.atomic():
+        now = timezone.now()
+        closed = Listing.objects.filter(pk=listing.pk, active=True).update(
+            active=False,
+            version=F("version") + 1,
+            closed_at=now
+        )
+        if not closed:
+            return False
+        listing.active = False
+        listing.closed_at = now
+        listing.save()
+        UserStats.record_wins([listing.pk])
+        CategoryStats.listings_closed([listing.pk])
+        CategoryPriceBucket.listings_closed([listing.pk])
+    return True
+
+
+def next_deadline():
+    return Listing.objects.scheduled().order_by("ends_at").values_list("ends_at", flat=True).first()
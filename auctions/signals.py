@@ -0,0 +1,240 @@
+from django.core.signals import request_started
+from django.db import transaction
+from django.db.backends.signals import connection_created
+from django.db.models import Q
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_save
+from django.utils import timezone
+from django.dispatch import receiver
+
+from . import cache, routers, search, sqlite
+from .streaming import publish_listing_event
+from .models import Bid, CategoryPriceBucket, CategoryStats, Comment, Listing, ListingCategory, User, UserStats
+from .watchlist import watchlist_generation
+
+
+@receiver(post_save, sender=Listing)
+def update_search_index(sender, instance, created, update_fields=None, **kwargs):
+    if update_fields is not None and not {"title", "description"} & set(update_fields):
+        return
+    search.index_listing(instance)
+
+
+@receiver(post_delete, sender=Listing)
+def remove_from_search_index(sender, instance, **kwargs):
+    search.unindex_listing(instance.pk)
+
+
+def bump_on_commit(*names):
+    transaction.on_commit(lambda: cache.bump(*names))
+
+
+def category_generations(*category_ids):
+    # A category page lists its subcategories' listings too, so ancestors change with it
+    slugs = ListingCategory.with_ancestors(category_ids).values_list("slug", flat=True)
+    return [cache.category_generation(slug) for slug in slugs]
+
+
+@receiver(pre_save, sender=Listing)
+def remember_listing_category(sender, instance, **kwargs):
+    # (category_id, active, current_price) as stored, None for a new listing
+    instance._previous_state = None
+    if instance.pk:
+        instance._previous_state = (
+            Listing.objects.filter(pk=instance.pk).values_list("category_id", "active", "current_price").first()
+        )
+    instance._previous_category_id = instance._previous_state[0] if instance._previous_state else None
+
+
+@receiver(post_save, sender=Listing)
+def update_category_stats(sender, instance, created, raw=False, **kwargs):
+    # Bids and the close services update CategoryStats themselves, with UPDATEs
+    # that don't go through save(). This covers creation, edits and reopening.
+    if raw:
+        return
+    previous = getattr(instance, "_previous_state", None)
+    if created or previous is None:
+        if instance.active:
+            CategoryStats.listings_added(instance.category_id, 1, instance.current_price, instance.current_price)
+            CategoryPriceBucket.add(instance.category_id, [instance.current_price])
+        return
+    category_id, active, price = previous
+    if (category_id, active) == (instance.category_id, instance.active):
+        return
+    # save() never writes the price, the stored one is current
+    if active:
+        CategoryStats.listings_removed(category_id, 1, price, price)
+        CategoryPriceBucket.add(category_id, [price], sign=-1)
+    if instance.active:
+        CategoryStats.listings_added(instance.category_id, 1, price, price)
+        CategoryPriceBucket.add(instance.category_id, [price])
+
+
+@receiver(post_delete, sender=Listing)
+def uncount_deleted_category_listing(sender, instance, **kwargs):
+    if instance.active:
+        CategoryStats.listings_removed(
+            instance.category_id, 1, instance.current_price, instance.current_price
+        )
+        CategoryPriceBucket.add(instance.category_id, [instance.current_price], sign=-1)
+
+
+@receiver(post_save, sender=Listing)
+@receiver(post_delete, sender=Listing)
+def invalidate_listing_feeds(sender, instance, **kwargs):
+    category_ids = {instance.category_id, getattr(instance, "_previous_category_id", None)}
+    bump_on_commit(cache.FEED, cache.CATEGORIES, *category_generations(*category_ids))
+
+
+@receiver(post_save, sender=Bid)
+@receiver(post_delete, sender=Bid)
+def invalidate_bid_feeds(sender, instance, **kwargs):
+    category_id = Listing.objects.filter(pk=instance.on_listing_id).values_list("category_id", flat=True).first()
+    # The category list shows price ranges, which bids move
+    bump_on_commit(cache.FEED, cache.CATEGORIES, *category_generations(category_id))
+
+
+@receiver(post_save, sender=Comment)
+@receiver(post_delete, sender=Comment)
+def touch_commented_listing(sender, instance, **kwargs):
+    # Moves the listing's fragment cache version past the cached comment list
+    Listing.touch(instance.on_listing_id)
+
+
+# What the cached listing fragments show of a user: get_name() and the profile URL
+USER_NAME_FIELDS = ("username", "first_name", "last_name")
+
+
+@receiver(pre_save, sender=User)
+def remember_user_name(sender, instance, update_fields=None, **kwargs):
+    # Skips the query for saves that can't rename, like the last_login update on login
+    instance._previous_name = None
+    if instance.pk and (update_fields is None or set(USER_NAME_FIELDS) & set(update_fields)):
+        instance._previous_name = User.objects.filter(pk=instance.pk).values_list(*USER_NAME_FIELDS).first()
+
+
+@receiver(post_save, sender=User)
+def touch_listings_naming_user(sender, instance, created, raw=False, **kwargs):
+    # The fragment cache (and conditional GET) versions of the listings that
+    # show the user as author, bidder or commenter move past the old name.
+    # Archived bid history is rendered from BidArchive on request, uncached.
+    previous = getattr(instance, "_previous_name", None)
+    if raw or previous is None or previous == tuple(getattr(instance, name) for name in USER_NAME_FIELDS):
+        return
+    Listing.objects.filter(
+        Q(author=instance) | Q(bids__from_user=instance) | Q(comments__author=instance)
+    ).update(last_modified=timezone.now())
+
+
+@receiver(post_save, sender=User)
+def create_user_stats(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        UserStats.objects.get_or_create(user=instance)
+
+
+@receiver(post_save, sender=Listing)
+def count_created_listing(sender, instance, created, **kwargs):
+    if created:
+        UserStats.add(instance.author_id, listing_count=1)
+
+
+@receiver(post_delete, sender=Listing)
+def uncount_deleted_listing(sender, instance, **kwargs):
+    # create=False: the author may be the one being deleted. Bids on the
+    # listing are left counted, rebuild_user_stats recounts them.
+    UserStats.add(instance.author_id, create=False, listing_count=-1)
+    if instance.user_with_max_bid_id is None:
+        return
+    if instance.active:
+        UserStats.add(instance.user_with_max_bid_id, create=False, leading_count=-1)
+    else:
+        UserStats.add(
+            instance.user_with_max_bid_id,
+            create=False,
+            won_count=-1,
+            total_spent=-instance.current_price
+        )
+
+
+@receiver(pre_save, sender=ListingCategory)
+def remember_category_slug(sender, instance, **kwargs):
+    instance._previous_slug = instance._previous_path = instance._previous_name = None
+    if instance.pk:
+        instance._previous_slug, instance._previous_path, instance._previous_name = (
+            ListingCategory.objects.filter(pk=instance.pk).values_list("slug", "path", "name").first()
+            or (None, None, None)
+        )
+
+
+@receiver(post_save, sender=ListingCategory)
+def touch_listings_naming_category(sender, instance, created, raw=False, **kwargs):
+    # Cached listing fragments link the category by name and slug
+    if raw or created:
+        return
+    if (instance._previous_name, instance._previous_slug) != (instance.name, instance.slug):
+        Listing.objects.filter(category=instance).update(last_modified=timezone.now())
+
+
+@receiver(post_save, sender=ListingCategory)
+def create_category_stats(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        CategoryStats.objects.get_or_create(category=instance)
+
+
+@receiver(post_save, sender=ListingCategory)
+@receiver(post_delete, sender=ListingCategory)
+def invalidate_category_feeds(sender, instance, **kwargs):
+    slugs = {instance.slug, getattr(instance, "_previous_slug", None)} - {None}
+    generations = [cache.category_generation(slug) for slug in slugs]
+    # The ancestors gain or lose the listings of the category's subtree
+    previous_path = getattr(instance, "_previous_path", None)
+    if previous_path and previous_path != instance.path:
+        moved = ListingCategory.objects.filter(path__startswith=instance.path).values_list("pk", flat=True)
+        generations += category_generations(*previous_path.strip("/").split("/"), instance.parent_id, *moved)
+    elif kwargs.get("signal") is post_delete:
+        generations += category_generations(instance.parent_id)
+    bump_on_commit(cache.CATEGORIES, *generations)
+
+
+@receiver(post_save, sender=Bid)
+def stream_bid(sender, instance, created, **kwargs):
+    if created:
+        transaction.on_commit(lambda: publish_listing_event(instance.on_listing_id, "bid"))
+
+
+@receiver(post_save, sender=Listing)
+def stream_listing_change(sender, instance, created, **kwargs):
+    if not created:
+        event = "price" if instance.active else "close"
+        transaction.on_commit(lambda: publish_listing_event(instance.pk, event))
+
+
+@receiver(m2m_changed, sender=Listing.watchlisted_by.through)
+def update_watchlists(sender, instance, action, reverse, pk_set, **kwargs):
+    # Forward: listing.watchlisted_by, pk_set holds user ids. Reverse: user.watchlist_listings.
+    if action == "pre_clear":
+        # Remember who is about to be removed, the rows are gone by post_clear
+        related = Listing.watchlisted_by.through.objects.filter(
+            **{"user" if reverse else "listing": instance.pk}
+        ).values_list("listing_id" if reverse else "user_id", flat=True)
+        instance._cleared_watch_ids = set(related)
+        return
+    if action == "post_clear":
+        pk_set = getattr(instance, "_cleared_watch_ids", set())
+    elif action not in ("post_add", "post_remove"):
+        return
+    if not pk_set:
+        return
+
+    listing_ids, user_ids = (pk_set, {instance.pk}) if reverse else ({instance.pk}, pk_set)
+    Listing.refresh_watcher_counts(listing_ids)
+    bump_on_commit(*(watchlist_generation(user_id) for user_id in user_ids))
+
+
+@receiver(request_started)
+def check_connections(sender, **kwargs):
+    routers.check_connections()
+
+
+@receiver(connection_created)
+def configure_sqlite(sender, connection, **kwargs):
+    sqlite.configure_connection(connection)
@@ -0,0 +1,64 @@
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, OperationalError, connections
+
+
+# SQLite profiles, picked with settings.SQLITE_PROFILE. The pragmas are run on
+# every new connection. "production" switches to WAL, where readers never wait
+# for the writer, and serializes this process's writes in serialized_writes(),
+# so concurrent bids and comments queue up instead of failing with
+# "database is locked". Writers in other processes still wait on busy_timeout.
+
+PROFILES = {
+    "default": {
+        "pragmas": {},
+        "serialize_writes": False,
+    },
+    "production": {
+        "pragmas": {
+            "journal_mode": "wal",
+            # Durable at checkpoints rather than at every commit, safe with WAL
+            "synchronous": "normal",
+            "busy_timeout": 5000,  # ms
+            "cache_size": -65536,  # KiB, 64 MiB per connection
+            "mmap_size": 268435456,  # bytes, 256 MiB
+            "temp_store": "memory",
+        },
+        "serialize_writes": True,
+    },
+}
+
+_write_lock = threading.RLock()
+
+
+def get_profile():
+    profile = dict(PROFILES[getattr(settings, "SQLITE_PROFILE", "default")])
+    profile["pragmas"] = {**profile["pragmas"], **getattr(settings, "SQLITE_PRAGMAS", {})}
+    return profile
+
+
+def configure_connection(connection):
+    if connection.vendor != "sqlite":
+        return
+    with connection.cursor() as cursor:
+        for name, value in get_profile()["pragmas"].items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+
+
+@contextmanager
+def serialized_writes(using=DEFAULT_DB_ALIAS):
+    # Hold around a write transaction. Queues this process's SQLite writers
+    # one after another, a no-op for other databases and profiles.
+    if connections[using].vendor != "sqlite" or not get_profile()["serialize_writes"]:
+        yield
+        return
+    timeout = getattr(settings, "SQLITE_WRITE_QUEUE_TIMEOUT", 10)
+    if not _write_lock.acquire(timeout=timeout):
+        # Same message as SQLite's, callers already retry on it
+        raise OperationalError("database is locked (write queue timeout)")
+    try:
+        yield
+    finally:
+        _write_lock.release()
@@ -0,0 +1,152 @@
+import asyncio
+import json
+from datetime import datetime
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.urls import Resolver404, resolve
+from django.utils import timezone
+
+from .models import Listing
+from .pubsub import get_broker, listing_channel
+
+
+# Server-Sent Events for listing pages. EventStreamRouter sits in front of
+# the Django ASGI application (commerce/asgi.py) and serves the
+# "listing_events" URL itself, every other request goes to Django.
+#
+# Events are published to the broker of the process that made the change.
+# The close_auctions worker runs in a process of its own, so its close
+# events never reach the streams. Instead a stream whose listing is past its
+# end time re-reads the listing when it wakes up (at the end time, then at
+# every heartbeat) until it sees it closed.
+
+EVENTS_URL_NAME = "listing_events"
+CLOSE_CHECK_DELAY = 1  # Seconds after the end time, time for close_auctions to get to it
+
+
+def listing_state(listing):
+    return {
+        "listing": listing.pk,
+        "price": listing.current_price,
+        "bid_count": listing.bid_count,
+        "active": listing.active,
+        "winner": listing.user_with_max_bid.username if listing.user_with_max_bid else None,
+        "ends_at": listing.ends_at.isoformat() if listing.ends_at else None,
+    }
+
+
+def format_event(event, data, retry=None):
+    message = ""
+    if retry is not None:
+        message += f"retry: {retry}\n"
+    return message + f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def publish_listing_event(listing_id, event):
+    # Call after commit. Only reads the listing when somebody is listening.
+    broker = get_broker()
+    channel = listing_channel(listing_id)
+    if not broker.subscriber_count(channel):
+        return
+    listing = Listing.objects.select_related("user_with_max_bid").filter(pk=listing_id).first()
+    if listing is not None:
+        broker.publish(channel, (event, listing_state(listing)))
+
+
+@sync_to_async
+def get_listing_state(listing_id):
+    try:
+        listing = Listing.objects.select_related("user_with_max_bid").filter(pk=listing_id).first()
+        if listing is None:
+            return None
+        return listing_state(listing)
+    finally:
+        close_old_connections()
+
+
+async def listing_events(scope, receive, send, listing_id):
+    # Subscribe before reading the state, so no bid can slip in between
+    subscription = get_broker().subscribe(listing_channel(listing_id))
+    disconnected = asyncio.ensure_future(wait_for_disconnect(receive))
+    try:
+        state = await get_listing_state(listing_id)
+        if state is None:
+            await send({"type": "http.response.start", "status": 404, "headers": [(b"content-type", b"text/plain")]})
+            await send({"type": "http.response.body", "body": b"Not Found"})
+            return
+
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", b"text/event-stream"),
+                (b"cache-control", b"no-cache"),
+                (b"x-accel-buffering", b"no"),
+            ],
+        })
+        if not state["active"]:
+            await send({"type": "http.response.body", "body": format_event("close", state).encode()})
+            return
+        await send({"type": "http.response.body", "body": format_event("price", state).encode(), "more_body": True})
+
+        heartbeat = getattr(settings, "EVENT_STREAM_HEARTBEAT", 15)
+        ends_at = datetime.fromisoformat(state["ends_at"]) if state["ends_at"] else None
+        while not disconnected.done():
+            timeout = heartbeat
+            if ends_at is not None and ends_at > timezone.now():
+                timeout = min(heartbeat, (ends_at - timezone.now()).total_seconds() + CLOSE_CHECK_DELAY)
+            next_message = asyncio.ensure_future(subscription.get())
+            done, pending = await asyncio.wait(
+                {next_message, disconnected},
+                timeout=timeout,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            if next_message not in done:
+                next_message.cancel()
+                if disconnected.done():
+                    continue
+                if ends_at is not None and ends_at <= timezone.now():
+                    # Closed by close_auctions, whose events don't reach this process
+                    state = await get_listing_state(listing_id)
+                    if state is None or not state["active"]:
+                        await send({"type": "http.response.body", "body": format_event("close", state).encode()})
+                        break
+                # Comment line, keeps proxies from closing an idle connection
+                await send({"type": "http.response.body", "body": b": ping\n\n", "more_body": True})
+                continue
+            event, data = next_message.result()
+            closing = event == "close"
+            await send({
+                "type": "http.response.body",
+                "body": format_event(event, data).encode(),
+                "more_body": not closing,
+            })
+            if closing:
+                break
+    finally:
+        subscription.close()
+        disconnected.cancel()
+
+
+async def wait_for_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+class EventStreamRouter:
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "http" and scope["method"] == "GET":
+            try:
+                match = resolve(scope["path"])
+            except Resolver404:
+                match = None
+            if match is not None and match.url_name == EVENTS_URL_NAME:
+                return await listing_events(scope, receive, send, match.kwargs["id"])
+        return await self.application(scope, receive, send)
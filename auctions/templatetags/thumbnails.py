@@ -0,0 +1,11 @@
+from django import template
+
+from auctions.images import thumbnail_url
+
+register = template.Library()
+
+
+@register.filter
+def thumbnail(url, size):
+    # {{ listing.image|thumbnail:"card" }}, the proxied thumbnail of an external image URL
+    return thumbnail_url(url, size)
@@ -0,0 +1,24 @@
+from contextlib import contextmanager
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test.utils import CaptureQueriesContext
+
+
+class QueryBudgetMixin:
+    # TestCase mixin: fail when a block of code or a view runs more queries than allowed
+
+    @contextmanager
+    def assertQueryBudget(self, budget, using=DEFAULT_DB_ALIAS):
+        with CaptureQueriesContext(connections[using]) as context:
+            yield context
+        executed = len(context)
+        if executed > budget:
+            queries = "\n".join(
+                f"{i}. {query['sql']}" for i, query in enumerate(context.captured_queries, start=1)
+            )
+            self.fail(f"{executed} queries executed, budget is {budget}\nCaptured queries were:\n{queries}")
+
+    def assertViewQueryBudget(self, url, budget, method="get", data=None, **extra):
+        with self.assertQueryBudget(budget):
+            response = getattr(self.client, method)(url, data, **extra)
+        return response
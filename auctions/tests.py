@@ -1,3 +1,1543 @@
-from django.test import TestCase
+import asyncio
+import base64
+import json
+import os
+import random
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO, StringIO
+from unittest import mock, skipIf
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, sync_to_async
+from django.conf import settings
+from django.contrib.sessions.models import Session
+from django.core.management import call_command
+from django.db import DatabaseError, connection, connections, transaction
+from django.db.models import Count, Max
+from django.http import HttpResponse
+from django.test import Client, RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from . import api, cache, images, ratelimit, routers, sqlite
+from .archive import archive_bids
+from .middleware import ReplicaRoutingMiddleware
+from .models import User, ListingCategory, Listing, Bid, BidArchive, CategoryPriceBucket, CategoryStats, Comment, UserStats
+from .pubsub import get_broker, listing_channel
+from .routers import STICKY_COOKIE, ReplicaRouter, replica_reads
+from .services import BidRejected, ListingClosed, close_due_listings, next_deadline, place_bid
+from .streaming import EventStreamRouter
+from .testing import QueryBudgetMixin
+
+
+class BidPlacementStressTest(TransactionTestCase):
+    threads = 8
+    bids_per_thread = 40
+
+    def setUp(self):
+        self.author = User.objects.create_user("author", "author@example.com", "password")
+        self.bidders = [
+            User.objects.create_user(f"bidder{i}", f"bidder{i}@example.com", "password")
+            for i in range(self.threads)
+        ]
+        self.listing = Listing.objects.create(
+            author=self.author,
+            title="Stress",
+            description="Concurrent bids",
+            starting_bid=1
+        )
+
+    def bid_worker(self, bidder, accepted, errors, barrier):
+        rng = random.Random(bidder.pk)
+        barrier.wait()
+        try:
+            for _ in range(self.bids_per_thread):
+                amount = rng.randint(1, 10000)
+                try:
+                    bid = place_bid(self.listing, bidder, amount)
+                except BidRejected:
+                    continue
+                accepted.append(bid)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            connection.close()
+
+    def test_concurrent_bids_keep_highest_winner(self):
+        accepted = []
+        errors = []
+        barrier = threading.Barrier(self.threads)
+        workers = [
+            threading.Thread(target=self.bid_worker, args=(bidder, accepted, errors, barrier))
+            for bidder in self.bidders
+        ]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        self.assertEqual(errors, [])
+
+        self.listing.refresh_from_db()
+        bids = list(Bid.objects.filter(on_listing=self.listing).order_by("pk"))
+        highest = max(bids, key=lambda bid: bid.amount)
+
+        # Every stored bid was accepted, and each one beat the previous
+        self.assertEqual(len(bids), len(accepted))
+        amounts = [bid.amount for bid in bids]
+        self.assertEqual(amounts, sorted(set(amounts)))
+        # Denormalized stats match the bid table
+        self.assertEqual(self.listing.bid_count, len(bids))
+        self.assertEqual(self.listing.current_price, highest.amount)
+        self.assertEqual(self.listing.leading_bid_id, highest.pk)
+        self.assertEqual(self.listing.user_with_max_bid_id, highest.from_user_id)
+
+
+class BidStatsTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user("author", "author@example.com", "password")
+        cls.alice = User.objects.create_user("alice", "alice@example.com", "password")
+        cls.bob = User.objects.create_user("bob", "bob@example.com", "password")
+        cls.listings = [
+            Listing.objects.create(author=cls.author, title=f"Listing {i}", description="Desc", starting_bid=10)
+            for i in range(3)
+        ]
+
+    def test_record_bid_rejects_stale_version(self):
+        listing = self.listings[0]
+        place_bid(listing, self.alice, 11)
+        stale = Listing.objects.get(pk=listing.pk)
+        place_bid(listing, self.bob, 12)
+        with transaction.atomic():
+            bid = Bid.objects.create(from_user=self.alice, on_listing=stale, amount=13)
+            self.assertFalse(stale.record_bid(bid, expected_version=stale.version))
+            self.assertEqual((stale.current_price, stale.bid_count), (11, 1))
+        listing.refresh_from_db()
+        self.assertEqual((listing.current_price, listing.bid_count, listing.user_with_max_bid), (12, 2, self.bob))
+
+        fresh = Listing.objects.get(pk=listing.pk)
+        with transaction.atomic():
+            bid = Bid.objects.create(from_user=self.alice, on_listing=fresh, amount=14)
+            self.assertTrue(fresh.record_bid(bid, expected_version=fresh.version))
+        listing.refresh_from_db()
+        self.assertEqual((listing.current_price, listing.bid_count, listing.leading_bid), (14, 3, bid))
+        self.assertEqual(listing.version, fresh.version)
+
+    def test_rebuild_matches_bid_table(self):
+        for amount in range(11, 16):
+            place_bid(self.listings[0], self.alice if amount % 2 else self.bob, amount)
+        place_bid(self.listings[1], self.bob, 20)
+        Listing.objects.update(current_price=1, bid_count=99, leading_bid=None, user_with_max_bid=None)
+        call_command("rebuild_bid_stats", self.listings[0].pk, self.listings[1].pk, stdout=StringIO())
+
+        for listing in self.listings[:2]:
+            listing.refresh_from_db()
+            top_bid = listing.bids.order_by("-amount").first()
+            self.assertEqual(listing.bid_count, listing.bids.count())
+            self.assertEqual(listing.current_price, listing.bids.aggregate(Max("amount"))["amount__max"])
+            self.assertEqual((listing.leading_bid, listing.user_with_max_bid), (top_bid, top_bid.from_user))
+        # Not listed, left alone
+        self.assertEqual(Listing.objects.get(pk=self.listings[2].pk).bid_count, 99)
+
+        call_command("rebuild_bid_stats", stdout=StringIO())
+        self.listings[2].refresh_from_db()
+        self.assertEqual((self.listings[2].bid_count, self.listings[2].current_price), (0, 10))
+
+
+class ExplainQueriesTest(TestCase):
+    @skipIf(connection.vendor != "sqlite", "Checks SQLite's EXPLAIN QUERY PLAN output")
+    def test_plans_use_access_path_indexes(self):
+        author = User.objects.create_user("author", "author@example.com", "password")
+        category = ListingCategory.objects.create(name="Books")
+        listing = Listing.objects.create(author=author, title="Lamp", description="Desc", category=category, starting_bid=10)
+        place_bid(listing, author, 11)
+        Comment.objects.create(author=author, on_listing=listing, text="Nice")
+
+        out = StringIO()
+        call_command("explain_queries", repeat=1, stdout=out)
+        indexed, unindexed = out.getvalue().split("Without access path indexes")
+        for index in (
+            "listing_feed_idx",
+            "listing_category_feed_idx",
+            "bid_listing_history_idx",
+            "bid_listing_amount_idx",
+            "comment_listing_history_idx",
+        ):
+            with self.subTest(index=index):
+                self.assertIn(index, indexed)
+                self.assertNotIn(index, unindexed)
+        # The dropped indexes are back
+        with connection.cursor() as cursor:
+            self.assertIn("listing_feed_idx", connection.introspection.get_constraints(cursor, "auctions_listing"))
+
+
+class ViewQueryBudgetTest(QueryBudgetMixin, TestCase):
+    budgets = {
+        # Feeds: session, user, facet counts, subcategory names, page
+        "index": 5,
+        "categories": 4,
+        "category": 6,
+        "watchlist": 4,
+        "user_page": 4,
+        "listing": 6,
+    }
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user("author", "author@example.com", "password")
+        cls.bidder = User.objects.create_user("bidder", "bidder@example.com", "password")
+        cls.category = ListingCategory.objects.create(name="Books")
+        for i in range(8):
+            listing = Listing.objects.create(
+                author=cls.author,
+                title=f"Listing {i}",
+                description="Some description",
+                category=cls.category,
+                starting_bid=10
+            )
+            listing.watchlisted_by.add(cls.bidder)
+        cls.listing = listing
+        for amount in range(11, 14):
+            place_bid(listing, cls.bidder, amount)
+            Comment.objects.create(author=cls.bidder, on_listing=listing, text="Nice")
+
+    def setUp(self):
+        self.client.force_login(self.bidder)
+
+    def test_feed_views_within_budget(self):
+        urls = {
+            "index": reverse("index"),
+            "categories": reverse("categories"),
+            "category": self.category.get_absolute_url(),
+            "watchlist": reverse("watchlist"),
+            "user_page": self.author.get_absolute_url(),
+        }
+        for name, url in urls.items():
+            with self.subTest(view=name):
+                response = self.assertViewQueryBudget(url, self.budgets[name])
+                self.assertEqual(response.status_code, 200)
+
+    def warm_up_session(self):
+        # The first visit stores the watchlist ids in the session. Other history
+        # limits than the measured page, so its fragments are still uncached.
+        self.client.get(self.listing.get_absolute_url(), {"bids": 20, "comments": 20})
+
+    def test_listing_view_within_budget(self):
+        self.warm_up_session()
+        response = self.assertViewQueryBudget(self.listing.get_absolute_url(), self.budgets["listing"])
+        self.assertEqual(response.status_code, 200)
+
+    def test_listing_view_budget_independent_of_history(self):
+        other = User.objects.create_user("other", "other@example.com", "password")
+        for amount in range(14, 64):
+            place_bid(self.listing, other, amount)
+            Comment.objects.create(author=other, on_listing=self.listing, text="Me too")
+        self.warm_up_session()
+        response = self.assertViewQueryBudget(self.listing.get_absolute_url(), self.budgets["listing"])
+        self.assertEqual(len(response.context["bid_history"].items), 10)
+        self.assertTrue(response.context["bid_history"].has_more)
+
+    def test_server_timing_header_only_for_staff_or_debug(self):
+        self.assertNotIn("Server-Timing", self.client.get(reverse("index")))
+        with override_settings(DEBUG=True):
+            self.assertIn("db;dur=", self.client.get(reverse("index"))["Server-Timing"])
+        self.client.force_login(User.objects.create_user("staff", "staff@example.com", "password", is_staff=True))
+        self.assertIn("db;dur=", self.client.get(reverse("index"))["Server-Timing"])
+
+    def test_every_request_logged(self):
+        with self.assertLogs("auctions.queries", "DEBUG") as logs:
+            self.client.get(reverse("index"))
+        self.assertEqual(json.loads(logs.records[0].getMessage())["path"], reverse("index"))
+
+
+class KeysetPaginationTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user("author", "author@example.com", "password")
+        cls.category = ListingCategory.objects.create(name="Books")
+        for i in range(14):
+            listing = Listing.objects.create(
+                author=cls.author,
+                # Ties on every sort key but the pk
+                title="Tied" if i % 3 else f"Listing {i}",
+                description="Some description",
+                category=cls.category if i % 4 else None,
+                starting_bid=10
+            )
+            listing.watchlisted_by.add(cls.author)
+        Listing.objects.update(date_added=timezone.now())
+
+    def setUp(self):
+        # Logged in, so pages come from the views rather than the feed cache
+        self.client.force_login(self.author)
+
+    def walk(self, url, params=None):
+        # Pages forward through next_cursor, then back through previous_cursor
+        params = dict(params or {})
+        forward = []
+        while True:
+            page = self.client.get(url, params).context["page_obj"]
+            forward.append([listing.pk for listing in page])
+            if not page.has_next():
+                break
+            params["cursor"] = page.next_cursor
+        backward = [[listing.pk for listing in page]]
+        while page.has_previous():
+            params["cursor"] = page.previous_cursor
+            page = self.client.get(url, params).context["page_obj"]
+            backward.insert(0, [listing.pk for listing in page])
+        return forward, backward
+
+    def assertPages(self, url, listings, params=None):
+        expected = list(listings.values_list("pk", flat=True))
+        forward, backward = self.walk(url, params)
+        self.assertEqual([pk for page in forward for pk in page], expected)
+        self.assertGreater(len(forward), 1)
+        self.assertEqual(backward, forward)
+
+    def test_listing_feeds_page_both_ways(self):
+        listings = Listing.objects.filter(active=True).order_by("-date_added", "title", "pk")
+        self.assertPages(reverse("index"), listings)
+        self.assertPages(reverse("index"), listings.order_by("current_price", "pk"), {"sort": "price"})
+        self.assertPages(self.category.get_absolute_url(), listings.filter(category=self.category))
+        self.assertPages(reverse("watchlist"), self.author.watchlist_listings.order_by("-date_added", "title", "pk"))
+
+    def test_invalid_cursor(self):
+        for url in (reverse("index"), self.category.get_absolute_url(), reverse("watchlist")):
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(url, {"cursor": "garbage"}).status_code, 404)
+                # Well-formed but for another ordering
+                cursor = base64.urlsafe_b64encode(b'{"v":[1],"n":2,"b":false}').decode()
+                self.assertEqual(self.client.get(url, {"cursor": cursor}).status_code, 404)
+
+
+class ListingSearchTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user("author", "author@example.com", "password")
+        cls.category = ListingCategory.objects.create(name="Books")
+        cls.bike = Listing.objects.create(
+            author=cls.author,
+            title="Red bicycle",
+            description="Fast and light",
+            starting_bid=10
+        )
+        cls.book = Listing.objects.create(
+            author=cls.author,
+            title="Repair manual",
+            description="How to fix a bicycle",
+            category=cls.category,
+            starting_bid=5
+        )
+
+    def search(self, **params):
+        response = self.client.get(reverse("search"), params)
+        return [listing.pk for listing in response.context["listings"]]
+
+    def test_title_matches_rank_first(self):
+        self.assertEqual(self.search(q="bicycle"), [self.bike.pk, self.book.pk])
+
+    def test_filters_by_category_and_active(self):
+        self.assertEqual(self.search(q="bicycle", category="books"), [self.book.pk])
+        self.book.active = False
+        self.book.save()
+        self.assertEqual(self.search(q="bicycle"), [self.bike.pk])
+        self.assertEqual(self.search(q="bicycle", active="0"), [self.book.pk])
+
+    def test_index_follows_updates(self):
+        self.bike.title = "Green tricycle"
+        self.bike.save()
+        self.assertEqual(self.search(q="tricycle"), [self.bike.pk])
+        self.assertEqual(self.search(q="red"), [])
+
+    def test_other_databases_fall_back_to_icontains(self):
+        with mock.patch.object(connection, "vendor", "mysql"):
+            self.assertEqual(self.search(q="bicycle"), [self.bike.pk, self.book.pk])
+            self.assertEqual(self.search(q="fix bicycle"), [self.book.pk])
+            self.assertEqual(self.search(q="bicycle", category="books"), [self.book.pk])
+            self.assertEqual(self.search(q="!!"), [])
+
+
+class FeedCacheTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user("author", "author@example.com", "password")
+        cls.bidder = User.objects.create_user("bidder", "bidder@example.com", "password")
+        cls.category = ListingCategory.objects.create(name="Books")
+        cls.listing = Listing.objects.create(
+            author=cls.author,
+            title="Cached",
+            description="Some description",
+            category=cls.category,
+            starting_bid=10
+        )
+
+    def setUp(self):
+        cache.get_cache().clear()
+
+    def test_anonymous_feed_served_from_cache(self):
+        for url in (reverse("index"), self.category.get_absolute_url(), reverse("categories")):
+            with self.subTest(url=url):
+                self.assertEqual(self.client.get(url)["X-Cache"], "MISS")
+                with self.assertNumQueries(0):
+                    self.assertEqual(self.client.get(url)["X-Cache"], "HIT")
+
+    def test_bid_invalidates_feed(self):
+        url = self.category.get_absolute_url()
+        self.client.get(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            place_bid(self.listing, self.bidder, 25)
+        response = self.client.get(url)
+        self.assertEqual(response["X-Cache"], "MISS")
+        self.assertContains(response, "25.0")
+
+    def test_logged_in_users_bypass_cache(self):
+        self.client.force_login(self.bidder)
+        self.client.get(reverse("index"))
+        self.assertNotIn("X-Cache", self.client.get(reverse("index")))
+
+    def test_listing_fragments_skip_history_queries(self):
+        self.client.force_login(self.bidder)
+        url = self.listing.get_absolute_url()
+        self.client.get(url)
+        # Session, user, validators and listing. Bids and comments come from the
+        # fragment cache, the watchlist flag from the session.
+        with self.assertNumQueries(4):
+            self.client.get(url)
+
+    def test_comment_and_bid_refresh_listing_fragments(self):
+        self.client.force_login(self.bidder)
+        url = self.listing.get_absolute_url()
+        self.client.get(url)
+        self.client.post(url, {"addcomment": "Post Comment", "text": "Fresh comment"})
+        place_bid(self.listing, self.bidder, 30)
+        response = self.client.get(url)
+        self.assertContains(response, "Fresh comment")
+        self.assertContains(response, "$30.0</span> on")
+
+    def test_renames_refresh_listing_fragments(self):
+        # Bids are listed to logged in users
+        self.client.force_login(self.author)
+        url = self.listing.get_absolute_url()
+        place_bid(self.listing, self.bidder, 30)
+        self.client.get(url, {"bids": 10})
+        self.author.first_name, self.author.last_name = "Ada", "Lovelace"
+        self.author.save()
+        self.bidder.username = "renamed-bidder"
+        self.bidder.save()
+        self.category.name = "Rare Books"
+        self.category.save()
+        response = self.client.get(url, {"bids": 10})
+        self.assertContains(response, "Ada Lovelace")
+        self.assertContains(response, "renamed-bidder")
+        self.assertContains(response, "Rare Books")
+
+    def test_login_does_not_touch_listings(self):
+        last_modified = Listing.objects.get(pk=self.listing.pk).last_modified
+        self.assertTrue(self.client.login(username="author", password="password"))
+        self.assertEqual(Listing.objects.get(pk=self.listing.pk).last_modified, last_modified)
+
+
+class ConditionalGetTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user("author", "author@example.com", "password")
+        cls.bidder = User.objects.create_user("bidder", "bidder@example.com", "password")
+        cls.category = ListingCategory.objects.create(name="Books")
+        cls.listing = Listing.objects.create(
+            author=cls.author,
+            title="Conditional",
+            description="Some description",
+            category=cls.category,
+            starting_bid=10
+        )
+
+    def revalidate(self, url, response):
+        return self.client.get(url, HTTP_IF_NONE_MATCH=response["ETag"])
+
+    def test_unchanged_pages_answer_not_modified(self):
+        urls = {
+            reverse("index"): 0,
+            self.category.get_absolute_url(): 0,
+            self.listing.get_absolute_url(): 1,
+        }
+        for url, queries in urls.items():
+            with self.subTest(url=url):
+                response = self.client.get(url)
+                self.assertIn("Cookie", response["Vary"])
+                with self.assertNumQueries(queries):
+                    self.assertEqual(self.revalidate(url, response).status_code, 304)
+
+    def test_bid_changes_validators(self):
+        url = self.listing.get_absolute_url()
+        feed = self.client.get(reverse("index"))
+        page = self.client.get(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            place_bid(self.listing, self.bidder, 25)
+        self.assertEqual(self.revalidate(reverse("index"), feed).status_code, 200)
+        self.assertEqual(self.revalidate(url, page).status_code, 200)
+
+    def test_etag_differs_per_user_and_watchlist_state(self):
+        url = self.listing.get_absolute_url()
+        anonymous = self.client.get(url)
+        self.client.force_login(self.bidder)
+        self.assertEqual(self.revalidate(url, anonymous).status_code, 200)
+        page = self.client.get(url)
+        self.assertEqual(self.revalidate(url, page).status_code, 304)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.listing.watchlisted_by.add(self.bidder)
+        self.assertEqual(self.revalidate(url, page).status_code, 200)
+
+    def test_watcher_count_changes_validators(self):
+        url = self.listing.get_absolute_url()
+        page = self.client.get(url)
+        with self.captureOnCommitCallbacks(execute=True):
+            self.listing.watchlisted_by.add(self.bidder)
+        response = self.revalidate(url, page)
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, "Watched by 1 user")
+
+
+class WatchlistTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user("author", "author@example.com", "password")
+        cls.watcher = User.objects.create_user("watcher", "watcher@example.com", "password")
+        cls.listings = [
+            Listing.objects.create(author=cls.author, title=f"Listing {i}", description="Some", starting_bid=10)
+            for i in range(3)
+        ]
+
+    def setUp(self):
+        self.client.force_login(self.watcher)
+
+    def batch(self, action, ids):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse("watchlist_batch"), {"action": action, "ids": ids})
+        return response.json()
+
+    def watcher_counts(self):
+        return list(Listing.objects.order_by("pk").values_list("watcher_count", flat=True))
+
+    def test_batch_add_remove_maintains_watcher_counts(self):
+        first, second, third = (listing.pk for listing in self.listings)
+        self.assertEqual(self.batch("add", f"{first},{second},999")["ids"], [first, second])
+        self.assertEqual(self.watcher_counts(), [1, 1, 0])
+        self.batch("remove", str(first))
+        self.assertEqual(self.watcher_counts(), [0, 1, 0])
+        self.watcher.watchlist_listings.clear()
+        self.assertEqual(self.watcher_counts(), [0, 0, 0])
+
+    def test_batch_only_touches_changed_listings(self):
+        first, second, third = (listing.pk for listing in self.listings)
+        self.batch("add", str(first))
+        touched = dict(Listing.objects.values_list("pk", "last_modified"))
+        self.assertEqual(self.batch("add", f"{first},{second}")["ids"], [second])
+        self.assertEqual(self.batch("remove", f"{second},{third}")["ids"], [second])
+        self.assertEqual(Listing.objects.get(pk=first).last_modified, touched[first])
+        self.assertEqual(Listing.objects.get(pk=third).last_modified, touched[third])
+        self.assertEqual(self.watcher_counts(), [1, 0, 0])
+
+    def test_watched_ids_cached_in_session_until_toggle(self):
+        listing = self.listings[0]
+        url = listing.get_absolute_url()
+        self.client.get(url)
+        response = self.client.get(url)
+        self.assertFalse(response.context["inwatchlist_flag"])
+        self.batch("add", str(listing.pk))
+        self.assertTrue(self.client.get(url).context["inwatchlist_flag"])
+
+    def test_feed_marks_watched_listings(self):
+        self.batch("add", str(self.listings[1].pk))
+        response = self.client.get(reverse("index"))
+        watched = [listing.pk for listing in response.context["listings"] if listing.is_watched]
+        self.assertEqual(watched, [self.listings[1].pk])
+        self.assertContains(response, "In your watchlist", count=1)
+
+
+class UserStatsTest(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user("author", "author@example.com", "password")
+        self.alice = User.objects.create_user("alice", "alice@example.com", "password")
+        self.bob = User.objects.create_user("bob", "bob@example.com", "password")
+        self.listings = [
+            Listing.objects.create(author=self.author, title=f"Listing {i}", description="Desc", starting_bid=10)
+            for i in range(8)
+        ]
+
+    def stats(self, user):
+        return UserStats.objects.values("listing_count", "bid_count", "leading_count", "won_count", "total_spent").get(
+            user=user
+        )
+
+    def test_incremental_stats_match_rebuild(self):
+        for listing in self.listings[:3]:
+            place_bid(listing, self.alice, 11)
+            place_bid(listing, self.alice, 12)
+            place_bid(listing, self.bob, 13)
+        place_bid(self.listings[3], self.alice, 20)
+        Listing.objects.filter(pk__in=[listing.pk for listing in self.listings[:2]]).update(
+            ends_at=timezone.now() - timedelta(minutes=1)
+        )
+        close_due_listings()
+        self.client.force_login(self.author)
+        self.client.post(self.listings[3].get_close_url())
+        self.client.post(self.listings[3].get_close_url())
+
+        incremental = {user.username: self.stats(user) for user in (self.author, self.alice, self.bob)}
+        UserStats.objects.all().delete()
+        call_command("rebuild_user_stats", stdout=StringIO())
+        rebuilt = {user.username: self.stats(user) for user in (self.author, self.alice, self.bob)}
+        self.assertEqual(incremental, rebuilt)
+        self.assertEqual(rebuilt["alice"], {
+            "listing_count": 0, "bid_count": 7, "leading_count": 0, "won_count": 1, "total_spent": 20
+        })
+        self.assertEqual(rebuilt["bob"]["leading_count"], 1)
+        self.assertEqual(rebuilt["bob"]["won_count"], 2)
+        self.assertEqual(rebuilt["author"]["listing_count"], 8)
+
+    def test_tabs_paginate_without_count(self):
+        url = self.author.get_absolute_url()
+        seen = []
+        params = {"tab": "listings"}
+        while True:
+            with self.assertQueryBudget(3):
+                response = self.client.get(url, params)
+            self.assertEqual(response.context["paginator"].num_pages, 2)
+            seen += [listing.pk for listing in response.context["items"]]
+            if not response.context["page_obj"].has_next():
+                break
+            params["cursor"] = response.context["page_obj"].next_cursor
+        self.assertEqual(seen, [listing.pk for listing in reversed(self.listings)])
+
+        place_bid(self.listings[0], self.alice, 11)
+        response = self.client.get(self.alice.get_absolute_url(), {"tab": "bids"})
+        self.assertEqual([bid.amount for bid in response.context["items"]], [11])
+        self.assertContains(response, "Bids placed:")
+
+
+class CategoryTreeTest(QueryBudgetMixin, TestCase):
+    def setUp(self):
+        cache.get_cache().clear()
+        self.author = User.objects.create_user("author", "author@example.com", "password")
+        self.bidder = User.objects.create_user("bidder", "bidder@example.com", "password")
+        self.books = ListingCategory.objects.create(name="Books")
+        self.fiction = ListingCategory.objects.create(name="Fiction", parent=self.books)
+        self.poetry = ListingCategory.objects.create(name="Poetry", parent=self.fiction)
+        self.music = ListingCategory.objects.create(name="Music")
+
+    def create(self, category, price):
+        return Listing.objects.create(
+            author=self.author, title=f"{category} {price}", description="Desc", category=category, starting_bid=price
+        )
+
+    def stats(self):
+        return {
+            row.pop("category__slug"): row
+            for row in CategoryStats.objects.values("category__slug", "active_count", "min_price", "max_price")
+        }
+
+    def test_paths_follow_moves(self):
+        self.assertEqual(self.poetry.path, f"/{self.books.pk}/{self.fiction.pk}/{self.poetry.pk}/")
+        self.fiction.parent = self.music
+        self.fiction.save()
+        self.poetry.refresh_from_db()
+        self.assertEqual(self.poetry.path, f"/{self.music.pk}/{self.fiction.pk}/{self.poetry.pk}/")
+        self.books.parent = self.poetry
+        self.books.save()
+        self.music.parent = self.poetry
+        with self.assertRaises(ValueError):
+            self.music.save()
+
+    def test_incremental_stats_match_rebuild(self):
+        cheap = self.create(self.poetry, 5)
+        moved = self.create(self.fiction, 20)
+        closed = self.create(self.fiction, 8)
+        self.create(self.books, 30)
+        place_bid(cheap, self.bidder, 12)
+        moved.category = self.music
+        moved.save()
+        self.client.force_login(self.author)
+        self.client.post(closed.get_close_url())
+        Listing.objects.filter(pk=cheap.pk).update(ends_at=timezone.now() - timedelta(minutes=1))
+        place_bid(self.create(self.poetry, 7), self.bidder, 9)
+        close_due_listings()
+
+        incremental = self.stats()
+        self.assertEqual(incremental["poetry"], {"active_count": 1, "min_price": 9, "max_price": 9})
+        self.assertEqual(incremental["fiction"], {"active_count": 0, "min_price": None, "max_price": None})
+        self.assertEqual(incremental["music"], {"active_count": 1, "min_price": 20, "max_price": 20})
+        CategoryStats.objects.all().delete()
+        call_command("rebuild_category_stats", stdout=StringIO())
+        self.assertEqual(self.stats(), incremental)
+
+    def test_pages_include_subcategories(self):
+        self.create(self.books, 30)
+        self.create(self.fiction, 15)
+        poem = self.create(self.poetry, 5)
+        self.create(self.music, 50)
+
+        response = self.client.get(reverse("categories"))
+        totals = {category.slug: (category.listing_count, category.min_price) for category in response.context["categories"]}
+        self.assertEqual(totals, {"books": (3, 5), "fiction": (2, 5), "poetry": (1, 5), "music": (1, 50)})
+
+        with self.assertQueryBudget(5):
+            response = self.client.get(self.fiction.get_absolute_url())
+        self.assertEqual(response.context["paginator"].count, 2)
+        self.assertIn(poem, response.context["listings"])
+        self.assertEqual([(category, count) for category, count, query in response.context["category_facets"]], [(self.poetry, 1)])
+        response = self.client.get(reverse("search"), {"q": "poetry", "category": "books"})
+        self.assertEqual([listing.pk for listing in response.context["listings"]], [poem.pk])
+
+    def test_page_survives_stats_without_prices(self):
+        # Drifted stats, listings counted but no prices, until rebuild_category_stats runs
+        self.create(self.poetry, 5)
+        CategoryStats.objects.update(min_price=None, max_price=None)
+        response = self.client.get(reverse("categories"))
+        self.assertEqual(response.status_code, 200)
+        totals = {category.slug: (category.listing_count, category.min_price) for category in response.context["categories"]}
+        self.assertEqual(totals["books"], (1, None))
+
+
+class ListingFacetTest(TestCase):
+    def setUp(self):
+        cache.get_cache().clear()
+        self.author = User.objects.create_user("author", "author@example.com", "password")
+        self.bidder = User.objects.create_user("bidder", "bidder@example.com", "password")
+        self.books = ListingCategory.objects.create(name="Books")
+        self.poetry = ListingCategory.objects.create(name="Poetry", parent=self.books)
+        self.music = ListingCategory.objects.create(name="Music")
+        self.listings = {}
+        for title, category, price, ends_in in [
+            ("Atlas", self.books, 5, None),
+            ("Sonnets", self.poetry, 40, 2),
+            ("Haiku", self.poetry, 60, 48),
+            ("Vinyl", self.music, 8, 1),
+            ("Misc", None, 700, None),
+        ]:
+            self.listings[title] = Listing.objects.create(
+                author=self.author,
+                title=title,
+                description="Desc",
+                category=category,
+                starting_bid=price,
+                ends_at=timezone.now() + timedelta(hours=ends_in) if ends_in else None
+            )
+        for amount in (6, 7):
+            place_bid(self.listings["Atlas"], self.bidder, amount)
+        place_bid(self.listings["Sonnets"], self.bidder, 45)
+
+    def feed(self, url=None, **params):
+        response = self.client.get(url or reverse("index"), params)
+        return response, [listing.title for listing in response.context["listings"]]
+
+    def test_sorts_and_price_filter(self):
+        self.assertEqual(self.feed(sort="price")[1], ["Atlas", "Vinyl", "Sonnets", "Haiku", "Misc"])
+        self.assertEqual(self.feed(sort="bids")[1][:2], ["Atlas", "Sonnets"])
+        # Within 24 hours, soonest first
+        self.assertEqual(self.feed(sort="ending")[1], ["Vinyl", "Sonnets"])
+        # A price range alone sorts by price
+        response, titles = self.feed(price=0)
+        self.assertEqual(titles, ["Atlas", "Vinyl"])
+        self.assertEqual(response.context["paginator"].count, 2)
+        self.assertEqual(self.feed(price=1, sort="-price")[1], ["Sonnets"])
+
+    def test_unsupported_combination_falls_back(self):
+        response, titles = self.feed(price=0, sort="newest")
+        self.assertEqual(titles, ["Misc", "Vinyl", "Haiku", "Sonnets", "Atlas"])
+        self.assertContains(response, "Price ranges can only be sorted by price")
+
+    def test_facet_counts(self):
+        response, titles = self.feed(price=2)
+        prices = {label: count for label, count, query, selected in response.context["price_facets"]}
+        self.assertEqual(prices, {"$0 \u2013 $10": 2, "$10 \u2013 $50": 1, "$50 \u2013 $100": 1, "$500 \u2013 $1000": 1})
+        categories = [(category.slug, count) for category, count, query in response.context["category_facets"]]
+        self.assertEqual(categories, [("books", 1)])
+
+        response, titles = self.feed(self.books.get_absolute_url(), sort="ending")
+        self.assertEqual(titles, ["Sonnets"])
+        self.assertEqual(response.context["paginator"].count, 1)
+        categories = [(category.slug, count) for category, count, query in response.context["category_facets"]]
+        self.assertEqual(categories, [("poetry", 1)])
+
+    def test_ending_soon_follows_the_clock(self):
+        # Haiku enters the 24 hour window with no write, cached pages and ETags must notice
+        url = reverse("index") + "?sort=ending"
+        response = self.client.get(url)
+        self.assertEqual(response["X-Cache"], "MISS")
+        etag = response["ETag"]
+        self.assertEqual(self.client.get(url)["X-Cache"], "HIT")
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        later = timezone.now() + timedelta(hours=25)
+        with mock.patch("django.utils.timezone.now", return_value=later):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response["X-Cache"], "MISS")
+        self.assertIn("Haiku", [listing.title for listing in response.context["listings"]])
+        # Other sorts don't depend on the clock
+        self.assertEqual(self.feed()[0]["X-Cache"], "MISS")
+        with mock.patch("django.utils.timezone.now", return_value=later):
+            self.assertEqual(self.client.get(reverse("index"))["X-Cache"], "HIT")
+
+    def test_incremental_buckets_match_rebuild(self):
+        place_bid(self.listings["Vinyl"], self.bidder, 120)
+        self.listings["Haiku"].category = self.music
+        self.listings["Haiku"].save()
+        self.listings["Misc"].delete()
+        self.client.force_login(self.author)
+        self.client.post(self.listings["Atlas"].get_close_url())
+
+        def buckets():
+            rows = CategoryPriceBucket.objects.filter(active_count__gt=0).values_list("category", "bucket", "active_count")
+            return sorted(rows, key=str)
+
+        incremental = buckets()
+        call_command("rebuild_category_stats", stdout=StringIO())
+        self.assertEqual(buckets(), incremental)
+        self.assertIn((self.music.pk, 3, 1), incremental)
+
+
+class CommentEndpointTest(QueryBudgetMixin, TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user("author", "author@example.com", "password")
+        cls.alice = User.objects.create_user("alice", "alice@example.com", "password")
+        cls.listing = Listing.objects.create(author=cls.author, title="Lamp", description="Desc", starting_bid=10)
+        cls.url = reverse("listing_comments", args=[cls.listing.pk])
+
+    def test_post_returns_only_the_new_comment(self):
+        self.client.force_login(self.alice)
+        # Session, user, listing check, insert, listing touch
+        with self.assertQueryBudget(5):
+            response = self.client.post(self.url, {"text": "Still works?"}, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        self.assertEqual(response.status_code, 201)
+        self.assertContains(response, "Still works?", status_code=201)
+        self.assertNotContains(response, "Current Price", status_code=201)
+
+        response = self.client.post(self.url, {"text": "Yes"}, HTTP_ACCEPT="application/json")
+        self.assertEqual(response.json()["author"], "alice")
+        response = self.client.post(self.url, {"text": ""}, HTTP_ACCEPT="application/json")
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("text", response.json()["errors"])
+
+        # Without script the form posts normally and lands back on the listing
+        response = self.client.post(self.url, {"text": "Plain"})
+        self.assertRedirects(response, self.listing.get_absolute_url())
+        self.assertEqual(self.listing.comments.count(), 3)
+
+        self.client.logout()
+        response = self.client.post(self.url, {"text": "Anonymous"}, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+        self.assertEqual(response.status_code, 401)
+
+    def test_thread_pages_by_cursor(self):
+        for i in range(25):
+            Comment.objects.create(author=self.alice, on_listing=self.listing, text=f"Comment {i}")
+        expected = list(self.listing.comments.order_by("-date_added", "pk").values_list("pk", flat=True))
+
+        # The listing page renders the first page and links to the next one
+        response = self.client.get(self.listing.get_absolute_url())
+        self.assertEqual([comment.pk for comment in response.context["comment_history"]], expected[:10])
+        self.assertContains(response, f"{self.url}?cursor=")
+
+        seen, cursor = [], None
+        while True:
+            with self.assertQueryBudget(2):
+                response = self.client.get(self.url, {"format": "json", **({"cursor": cursor} if cursor else {})})
+            page = response.json()
+            seen += [comment["id"] for comment in page["results"]]
+            cursor = page["next"]
+            if cursor is None:
+                break
+        self.assertEqual(seen, expected)
+
+        response = self.client.get(self.url, {"cursor": "garbage"})
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(RATE_LIMITS={
+    "listing": [
+        {"scope": "user", "rate": "2/h", "methods": ["POST"], "param": "makebid"},
+        {"scope": "listing", "rate": "3/h", "methods": ["POST"], "param": "makebid"},
+    ],
+    "listing_comments": [{"scope": "user", "rate": "2/h", "methods": ["POST"]}],
+    "login": [{"scope": "post:username", "rate": "2/h", "methods": ["POST"]}],
+})
+class RateLimitTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user("author", "author@example.com", "password")
+        cls.alice = User.objects.create_user("alice", "alice@example.com", "password")
+        cls.bob = User.objects.create_user("bob", "bob@example.com", "password", is_staff=True)
+        cls.listing = Listing.objects.create(author=cls.author, title="Lamp", description="Desc", starting_bid=10)
+
+    def setUp(self):
+        ratelimit.get_store().clear()
+        # Counters are kept for the life of the process
+        self.counters = ratelimit.stats()
+
+    def bid(self, amount, **extra):
+        return self.client.post(self.listing.get_absolute_url(), {"makebid": "", "amount": amount}, **extra)
+
+    def test_bid_spam_is_rejected_before_the_view(self):
+        self.client.force_login(self.alice)
+        self.assertEqual(self.bid(11).status_code, 200)
+        self.assertEqual(self.bid(12).status_code, 200)
+        # Session and user only, the listing isn't loaded
+        with self.assertNumQueries(2):
+            response = self.bid(13)
+        self.assertEqual(response.status_code, 429)
+        self.assertGreater(int(response["Retry-After"]), 0)
+        self.assertEqual(Listing.objects.get(pk=self.listing.pk).current_price, 12)
+        # Other POSTs to the listing and plain views aren't bids
+        self.assertEqual(self.client.post(self.listing.get_absolute_url(), {"addtowatchlist": ""}).status_code, 200)
+        self.assertEqual(self.client.get(self.listing.get_absolute_url()).status_code, 200)
+
+        # Another user has a bucket of their own, but the listing's is shared
+        self.client.force_login(self.bob)
+        self.assertEqual(self.bid(14).status_code, 200)
+        self.assertEqual(self.bid(15).status_code, 429)
+
+        counters = self.client.get(reverse("metrics")).json()["rate_limits"]
+        for rule, expected in {"listing:user": (4, 1), "listing:listing": (3, 1)}.items():
+            before = self.counters.get(rule, {"allowed": 0, "rejected": 0})
+            self.assertEqual(
+                (counters[rule]["allowed"] - before["allowed"], counters[rule]["rejected"] - before["rejected"]),
+                expected
+            )
+        self.client.force_login(self.alice)
+        self.assertEqual(self.client.get(reverse("metrics")).status_code, 403)
+
+    def test_made_up_session_cookies_share_the_address_bucket(self):
+        # Unknown session keys are anonymous requests, limited by address
+        url = reverse("listing_comments", args=[self.listing.pk])
+        for i, status in enumerate((401, 401, 429)):
+            self.client.cookies[settings.SESSION_COOKIE_NAME] = f"made-up-{i}"
+            response = self.client.post(url, {"text": "Spam"}, HTTP_X_REQUESTED_WITH="XMLHttpRequest")
+            self.assertEqual(response.status_code, status)
+        # Every session of a user shares the user's bucket
+        ratelimit.get_store().clear()
+        other = Client()
+        for client in (self.client, other):
+            client.force_login(self.bob)
+        self.assertEqual(self.bid(20).status_code, 200)
+        self.assertEqual(other.post(self.listing.get_absolute_url(), {"makebid": "", "amount": 21}).status_code, 200)
+        self.assertEqual(self.bid(22).status_code, 429)
+
+    def test_login_attempts_are_limited_per_username(self):
+        for address in ("10.0.0.1", "10.0.0.2"):
+            response = self.client.post(reverse("login"), {"username": "Alice", "password": "wrong"}, REMOTE_ADDR=address)
+            self.assertEqual(response.status_code, 200)
+        # No user lookup, no password hash
+        with self.assertNumQueries(0):
+            response = self.client.post(reverse("login"), {"username": "alice", "password": "password"}, REMOTE_ADDR="10.0.0.3")
+        self.assertEqual(response.status_code, 429)
+        response = self.client.post(reverse("login"), {"username": "bob", "password": "password"}, REMOTE_ADDR="10.0.0.3")
+        self.assertEqual(response.status_code, 302)
+
+    def test_buckets_refill(self):
+        store = ratelimit.LocalBucketStore(max_keys=2)
+        self.assertEqual(store.take("a", 2, 1, now=0), (True, 0))
+        self.assertEqual(store.take("a", 2, 1, now=0), (True, 0))
+        self.assertEqual(store.take("a", 2, 1, now=0.5), (False, 0.5))
+        self.assertEqual(store.take("a", 2, 1, now=1), (True, 0))
+        # The least recently used bucket goes first, and comes back full
+        store.take("b", 2, 1, now=1)
+        store.take("c", 2, 1, now=1)
+        self.assertEqual(list(store._buckets), ["b", "c"])
+
+
+class BidArchiveTest(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user("author", "author@example.com", "password")
+        self.alice = User.objects.create_user("alice", "alice@example.com", "password")
+        self.bob = User.objects.create_user("bob", "bob@example.com", "password")
+        self.listing = Listing.objects.create(author=self.author, title="Old", description="Desc", starting_bid=10)
+        self.open_listing = Listing.objects.create(author=self.author, title="New", description="Desc", starting_bid=10)
+        for amount in range(11, 26):
+            place_bid(self.listing, self.alice if amount % 2 else self.bob, amount)
+        place_bid(self.open_listing, self.bob, 11)
+        self.history = list(self.listing.bids.values_list("pk", "amount"))
+        Listing.objects.filter(pk=self.listing.pk).update(
+            active=False,
+            closed_at=timezone.now() - timedelta(days=40)
+        )
+
+    def test_archives_history_and_keeps_leading_bid(self):
+        self.assertEqual(archive_bids(), [self.listing.pk])
+        self.assertEqual(archive_bids(), [])
+        self.listing.refresh_from_db()
+        self.assertTrue(self.listing.bids_archived)
+        self.assertEqual(list(self.listing.bids.values_list("pk", flat=True)), [self.listing.leading_bid_id])
+        self.assertEqual(BidArchive.objects.get(listing=self.listing).bid_count, 15)
+        self.assertEqual(self.open_listing.bids.count(), 1)
+
+        # Stats stay as they were, also after rebuilding them
+        call_command("rebuild_bid_stats", stdout=StringIO())
+        call_command("rebuild_user_stats", stdout=StringIO())
+        self.listing.refresh_from_db()
+        self.assertEqual((self.listing.bid_count, self.listing.current_price), (15, 25))
+        self.assertEqual(UserStats.objects.get(user=self.alice).bid_count, 8)
+        self.assertEqual(UserStats.objects.get(user=self.bob).bid_count, 8)
+
+    def test_listing_page_and_api_read_archive(self):
+        archive_bids()
+        self.client.force_login(self.bob)
+        response = self.client.get(self.listing.get_absolute_url(), {"bids": 10})
+        self.assertEqual([bid.amount for bid in response.context["bid_history"]], list(range(25, 15, -1)))
+        self.assertTrue(response.context["bid_history"].has_more)
+        self.assertContains(response, 'href="/user/alice"')
+
+        seen = []
+        params = {"limit": 4, "fields": "id,user,amount"}
+        while True:
+            data = self.client.get(reverse("api_listing_bids", args=[self.listing.pk]), params).json()
+            seen += [(bid["id"], bid["amount"]) for bid in data["results"]]
+            if not data["next"]:
+                break
+            params["cursor"] = data["next"]
+        self.assertEqual(seen, self.history)
+
+    def test_profile_bids_tab_counts_listed_bids(self):
+        archive_bids()
+        response = self.client.get(self.bob.get_absolute_url(), {"tab": "bids"})
+        self.assertEqual(response.context["stats"].bid_count, 8)
+        self.assertEqual(response.context["paginator"].count, 1)
+        self.assertEqual([bid.on_listing for bid in response.context["items"]], [self.open_listing])
+        self.assertContains(response, "Bids (1)")
+
+    def test_export_after_archiving_has_every_bid(self):
+        archive_bids()
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        exported, stderr = {}, StringIO()
+        for model in ("bids", "archived_bids"):
+            path = os.path.join(tmp.name, f"{model}.jsonl")
+            options = {"output": path, "checkpoint": f"{path}.checkpoint", "chunk_size": 1, "stderr": stderr}
+            call_command("export_data", model, **options)
+            # Resuming from the checkpoint adds nothing twice
+            call_command("export_data", model, **options)
+            with open(path) as f:
+                exported[model] = [(row["id"], row["amount"]) for row in map(json.loads, f)]
+        self.assertIn("export them with archived_bids", stderr.getvalue())
+        self.assertEqual(len(exported["archived_bids"]), 14)
+        self.assertEqual(
+            sorted(exported["bids"] + exported["archived_bids"]),
+            sorted(self.history + list(self.open_listing.bids.values_list("pk", "amount")))
+        )
+
+
+@override_settings(REPLICA_DATABASES=["replica1"])
+class ReplicaRoutingTest(SimpleTestCase):
+    # Views report where the router sends their reads, no database is touched
+
+    def setUp(self):
+        # There is no replica1 connection to check
+        self.checked = []
+        patcher = mock.patch.object(routers, "check_connection", side_effect=self.checked.append)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def request(self, view, method="get", **cookies):
+        request = getattr(RequestFactory(), method)("/")
+        request.COOKIES.update(cookies)
+        middleware = ReplicaRoutingMiddleware(lambda request: middleware.process_view(request, view, (), {}) or view(request))
+        return middleware(request)
+
+    @staticmethod
+    def reading_view(request):
+        return HttpResponse(ReplicaRouter().db_for_read(Listing))
+
+    @staticmethod
+    def marked(view):
+        return replica_reads(lambda request: view(request))
+
+    @staticmethod
+    def writing_view(request):
+        ReplicaRouter().db_for_write(Bid)
+        return HttpResponse(ReplicaRouter().db_for_read(Listing))
+
+    def test_marked_views_read_from_replica(self):
+        self.assertEqual(self.request(self.marked(self.reading_view)).content, b"replica1")
+        self.assertEqual(self.request(self.reading_view).content, b"default")
+        self.assertEqual(self.request(self.marked(self.reading_view), method="post").content, b"default")
+
+    def test_writers_stick_to_primary(self):
+        response = self.request(self.marked(self.writing_view))
+        # Reads after a write in the same request go to the primary too
+        self.assertEqual(response.content, b"default")
+        sticky = response.cookies[STICKY_COOKIE].value
+        response = self.request(self.marked(self.reading_view), **{STICKY_COOKIE: sticky})
+        self.assertEqual(response.content, b"default")
+        self.assertNotIn(STICKY_COOKIE, response.cookies)
+        self.assertEqual(self.request(self.marked(self.reading_view), **{STICKY_COOKIE: "0"}).content, b"replica1")
+
+    def test_session_writes_dont_stick(self):
+        def session_view(request):
+            ReplicaRouter().db_for_write(Session)
+            return HttpResponse(ReplicaRouter().db_for_read(Listing) + "," + ReplicaRouter().db_for_read(Session))
+
+        response = self.request(self.marked(session_view))
+        self.assertEqual(response.content, b"replica1,default")
+        self.assertNotIn(STICKY_COOKIE, response.cookies)
+
+    def test_only_used_connections_are_checked(self):
+        routers.check_connections()
+        self.assertEqual(self.checked, ["default"])
+        self.request(self.reading_view)
+        self.assertEqual(self.checked, ["default"])
+        self.request(self.marked(self.reading_view))
+        self.assertEqual(self.checked, ["default", "replica1"])
+
+
+@override_settings(SQLITE_PROFILE="production", SQLITE_WRITE_QUEUE_TIMEOUT=0.05)
+class SqliteProfileTest(TestCase):
+    def test_new_connections_get_pragmas(self):
+        new_connection = connections.create_connection("default")
+        try:
+            with new_connection.cursor() as cursor:
+                cursor.execute("PRAGMA busy_timeout")
+                self.assertEqual(cursor.fetchone()[0], 5000)
+                cursor.execute("PRAGMA synchronous")
+                self.assertEqual(cursor.fetchone()[0], 1)  # NORMAL
+        finally:
+            new_connection.close()
+
+    def test_writes_are_serialized(self):
+        errors = []
+
+        def write():
+            try:
+                with sqlite.serialized_writes():
+                    pass
+            except Exception as e:
+                errors.append(e)
+
+        with sqlite.serialized_writes():
+            # Reentrant for the holder, other threads wait their turn
+            with sqlite.serialized_writes():
+                thread = threading.Thread(target=write)
+                thread.start()
+                thread.join()
+        self.assertEqual([str(e) for e in errors], ["database is locked (write queue timeout)"])
+        write()
+        self.assertEqual(len(errors), 1)
+
+
+# 1x1 PNG, served when Pillow isn't there to draw a larger one
+TINY_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAADUlEQVR42mP8z8BQDwAEhQGAhKmMIQAAAABJRU5ErkJggg=="
+)
+
+
+class OriginHandler(BaseHTTPRequestHandler):
+    # Local stand-in for the hosts of listing images
+    hits = []
+    body = b""
+
+    def do_GET(self):
+        self.hits.append(self.path)
+        if self.path != "/photo":
+            self.send_error(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "image/jpeg" if images.Image else "image/png")
+        self.send_header("Content-Length", str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class ImageProxyTest(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        if images.Image:
+            out = BytesIO()
+            images.Image.new("RGB", (2000, 1500), "teal").save(out, "JPEG")
+            OriginHandler.body = out.getvalue()
+        else:
+            OriginHandler.body = TINY_PNG
+        cls.server = ThreadingHTTPServer(("127.0.0.1", 0), OriginHandler)
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+        cls.origin = f"http://127.0.0.1:{cls.server.server_address[1]}/photo"
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super().tearDownClass()
+
+    def setUp(self):
+        OriginHandler.hits = []
+        # Remembered fetch failures
+        cache.get_cache().clear()
+        cache_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(cache_dir.cleanup)
+        settings = override_settings(IMAGE_CACHE_DIR=cache_dir.name, IMAGE_PROXY_ALLOW_PRIVATE=True)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+    def get(self, size, url=None, **headers):
+        response = self.client.get(images.thumbnail_url(url or self.origin, size), **headers)
+        content = b"".join(response.streaming_content) if response.streaming else response.content
+        return response, content
+
+    def test_origin_fetched_once_for_all_sizes(self):
+        response = self.get("card")[0]
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("immutable", response["Cache-Control"])
+        self.assertEqual(self.get("avatar")[0].status_code, 200)
+        self.assertEqual(OriginHandler.hits, ["/photo"])
+
+        etag = self.get("card")[0]["ETag"]
+        self.assertEqual(self.get("card", HTTP_IF_NONE_MATCH=etag)[0].status_code, 304)
+
+    @skipIf(images.Image is None, "Resizing needs Pillow")
+    def test_thumbnails_fit_their_boxes(self):
+        for size, box in images.SIZES.items():
+            with self.subTest(size=size):
+                thumbnail = images.Image.open(BytesIO(self.get(size)[1]))
+                self.assertLessEqual(thumbnail.size[0], box[0])
+                self.assertLessEqual(thumbnail.size[1], box[1])
+                self.assertEqual(thumbnail.size[0] / thumbnail.size[1], 2000 / 1500)
+
+    def test_range_requests(self):
+        full = self.get("card")[1]
+        response, content = self.get("card", HTTP_RANGE="bytes=0-9")
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(content, full[:10])
+        self.assertEqual(response["Content-Range"], f"bytes 0-9/{len(full)}")
+        response, content = self.get("card", HTTP_RANGE="bytes=-5")
+        self.assertEqual(content, full[-5:])
+        self.assertEqual(self.get("card", HTTP_RANGE=f"bytes={len(full)}-")[0].status_code, 416)
+
+    def test_rejected_requests(self):
+        url = reverse("image", kwargs={"size": "card"})
+        self.assertEqual(self.client.get(url, {"url": self.origin}).status_code, 403)
+        self.assertEqual(self.get("poster")[0].status_code, 404)
+        self.assertEqual(self.get("card", url=self.origin + "-missing")[0].status_code, 502)
+        with override_settings(IMAGE_PROXY_ALLOW_PRIVATE=False):
+            self.assertEqual(self.get("card", url=self.origin + "?other")[0].status_code, 400)
+
+    def test_failed_fetches_are_remembered(self):
+        missing = self.origin + "-missing"
+        self.assertEqual(self.get("card", url=missing)[0].status_code, 502)
+        self.assertEqual(self.get("avatar", url=missing)[0].status_code, 502)
+        self.assertEqual(OriginHandler.hits, ["/photo-missing"])
+        with override_settings(IMAGE_PROXY_FAILURE_TTL=0):
+            cache.get_cache().clear()
+            self.get("card", url=missing)
+            self.get("card", url=missing)
+        self.assertEqual(len(OriginHandler.hits), 3)
+
+    def test_lru_eviction(self):
+        self.get("card")
+        self.assertEqual(images.evict(max_bytes=0), 0)
+        self.get("card")
+        self.assertEqual(OriginHandler.hits, ["/photo", "/photo"])
+
+    def test_eviction_walks_cache_only_when_due(self):
+        with mock.patch.object(images.os, "walk", wraps=os.walk) as walk:
+            # The first write learns the size
+            self.get("card")
+            self.assertEqual(walk.call_count, 1)
+            images.maybe_evict(100)
+            self.assertEqual(walk.call_count, 1)
+            with override_settings(IMAGE_CACHE_MAX_BYTES=1):
+                images.maybe_evict(100)
+            self.assertEqual(walk.call_count, 2)
+
+    def test_blob_evicted_while_serving(self):
+        get_thumbnail = images.get_thumbnail
+        evicted = []
+
+        def get_then_evict(url, size):
+            found = get_thumbnail(url, size)
+            if not evicted:
+                evicted.append(images.evict(max_bytes=0))
+            return found
+
+        self.get("card")
+        with mock.patch.object(images, "get_thumbnail", get_then_evict):
+            response, content = self.get("card")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(content)
+        self.assertEqual(OriginHandler.hits, ["/photo", "/photo"])
+
+
+class ApiTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user("author", "author@example.com", "password")
+        cls.bidder = User.objects.create_user("bidder", "bidder@example.com", "password")
+        cls.category = ListingCategory.objects.create(name="Books")
+        cls.listings = [
+            Listing.objects.create(
+                author=cls.author,
+                title=f"Listing {i}",
+                description="Some description",
+                category=cls.category,
+                starting_bid=10
+            )
+            for i in range(5)
+        ]
+        for amount in range(11, 16):
+            place_bid(cls.listings[0], cls.bidder, amount)
+
+    def get_json(self, url, **params):
+        response = self.client.get(url, params)
+        content = b"".join(response.streaming_content) if response.streaming else response.content
+        return response.status_code, json.loads(content)
+
+    def test_listings_cursor_pagination(self):
+        seen = []
+        params = {"limit": 2, "fields": "id,title"}
+        while True:
+            status, data = self.get_json(reverse("api_listings"), **params)
+            self.assertEqual(status, 200)
+            self.assertTrue(all(set(item) == {"id", "title"} for item in data["results"]))
+            seen += [item["id"] for item in data["results"]]
+            if not data["next"]:
+                break
+            params["cursor"] = data["next"]
+        self.assertEqual(seen, [listing.pk for listing in reversed(self.listings)])
+
+    def test_prices_in_one_query(self):
+        ids = ",".join(str(listing.pk) for listing in self.listings) + ",999"
+        with self.assertNumQueries(1):
+            status, data = self.get_json(reverse("api_listing_prices"), ids=ids)
+        self.assertEqual(data["results"][str(self.listings[0].pk)]["current_price"], 15)
+        self.assertEqual(data["missing"], [999])
+
+    def test_bid_history_and_profile(self):
+        status, data = self.get_json(reverse("api_listing_bids", args=[self.listings[0].pk]), fields="amount")
+        self.assertEqual([bid["amount"] for bid in data["results"]], [15, 14, 13, 12, 11])
+        status, data = self.get_json(reverse("api_user", args=["bidder"]), fields="username,bid_count")
+        self.assertEqual(data, {"username": "bidder", "bid_count": 5})
+
+    def test_errors(self):
+        self.assertEqual(self.get_json(reverse("api_listings"), fields="password")[0], 400)
+        self.assertEqual(self.get_json(reverse("api_listings"), cursor="nonsense")[0], 400)
+        self.assertEqual(self.get_json(reverse("api_listing", args=[999]))[0], 404)
+
+    def test_stream_errors(self):
+        # A failing query is an error status, a failure mid-stream still ends in valid JSON
+        client = Client(raise_request_exception=False)
+        with mock.patch("django.db.models.query.ValuesIterable.__iter__", side_effect=DatabaseError):
+            with self.assertLogs("django.request", "ERROR"):
+                self.assertEqual(client.get(reverse("api_listings")).status_code, 500)
+
+        select, selected = api.select, []
+
+        def select_one(row, fields):
+            selected.append(row)
+            if len(selected) > 1:
+                raise RuntimeError
+            return select(row, fields)
+
+        with mock.patch.object(api, "select", select_one):
+            with self.assertLogs("auctions.api", "ERROR"):
+                status, data = self.get_json(reverse("api_listings"), fields="id")
+        self.assertEqual(status, 200)
+        self.assertEqual(data, {"results": [{"id": self.listings[-1].pk}], "next": None, "error": "Internal error"})
+
+
+class ListingEventStreamTest(TransactionTestCase):
+    # The stream reads the database from another thread, so data must be committed
+    def setUp(self):
+        self.author = User.objects.create_user("author", "author@example.com", "password")
+        self.bidder = User.objects.create_user("bidder", "bidder@example.com", "password")
+        self.listing = Listing.objects.create(
+            author=self.author,
+            title="Streamed",
+            description="Some description",
+            starting_bid=10
+        )
+
+    def stream(self, actions):
+        # Drive the ASGI endpoint until it ends, running sync `actions` once it is subscribed
+        sent = []
+
+        async def receive():
+            await asyncio.sleep(3600)
+
+        async def send(message):
+            sent.append(message)
+
+        async def run():
+            stream = asyncio.ensure_future(
+                EventStreamRouter(None)({"type": "http", "method": "GET", "path": f"/listing/{self.listing.pk}/events"}, receive, send)
+            )
+            while len(sent) < 2 and not stream.done():
+                await asyncio.sleep(0.01)
+            await sync_to_async(actions)()
+            await asyncio.wait_for(stream, 5)
+
+        async_to_sync(run)()
+        return b"".join(message.get("body", b"") for message in sent).decode()
+
+    def test_stream_pushes_bids_and_close(self):
+        def actions():
+            place_bid(self.listing, self.bidder, 15)
+            self.listing.refresh_from_db()
+            self.listing.active = False
+            self.listing.save()
+
+        body = self.stream(actions)
+        self.assertIn('event: price\ndata: {"listing": %d, "price": 10.0' % self.listing.pk, body)
+        self.assertIn('event: bid\ndata: {"listing": %d, "price": 15.0' % self.listing.pk, body)
+        self.assertIn('event: close', body)
+        self.assertEqual(get_broker().subscriber_count(listing_channel(self.listing.pk)), 0)
+
+    def test_stream_notices_close_by_another_process(self):
+        Listing.objects.filter(pk=self.listing.pk).update(ends_at=timezone.now() + timedelta(seconds=0.5))
+
+        def actions():
+            # What close_auctions does, without publishing to this process's broker
+            time.sleep(0.5)
+            Listing.objects.filter(pk=self.listing.pk).update(active=False, closed_at=timezone.now())
+
+        with self.settings(EVENT_STREAM_HEARTBEAT=60):
+            body = self.stream(actions)
+        self.assertIn('event: close\ndata: {"listing": %d' % self.listing.pk, body)
+
+    def test_wsgi_fallback_returns_snapshot(self):
+        response = self.client.get(reverse("listing_events", kwargs={"id": self.listing.pk}))
+        self.assertEqual(response["Content-Type"], "text/event-stream")
+        self.assertContains(response, "event: price")
+
+
+class ScheduledCloseTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user("author", "author@example.com", "password")
+        cls.bidder = User.objects.create_user("bidder", "bidder@example.com", "password")
+
+    def create_listing(self, ends_at):
+        return Listing.objects.create(
+            author=self.author,
+            title="Scheduled",
+            description="Some description",
+            starting_bid=10,
+            ends_at=ends_at
+        )
+
+    def test_closes_due_listings_in_batches(self):
+        now = timezone.now()
+        due = [self.create_listing(now + timedelta(hours=1)) for i in range(5)]
+        later = self.create_listing(now + timedelta(hours=1))
+        place_bid(due[0], self.bidder, 20)
+        for i, listing in enumerate(due):
+            Listing.objects.filter(pk=listing.pk).update(ends_at=now - timedelta(seconds=i), user_with_max_bid=None)
+
+        self.assertEqual(len(close_due_listings(now, batch_size=3)), 3)
+        self.assertEqual(len(close_due_listings(now, batch_size=3)), 2)
+        self.assertEqual(close_due_listings(now, batch_size=3), [])
+
+        self.assertFalse(Listing.objects.filter(pk__in=[listing.pk for listing in due], active=True).exists())
+        self.assertEqual(Listing.objects.get(pk=due[0].pk).user_with_max_bid, self.bidder)
+        self.assertTrue(Listing.objects.get(pk=later.pk).active)
+        self.assertEqual(next_deadline(), later.ends_at)
+
+    def test_close_queries_dont_grow_with_winners(self):
+        now = timezone.now()
+        bidders = [User.objects.create_user(f"winner{i}", f"winner{i}@example.com", "password") for i in range(6)]
+        queries = []
+        for batch in (bidders[:2], bidders[2:]):
+            for bidder in batch:
+                listing = self.create_listing(now + timedelta(hours=1))
+                place_bid(listing, bidder, 20)
+                Listing.objects.filter(pk=listing.pk).update(ends_at=now - timedelta(seconds=1))
+            with CaptureQueriesContext(connection) as context:
+                close_due_listings(now)
+            queries.append(len(context))
+        self.assertEqual(queries[0], queries[1])
+        for bidder in bidders:
+            stats = UserStats.objects.get(user=bidder)
+            self.assertEqual((stats.leading_count, stats.won_count, stats.total_spent), (0, 1, 20))
+
+    def test_no_bids_after_end_time(self):
+        listing = self.create_listing(timezone.now() + timedelta(hours=1))
+        Listing.objects.filter(pk=listing.pk).update(ends_at=timezone.now() - timedelta(seconds=1))
+        with self.assertRaises(ListingClosed):
+            place_bid(listing, self.bidder, 20)
+
+
+class GenerateDataTest(TestCase):
+    def test_generated_bid_stats_are_consistent(self):
+        call_command("generate_data", users=20, categories=3, listings=50, batch_size=20, stdout=StringIO())
+        self.assertEqual(Listing.objects.count(), 50)
+        for listing in Listing.objects.filter(bid_count__gt=0):
+            top_bid = listing.bids.order_by("-amount").first()
+            self.assertEqual(listing.bid_count, listing.bids.count())
+            self.assertEqual(listing.leading_bid_id, top_bid.pk)
+            self.assertEqual(listing.current_price, top_bid.amount)
+
+    def test_generated_closed_listings_can_be_archived(self):
+        call_command("generate_data", users=20, categories=3, listings=50, batch_size=20, stdout=StringIO())
+        closed = Listing.objects.filter(active=False)
+        self.assertGreater(closed.count(), 0)
+        self.assertFalse(closed.filter(closed_at=None).exists())
+        self.assertTrue(archive_bids())
+
+    def test_generated_watcher_counts_are_consistent(self):
+        call_command("generate_data", users=20, categories=3, listings=50, watchlist=5, batch_size=20, stdout=StringIO())
+        expected = dict(Listing.objects.annotate(n=Count("watchlisted_by")).values_list("pk", "n"))
+        self.assertGreater(sum(expected.values()), 0)
+        self.assertEqual(dict(Listing.objects.values_list("pk", "watcher_count")), expected)
+
+        Listing.objects.update(watcher_count=0)
+        call_command("rebuild_watcher_counts", stdout=StringIO())
+        self.assertEqual(dict(Listing.objects.values_list("pk", "watcher_count")), expected)
+
+
+class ImportExportTest(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.seller = User.objects.create_user("seller", "seller@example.com", "password")
+        cls.category = ListingCategory.objects.create(name="Books")
+
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+
+    def path(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def test_import_validates_rows_and_resolves_categories(self):
+        with open(self.path("listings.csv"), "w") as f:
+            f.write("title,description,category,starting_bid\n")
+            f.write("Manual,How to fix a bicycle,books,5\n")
+            f.write("Lamp,Brass lamp,,12.5\n")
+            f.write("Broken,No price,books,\n")
+            f.write("Orphan,Unknown category,cars,3\n")
+        stderr = StringIO()
+        call_command("import_listings", self.path("listings.csv"), author="seller", batch_size=1,
+                     stdout=StringIO(), stderr=stderr)
+        self.assertEqual(
+            list(Listing.objects.order_by("pk").values_list("title", "category__slug", "current_price")),
+            [("Manual", "books", 5), ("Lamp", None, 12.5)]
+        )
+        self.assertIn("Line 4: starting_bid", stderr.getvalue())
+        self.assertIn("Line 5: category", stderr.getvalue())
+        self.assertEqual(self.client.get(reverse("search"), {"q": "bicycle"}).context["listings"][0].title, "Manual")
+
+    def test_export_resumes_from_checkpoint(self):
+        listing = Listing.objects.create(author=self.seller, title="Lamp", description="Brass", starting_bid=1)
+        for amount in range(2, 7):
+            place_bid(listing, self.seller, amount)
+        options = {"output": self.path("bids.jsonl"), "checkpoint": self.path("bids.checkpoint"),
+                   "chunk_size": 2, "stderr": StringIO()}
+        call_command("export_data", "bids", **options)
+        place_bid(listing, self.seller, 7)
+        call_command("export_data", "bids", **options)
+        with open(self.path("bids.jsonl")) as f:
+            amounts = [json.loads(line)["amount"] for line in f]
+        self.assertEqual(amounts, [2, 3, 4, 5, 6, 7])
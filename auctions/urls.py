@@ -1,6 +1,6 @@
 from django.urls import path
 
-from . import views
+from . import api, views
 
 urlpatterns = [
     path("", views.ListingList.as_view(), name="index"),
@@ -11,9 +11,22 @@ urlpatterns = [
     path("user/<str:username>", views.UserDetail.as_view(), name="user_page"),
     path("category/<str:slug>", views.CategoryDetail.as_view(), name="category"),
     path("category", views.CategoryList.as_view(), name="categories"),
+    path("search", views.ListingSearch.as_view(), name="search"),
     path("listing/<int:id>/edit", views.ListingUpdate.as_view(), name="update_listing"),
     path("listing/<int:id>/close", views.ListingClose.as_view(), name="close_listing"),
+    path("listing/<int:id>/events", views.listing_events, name="listing_events"),
+    path("listing/<int:id>/comments", views.listing_comments, name="listing_comments"),
     path("listing/<int:id>", views.listing_view, name="listing"),
     path("listing/new", views.ListingCreate.as_view(), name="create_listing"),    
-    path("watchlist", views.WatchlistDetail.as_view(), name="watchlist")
+    path("watchlist", views.WatchlistDetail.as_view(), name="watchlist"),
+    path("watchlist/batch", views.watchlist_batch, name="watchlist_batch"),
+    path("image/<str:size>", views.image_view, name="image"),
+    path("metrics", views.metrics, name="metrics"),
+    # Read-only JSON API, see auctions/api.py
+    path("api/listings", api.listing_list, name="api_listings"),
+    path("api/listings/prices", api.listing_prices, name="api_listing_prices"),
+    path("api/listings/<int:id>", api.listing_detail, name="api_listing"),
+    path("api/listings/<int:id>/bids", api.listing_bids, name="api_listing_bids"),
+    path("api/categories", api.category_list, name="api_categories"),
+    path("api/users/<str:username>", api.user_detail, name="api_user"),
 ]
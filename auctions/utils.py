@@ -1,8 +1,22 @@
+import json
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from datetime import datetime
+from hashlib import md5
+from math import ceil
+
+from django.core.cache import cache
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.http import Http404
+from django.utils.functional import cached_property
+
+
 class CustomPageRangeMixin:
     pages_on_each_side = 1  # The number of pages on each side of the current page number
 
     def get_context_data(self, **kwargs):
         context = super().get_context_data(**kwargs)
+        context['pagination_params'] = self.get_pagination_params()
         
         if self.pages_on_each_side == None or self.pages_on_each_side == 0:
             return context
@@ -20,4 +34,180 @@ class CustomPageRangeMixin:
         custom_range = range(left_index, right_index + 1)  # Because python range(1, 4) is from 1 till 3
         
         context['custom_page_range'] = custom_range
-        return context
\ No newline at end of file
+        return context
+
+    def get_pagination_params(self):
+        # Keep the other query parameters (search, filters) in pagination links
+        params = self.request.GET.copy()
+        params.pop(self.page_kwarg, None)
+        params.pop("cursor", None)
+        return params.urlencode()
+
+
+class InvalidCursor(Exception):
+    pass
+
+
+class KeysetPage:
+    is_keyset = True
+
+    def __init__(self, object_list, number, paginator, has_next, has_previous):
+        self.object_list = object_list
+        self.number = number
+        self.paginator = paginator
+        self._has_next = has_next
+        self._has_previous = has_previous
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def has_next(self):
+        return self._has_next
+
+    def has_previous(self):
+        return self._has_previous
+
+    def has_other_pages(self):
+        return self._has_next or self._has_previous
+
+    def next_page_number(self):
+        return self.number + 1
+
+    def previous_page_number(self):
+        return self.number - 1
+
+    @property
+    def next_cursor(self):
+        if not self._has_next:
+            return None
+        return self.paginator.encode_cursor(self.object_list[-1], self.number + 1)
+
+    @property
+    def previous_cursor(self):
+        if not self._has_previous:
+            return None
+        return self.paginator.encode_cursor(self.object_list[0], self.number - 1, backwards=True)
+
+
+class CursorEncoder(DjangoJSONEncoder):
+    def default(self, o):
+        # DjangoJSONEncoder truncates microseconds, which would break seeking on ties
+        if isinstance(o, datetime):
+            return o.isoformat()
+        return super().default(o)
+
+
+class KeysetPaginator:
+    # Seek pagination over the queryset ordering (or Meta.ordering) plus pk as a tiebreaker.
+    # Every page costs the same as the first one, the total count is cached and approximate.
+
+    def __init__(self, queryset, per_page, count_timeout=60, count=None):
+        self.queryset = queryset
+        self.per_page = per_page
+        self.count_timeout = count_timeout
+        if count is not None:
+            # Known from elsewhere (a denormalized counter), skips the COUNT query
+            self.__dict__["count"] = count
+
+        ordering = list(queryset.query.order_by or queryset.model._meta.ordering)
+        if not any(field.lstrip("-") in ("pk", "id") for field in ordering):
+            ordering.append("pk")
+        self.ordering = ordering
+        self.fields = [(field.lstrip("-"), field.startswith("-")) for field in ordering]
+
+    @cached_property
+    def count(self):
+        key = "keyset-count:" + md5(str(self.queryset.query).encode()).hexdigest()
+        return cache.get_or_set(key, self.queryset.count, self.count_timeout)
+
+    @cached_property
+    def num_pages(self):
+        return max(1, ceil(self.count / self.per_page))
+
+    def encode_cursor(self, obj, number, backwards=False):
+        # obj is a model instance, or a dict from values() that includes the ordering fields
+        get = obj.get if isinstance(obj, dict) else lambda name: getattr(obj, name)
+        position = {
+            "v": [get(name) for name, descending in self.fields],
+            "n": number,
+            "b": backwards,
+        }
+        data = json.dumps(position, cls=CursorEncoder, separators=(",", ":"))
+        return urlsafe_b64encode(data.encode()).decode().rstrip("=")
+
+    def decode_cursor(self, cursor):
+        try:
+            data = urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+            position = json.loads(data)
+            values, number, backwards = position["v"], int(position["n"]), bool(position["b"])
+        except (ValueError, TypeError, KeyError):
+            raise InvalidCursor(cursor)
+        if len(values) != len(self.fields) or number < 1:
+            raise InvalidCursor(cursor)
+        return values, number, backwards
+
+    def seek_filter(self, values, backwards):
+        # (a, b, c) after (x, y, z) == a > x OR (a = x AND b > y) OR (a = x AND b = y AND c > z)
+        condition = Q()
+        for i, (name, descending) in enumerate(self.fields):
+            lookup = "lt" if descending != backwards else "gt"
+            term = Q(**{f"{name}__{lookup}": values[i]})
+            for j, (prev_name, prev_descending) in enumerate(self.fields[:i]):
+                term &= Q(**{prev_name: values[j]})
+            condition |= term
+        return condition
+
+    def seek(self, cursor=None):
+        # The queryset ordered and filtered to start right after the cursor position,
+        # with the page number and direction. Unsliced, callers take per_page + 1 rows.
+        values, number, backwards = None, 1, False
+        if cursor:
+            values, number, backwards = self.decode_cursor(cursor)
+
+        ordering = self.ordering
+        if backwards:
+            ordering = [field[1:] if field.startswith("-") else "-" + field for field in ordering]
+        queryset = self.queryset.order_by(*ordering)
+        if values is not None:
+            queryset = queryset.filter(self.seek_filter(values, backwards))
+        return queryset, number, backwards, values is not None
+
+    def page(self, cursor=None):
+        queryset, number, backwards, seeking = self.seek(cursor)
+
+        object_list = list(queryset[:self.per_page + 1])
+        has_more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+        if backwards:
+            object_list.reverse()
+            return KeysetPage(object_list, number, self, has_next=True, has_previous=has_more)
+        return KeysetPage(object_list, number, self, has_next=has_more, has_previous=seeking)
+
+
+class KeysetPaginationMixin:
+    keyset_pagination = True  # Set to False to fall back to the OFFSET paginator
+    cursor_kwarg = "cursor"
+    count_cache_timeout = 60  # Seconds the approximate total count is cached for
+
+    def get_keyset_count(self):
+        # Override to supply the total count without a COUNT query
+        return None
+
+    def paginate_queryset(self, queryset, page_size):
+        if not self.keyset_pagination:
+            return super().paginate_queryset(queryset, page_size)
+
+        paginator = KeysetPaginator(
+            queryset,
+            page_size,
+            count_timeout=self.count_cache_timeout,
+            count=self.get_keyset_count()
+        )
+        try:
+            page = paginator.page(self.request.GET.get(self.cursor_kwarg))
+        except InvalidCursor:
+            raise Http404("Invalid cursor")
+        return (paginator, page, page.object_list, page.has_other_pages())
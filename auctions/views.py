@@ -1,25 +1,42 @@
+import os
+
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.mixins import LoginRequiredMixin
 from django.db import IntegrityError
-from django.http import HttpResponse, HttpResponseRedirect
+from django.core.serializers.json import DjangoJSONEncoder
+from django.http import FileResponse, Http404, HttpResponse, HttpResponseRedirect, JsonResponse
 from django.shortcuts import get_object_or_404, redirect, render
 from django.urls import reverse
-from django.views.generic import CreateView, DetailView, ListView, UpdateView, View
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.functional import cached_property
+from django.utils.http import quote_etag
+from django.views.decorators.http import require_GET, require_http_methods, require_POST
+from django.views.generic import CreateView, ListView, UpdateView, View
 from django.core.exceptions import PermissionDenied
 
-from .models import User, ListingCategory, Listing
+from .models import User, ListingCategory, Listing, Comment, UserStats
+from . import archive, cache, images, ratelimit, watchlist
+from .cache import FeedCacheMixin
+from .conditional import ConditionalGetMixin, condition_on_listing
+from .facets import ListingFilterMixin
 from .forms import UserForm, ListingForm, CommentForm, BidForm
-from .utils import CustomPageRangeMixin
+from .routers import replica_reads
+from .search import SearchResults
+from .sqlite import serialized_writes
+from .services import BidConflict, BidRejected, close_listing, place_bid
+from .streaming import format_event, listing_state
+from .utils import CustomPageRangeMixin, InvalidCursor, KeysetPaginationMixin, KeysetPaginator
 
 
-class ListingList(CustomPageRangeMixin, ListView):
+@replica_reads
+class ListingList(ListingFilterMixin, ConditionalGetMixin, FeedCacheMixin, KeysetPaginationMixin, CustomPageRangeMixin, ListView):
     context_object_name = "listings"
     paginate_by = 6
     template_name = "auctions/index.html"
 
     def get_queryset(self):
-        active_listings = Listing.objects.filter(active=True)
-        return active_listings
+        active_listings = Listing.objects.filter(active=True).with_watched(self.request.user)
+        return self.filter_listings(active_listings)
     
 
 def login_view(request):
@@ -75,13 +92,50 @@ def register(request):
 
 
 # Custom views
-class UserDetail(DetailView):
-    context_object_name = "user_detail"
+@replica_reads
+class UserDetail(KeysetPaginationMixin, CustomPageRangeMixin, ListView):
+    # Profile with totals from UserStats and one keyset paginated sub-list,
+    # picked with "?tab=". Each tab is served by an index on its user column.
+    context_object_name = "items"
+    paginate_by = 6
     template_name = "auctions/user.html"
+    tabs = {
+        "listings": "listing_count",
+        "leading": "leading_count",
+        "won": "won_count",
+        # Archived bids aren't listed, only counted in bid_count
+        "bids": "listed_bid_count",
+    }
+
+    def get(self, request, *args, **kwargs):
+        self.user_detail = get_object_or_404(User.objects.select_related("stats"), username=self.kwargs["username"])
+        try:
+            self.stats = self.user_detail.stats
+        except UserStats.DoesNotExist:
+            self.stats = UserStats(user=self.user_detail)
+        self.tab = request.GET.get("tab")
+        if self.tab not in self.tabs:
+            self.tab = "listings"
+        return super().get(request, *args, **kwargs)
 
-    def get_object(self, queryset=None):
-        obj = get_object_or_404(User, username=self.kwargs["username"])
-        return obj
+    def get_queryset(self):
+        if self.tab == "bids":
+            return self.user_detail.bids.select_related("on_listing")
+        if self.tab == "listings":
+            listings = self.user_detail.created_listings.all()
+        else:
+            listings = Listing.objects.filter(user_with_max_bid=self.user_detail, active=self.tab == "leading")
+        return listings.with_watched(self.request.user)
+
+    def get_keyset_count(self):
+        return getattr(self.stats, self.tabs[self.tab])
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["user_detail"] = self.user_detail
+        context["stats"] = self.stats
+        context["tab"] = self.tab
+        return context
     
 
 class UserUpdate(LoginRequiredMixin, UpdateView):
@@ -97,28 +151,136 @@ class UserUpdate(LoginRequiredMixin, UpdateView):
         return obj
 
 
-class CategoryList(ListView):
+@replica_reads
+class CategoryList(FeedCacheMixin, ListView):
     context_object_name = 'categories'
-    model = ListingCategory
     template_name = "auctions/category_list.html"
 
+    def get_cache_generations(self):
+        return [cache.CATEGORIES]
 
-class CategoryDetail(CustomPageRangeMixin, ListView):
+    def get_queryset(self):
+        # The whole tree in path order, parents before their children. Totals
+        # include the subcategories and are summed from CategoryStats here,
+        # rather than counting listings.
+        categories = list(ListingCategory.objects.select_related("stats").order_by("path"))
+        by_pk = {category.pk: category for category in categories}
+        for category in categories:
+            category.listing_count, category.min_price, category.max_price = 0, None, None
+        for category in categories:
+            stats = getattr(category, "stats", None)
+            if stats is None or not stats.active_count:
+                continue
+            for pk in category.ancestor_ids():
+                ancestor = by_pk.get(pk)
+                if ancestor is None:
+                    continue
+                ancestor.listing_count += stats.active_count
+                ancestor.min_price = min((p for p in (ancestor.min_price, stats.min_price) if p is not None), default=None)
+                ancestor.max_price = max((p for p in (ancestor.max_price, stats.max_price) if p is not None), default=None)
+        return categories
+
+
+@replica_reads
+class CategoryDetail(ListingFilterMixin, ConditionalGetMixin, FeedCacheMixin, KeysetPaginationMixin, CustomPageRangeMixin, ListView):
     context_object_name = 'listings'
     paginate_by = 6
     template_name = "auctions/category_detail.html"
+
+    def get_cache_generations(self):
+        return [cache.category_generation(self.kwargs['slug'])]
     
     def get_queryset(self):
-        category = get_object_or_404(ListingCategory, slug=self.kwargs['slug'])
-        listings = category.listings.filter(active=True)
-        return listings
+        self.category = get_object_or_404(ListingCategory, slug=self.kwargs['slug'])
+        # Subcategories through the path prefix, a subquery rather than another query
+        listings = Listing.objects.filter(active=True, category__in=self.category.descendants())
+        return self.filter_listings(listings.with_watched(self.request.user))
+
+    def get_facet_scope(self):
+        return self.category
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["category"] = self.category
+        return context
+
 
+HISTORY_PAGE_SIZE = 10  # Bids and comments shown on the listing page before "Load more"
+HISTORY_MAX_SIZE = 500
 
+
+def get_history_limit(request, param):
+    try:
+        limit = int(request.GET.get(param, HISTORY_PAGE_SIZE))
+    except ValueError:
+        limit = HISTORY_PAGE_SIZE
+    return min(max(limit, HISTORY_PAGE_SIZE), HISTORY_MAX_SIZE)
+
+
+class HistorySlice:
+    # The latest `limit` rows of a bid or comment history. Evaluated lazily, so
+    # a template fragment served from the cache costs no query at all.
+
+    def __init__(self, queryset, limit):
+        self.queryset = queryset
+        self.limit = limit
+
+    @cached_property
+    def _rows(self):
+        # Fetch one extra row to know whether there is more history without a COUNT
+        return list(self.queryset[:self.limit + 1])
+
+    @property
+    def items(self):
+        return self._rows[:self.limit]
+
+    @property
+    def has_more(self):
+        return len(self._rows) > self.limit
+
+    def __iter__(self):
+        return iter(self.items)
+
+    @property
+    def next_cursor(self):
+        # Keyset cursor past the last row, for the incremental endpoints
+        if not self.has_more:
+            return None
+        return KeysetPaginator(self.queryset, self.limit).encode_cursor(self.items[-1], 2)
+
+
+class ListingSearch(CustomPageRangeMixin, ListView):
+    context_object_name = "listings"
+    paginate_by = 6
+    template_name = "auctions/search.html"
+
+    def get_queryset(self):
+        self.query = self.request.GET.get("q", "").strip()
+        self.category = None
+        if self.request.GET.get("category"):
+            self.category = get_object_or_404(ListingCategory, slug=self.request.GET["category"])
+        # Only active listings by default, "?active=0" for closed ones and "?active=all" for both
+        active = {"0": False, "all": None}.get(self.request.GET.get("active"), True)
+        if not self.query:
+            return []
+        return SearchResults(self.query, category=self.category, active=active)
+
+    def get_context_data(self, **kwargs):
+        context = super().get_context_data(**kwargs)
+        context["query"] = self.query
+        context["category"] = self.category
+        context["categories"] = ListingCategory.objects.all()
+        return context
+
+
+@replica_reads
+@condition_on_listing
 def listing_view(request, id):
-    listing = get_object_or_404(Listing, pk=id)     
+    listing = get_object_or_404(Listing.objects.with_related(), pk=id)
     isauthor_flag = (request.user == listing.author)
-    inwatchlist_flag = listing.watchlisted_by.filter(username=request.user).exists()
+    inwatchlist_flag = listing.pk in watchlist.watched_ids(request)
     bidlow_flag = False
+    bidretry_flag = False
     bid_form = BidForm()
     comment_form = CommentForm()
     
@@ -126,27 +288,23 @@ def listing_view(request, id):
         post_data = request.POST
         # Process watchlist
         if "addtowatchlist" in post_data:            
-            if inwatchlist_flag:
-                listing.watchlisted_by.remove(request.user)
-                inwatchlist_flag = False                   
-            else:
-                listing.watchlisted_by.add(request.user)
-                inwatchlist_flag = True
+            watchlist.update(request.user, [listing.pk], add=not inwatchlist_flag)
+            inwatchlist_flag = not inwatchlist_flag
+            watchlist.forget(request)
+            listing.refresh_from_db(fields=["watcher_count", "last_modified"])
         # Process bid
         if "makebid" in post_data:
             bid_form = BidForm(post_data)                
             if bid_form.is_valid():
-                user_bid = bid_form.cleaned_data["amount"]
-                if (user_bid > listing.calculate_max_bid()) and (user_bid >= listing.starting_bid):
-                    new_bid = bid_form.save(commit=False)
-                    new_bid.from_user = request.user
-                    new_bid.on_listing = listing
-                    new_bid.save()
-                    bid_form = BidForm()
-                    listing.user_with_max_bid = request.user
-                    listing.save()
+                try:
+                    place_bid(listing, request.user, bid_form.cleaned_data["amount"])
+                except BidConflict:
+                    bidretry_flag = True
+                except BidRejected:
+                    bidlow_flag = True
                 else:
-                    bidlow_flag = True                    
+                    bid_form = BidForm()
+                    listing.refresh_from_db()
         # Process comment
         if "addcomment" in post_data:            
             comment_form = CommentForm(post_data)   
@@ -154,19 +312,121 @@ def listing_view(request, id):
                 new_comment = comment_form.save(commit=False)
                 new_comment.author = request.user
                 new_comment.on_listing = listing
-                new_comment.save()
+                with serialized_writes():
+                    new_comment.save()
                 comment_form = CommentForm()
+                listing.refresh_from_db(fields=["last_modified"])
+
+    bids_limit = get_history_limit(request, "bids")
 
     return render(request, "auctions/listing_detail.html", {
         "listing": listing,
+        "bid_history": HistorySlice(archive.bid_history(listing), bids_limit),
+        # The first page, later ones come from listing_comments()
+        "comment_history": HistorySlice(listing.comments.with_authors(), HISTORY_PAGE_SIZE),
+        "more_bids_url": f"?bids={bids_limit + HISTORY_PAGE_SIZE}",
+        # Closed listings load their (possibly archived) bid history only on request
+        "show_bid_history": "bids" in request.GET,
         "isauthor_flag": isauthor_flag,
         "inwatchlist_flag": inwatchlist_flag,
         "bidlow_flag": bidlow_flag,
+        "bidretry_flag": bidretry_flag,
         "bid_form": bid_form,
         "comment_form": comment_form
     })
 
 
+def wants_json(request):
+    return request.GET.get("format") == "json" or "application/json" in request.headers.get("Accept", "")
+
+
+def is_fragment_request(request):
+    # fetch() from the listing page, a plain form post gets a redirect instead
+    return wants_json(request) or request.headers.get("X-Requested-With") == "XMLHttpRequest"
+
+
+def comment_json(comment):
+    return {
+        "id": comment.pk,
+        "author": comment.author.username,
+        "author_name": comment.author.get_name(),
+        "author_url": comment.author.get_absolute_url(),
+        "text": comment.text,
+        "date_added": comment.date_added,
+    }
+
+
+@replica_reads
+@require_http_methods(["GET", "POST"])
+def listing_comments(request, id):
+    # The comment thread of a listing without the rest of the listing page.
+    # GET: the page after ?cursor=, a seek on (on_listing, -date_added).
+    # POST: add a comment, answered with just that comment.
+    # HTML fragments by default, JSON with ?format=json or Accept: application/json.
+    if request.method == "POST":
+        return post_comment(request, id)
+
+    if not Listing.objects.filter(pk=id).exists():
+        raise Http404("No such listing")
+    paginator = KeysetPaginator(Comment.objects.filter(on_listing=id).with_authors(), HISTORY_PAGE_SIZE)
+    try:
+        page = paginator.page(request.GET.get("cursor"))
+    except InvalidCursor:
+        raise Http404("Invalid cursor")
+
+    if wants_json(request):
+        return JsonResponse({
+            "results": [comment_json(comment) for comment in page],
+            "next": page.next_cursor,
+        }, encoder=DjangoJSONEncoder)
+    return render(request, "auctions/listing_comments.html", {
+        "listing_id": id,
+        "comments": page,
+        "next_cursor": page.next_cursor,
+    })
+
+
+def post_comment(request, id):
+    fragment = is_fragment_request(request)
+    if not request.user.is_authenticated:
+        if fragment:
+            return JsonResponse({"error": "Login required"}, status=401)
+        return redirect("login")
+    if not Listing.objects.filter(pk=id).exists():
+        raise Http404("No such listing")
+
+    form = CommentForm(request.POST)
+    if not form.is_valid():
+        if fragment:
+            return JsonResponse({"errors": form.errors}, status=400)
+        return redirect("listing", id=id)
+    comment = form.save(commit=False)
+    comment.author = request.user
+    comment.on_listing_id = id
+    with serialized_writes():
+        comment.save()
+
+    if not fragment:
+        return redirect("listing", id=id)
+    if wants_json(request):
+        return JsonResponse(comment_json(comment), status=201, encoder=DjangoJSONEncoder)
+    return render(request, "auctions/comment.html", {"comment": comment}, status=201)
+
+
+EVENT_SNAPSHOT_RETRY = 10000  # Milliseconds before EventSource reconnects to the WSGI fallback
+
+
+def listing_events(request, id):
+    # Under ASGI this path is served as a live stream by auctions.streaming.
+    # Under WSGI the client gets the current state and reconnects after a while.
+    listing = get_object_or_404(Listing.objects.select_related("user_with_max_bid"), pk=id)
+    event = "price" if listing.active else "close"
+    return HttpResponse(
+        format_event(event, listing_state(listing), retry=EVENT_SNAPSHOT_RETRY),
+        content_type="text/event-stream"
+    )
+
+
 class ListingUpdate(LoginRequiredMixin, UpdateView):
     form_class = ListingForm
     login_url = "login"  
@@ -207,12 +467,13 @@ class ListingClose(View):
 
     def post(self, request, id):
         listing = get_object_or_404(Listing, pk=id)
-        listing.active = False
-        listing.save()
+        if listing.author != request.user:
+            raise PermissionDenied
+        close_listing(listing)
         return redirect("index")
 
 
-class WatchlistDetail(LoginRequiredMixin, CustomPageRangeMixin, ListView):
+class WatchlistDetail(LoginRequiredMixin, KeysetPaginationMixin, CustomPageRangeMixin, ListView):
     context_object_name = "listings"
     login_url = "login"
     paginate_by = 6
@@ -220,4 +481,73 @@ class WatchlistDetail(LoginRequiredMixin, CustomPageRangeMixin, ListView):
 
     def get_queryset(self):
         listings = self.request.user.watchlist_listings.all()
-        return listings
\ No newline at end of file
+        return listings
+
+
+@require_POST
+def watchlist_batch(request):
+    # Add or remove many listings at once: action=add|remove, ids=1,2,3 (or repeated ids)
+    if not request.user.is_authenticated:
+        return JsonResponse({"error": "Login required"}, status=401)
+    action = request.POST.get("action")
+    if action not in ("add", "remove"):
+        return JsonResponse({"error": "action must be 'add' or 'remove'"}, status=400)
+    try:
+        ids = {int(pk) for value in request.POST.getlist("ids") for pk in value.split(",") if pk}
+    except ValueError:
+        return JsonResponse({"error": "ids must be integers"}, status=400)
+    if len(ids) > watchlist.BATCH_MAX_SIZE:
+        return JsonResponse({"error": f"At most {watchlist.BATCH_MAX_SIZE} ids per request"}, status=400)
+
+    changed = watchlist.update(request.user, ids, add=action == "add")
+    watchlist.forget(request)
+    return JsonResponse({"action": action, "ids": sorted(changed)})
+
+
+IMAGE_MAX_AGE = 365 * 24 * 3600  # Thumbnails of a URL never change, see images.py
+
+
+@require_GET
+def image_view(request, size):
+    # Thumbnail of an external image URL signed by images.thumbnail_url()
+    try:
+        url = images.unsign_url(request.GET.get("url", ""))
+        f, blob, content_type = images.open_thumbnail(url, size)
+    except images.ImageProxyError as e:
+        return HttpResponse(str(e), status=e.status, content_type="text/plain")
+
+    etag = quote_etag(blob)
+    response = get_conditional_response(request, etag=etag)
+    if response is not None:
+        f.close()
+    else:
+        # Read from the open file, the blob may be evicted meanwhile
+        length = os.fstat(f.fileno()).st_size
+        try:
+            byte_range = images.parse_range(request.headers.get("Range"), length)
+        except ValueError:
+            f.close()
+            response = HttpResponse(status=416)
+            response["Content-Range"] = f"bytes */{length}"
+            return response
+        if byte_range is None:
+            response = FileResponse(f, content_type=content_type)
+        else:
+            # Thumbnails are small, the requested part is read at once
+            start, end = byte_range
+            with f:
+                f.seek(start)
+                response = HttpResponse(f.read(end + 1 - start), status=206, content_type=content_type)
+            response["Content-Range"] = f"bytes {start}-{end}/{length}"
+        response["Accept-Ranges"] = "bytes"
+    response["ETag"] = etag
+    patch_cache_control(response, public=True, max_age=IMAGE_MAX_AGE, immutable=True)
+    return response
+
+
+@require_GET
+def metrics(request):
+    # In-process counters for monitoring, per server process, staff only
+    if not request.user.is_staff:
+        raise PermissionDenied
+    return JsonResponse({"rate_limits": ratelimit.stats(), "feed_cache": cache.stats()})
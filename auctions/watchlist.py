@@ -0,0 +1,64 @@
+from . import cache
+from .models import Listing
+from .sqlite import serialized_writes
+
+
+# The ids of the listings on the current user's watchlist, loaded at most
+# once per request. Between requests they are kept in the session together
+# with the user's watchlist generation (cache.py counters), which is bumped
+# on every change to the M2M table (see signals.py). So every session of the
+# user drops its copy on a toggle, for the price of one cache read.
+
+SESSION_KEY = "watchlist"
+BATCH_MAX_SIZE = 500  # Listing ids accepted by one batch add/remove
+
+
+def watchlist_generation(user_id):
+    return f"watchlist:{user_id}"
+
+
+def watched_ids(request):
+    if not request.user.is_authenticated:
+        return frozenset()
+    if not hasattr(request, "_watched_ids"):
+        # Read the generation before the rows, a change in between then
+        # leaves an outdated generation behind rather than outdated ids
+        generation = cache.get_generations(watchlist_generation(request.user.pk))[0]
+        stored = request.session.get(SESSION_KEY)
+        if stored and stored["generation"] == generation:
+            ids = frozenset(stored["ids"])
+        else:
+            ids = frozenset(
+                Listing.watchlisted_by.through.objects
+                .filter(user=request.user)
+                .values_list("listing_id", flat=True)
+            )
+            request.session[SESSION_KEY] = {"generation": generation, "ids": sorted(ids)}
+        request._watched_ids = ids
+    return request._watched_ids
+
+
+def forget(request):
+    # Drop this request's copy after changing the watchlist
+    request.__dict__.pop("_watched_ids", None)
+    request.session.pop(SESSION_KEY, None)
+
+
+def update(user, listing_ids, add=True):
+    # Batch add or remove, unknown listing ids are ignored. Returns the ids
+    # actually added or removed, so unchanged listings keep their validators.
+    with serialized_writes():
+        watched = set(
+            Listing.watchlisted_by.through.objects
+            .filter(user=user, listing_id__in=listing_ids)
+            .values_list("listing_id", flat=True)
+        )
+        if add:
+            ids = set(Listing.objects.filter(pk__in=listing_ids).values_list("pk", flat=True)) - watched
+            if ids:
+                user.watchlist_listings.add(*ids)
+        else:
+            ids = watched
+            if ids:
+                user.watchlist_listings.remove(*ids)
+    return ids
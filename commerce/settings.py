@@ -42,6 +42,9 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'auctions.middleware.QueryInstrumentationMiddleware',
+    'auctions.middleware.ReplicaRoutingMiddleware',
+    'auctions.middleware.RateLimitMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -63,6 +66,7 @@ TEMPLATES = [
                 'django.template.context_processors.request',
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
+                'auctions.context_processors.fragment_cache',
             ],
         },
     },
@@ -75,15 +79,90 @@ DEFAULT_AUTO_FIELD='django.db.models.AutoField'
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
 
+# Connections are kept open for CONN_MAX_AGE seconds, auctions.routers checks
+# them before each request.
+
+CONN_MAX_AGE = int(os.environ.get('DATABASE_CONN_MAX_AGE', 60))
+
 DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+        'CONN_MAX_AGE': CONN_MAX_AGE,
     }
 }
 
+# Read replicas (auctions/routers.py). Listing and feed pages read from them,
+# writes go to 'default'. Locally, DATABASE_REPLICAS=replica1.sqlite3,replica2.sqlite3
+# stands them in with SQLite files that "manage.py sync_replicas" copies the
+# primary into. Users who just wrote read from the primary for REPLICA_STICKY_SECONDS.
+
+REPLICA_DATABASES = []
+for i, name in enumerate(filter(None, os.environ.get('DATABASE_REPLICAS', '').split(',')), start=1):
+    DATABASES[f'replica{i}'] = {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': os.path.join(BASE_DIR, name.strip()),
+        'CONN_MAX_AGE': CONN_MAX_AGE,
+        'TEST': {'MIRROR': 'default'},
+    }
+    REPLICA_DATABASES.append(f'replica{i}')
+
+DATABASE_ROUTERS = ['auctions.routers.ReplicaRouter']
+
+# SQLite tuning (auctions/sqlite.py). "production" turns on WAL and the
+# connection pragmas, and queues this process's writes. SQLITE_PRAGMAS
+# overrides single pragmas of the profile.
+
+SQLITE_PROFILE = os.environ.get('SQLITE_PROFILE', 'default')
+SQLITE_PRAGMAS = {}
+SQLITE_WRITE_QUEUE_TIMEOUT = 10
+REPLICA_STICKY_SECONDS = 10
+
 AUTH_USER_MODEL = 'auctions.User'
 
+
+# Cache
+# https://docs.djangoproject.com/en/3.2/topics/cache/
+# Anonymous feed pages are cached here (see auctions/cache.py). Set
+# CACHE_REDIS_URL to share the cache between processes (needs django-redis).
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'TIMEOUT': 300,
+        'OPTIONS': {
+            'MAX_ENTRIES': 5000,
+            'CULL_FREQUENCY': 3,
+        },
+    }
+}
+
+if os.environ.get('CACHE_REDIS_URL'):
+    CACHES['default'] = {
+        'BACKEND': 'django_redis.cache.RedisCache',
+        'LOCATION': os.environ['CACHE_REDIS_URL'],
+        'TIMEOUT': 300,
+    }
+
+FEED_CACHE_ALIAS = 'default'
+FEED_CACHE_TIMEOUT = 300
+
+# Listing cards and detail sections are cached per listing, keyed on
+# Listing.last_modified, so they can live much longer than the feed pages
+FRAGMENT_CACHE_ALIAS = 'default'
+FRAGMENT_CACHE_TIMEOUT = 3600
+
+# Image proxy (auctions/images.py). Thumbnails of Listing.image and User.avatar
+# are cached on disk, least recently used ones go beyond IMAGE_CACHE_MAX_BYTES.
+# Resizing needs Pillow, without it the originals are proxied unchanged.
+
+IMAGE_CACHE_DIR = os.environ.get('IMAGE_CACHE_DIR', os.path.join(BASE_DIR, 'image-cache'))
+IMAGE_CACHE_MAX_BYTES = 512 * 1024 * 1024
+IMAGE_PROXY_MAX_BYTES = 10 * 1024 * 1024  # Largest origin image fetched
+IMAGE_PROXY_TIMEOUT = 10
+IMAGE_PROXY_FAILURE_TTL = 60  # Seconds a failed fetch is answered from the cache
+IMAGE_PROXY_ALLOW_PRIVATE = False  # Fetch from private and loopback addresses, for local testing
+
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
 
@@ -121,3 +200,78 @@ USE_TZ = True
 # https://docs.djangoproject.com/en/3.0/howto/static-files/
 
 STATIC_URL = '/static/'
+
+
+# Query instrumentation
+# Requests running more queries than this are logged at WARNING level. The
+# Server-Timing header with the query counts is only sent with DEBUG on or
+# to staff users.
+
+QUERY_COUNT_WARNING_THRESHOLD = 50
+
+
+# Bid archiving (auctions/archive.py, "manage.py archive_bids")
+# Bids of listings closed for longer than this move to compressed BidArchive segments
+
+BID_ARCHIVE_AFTER_DAYS = 30
+
+# Listing feed sorts and facets (auctions/facets.py)
+# "Ending soon" lists the listings ending within this many hours
+
+LISTING_ENDING_SOON_HOURS = 24
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        # One line per request at DEBUG, requests over QUERY_COUNT_WARNING_THRESHOLD
+        # at WARNING. QUERY_LOG_LEVEL=DEBUG logs every request.
+        'auctions.queries': {
+            'handlers': ['console'],
+            'level': os.environ.get('QUERY_LOG_LEVEL', 'WARNING'),
+        },
+    },
+}
+
+
+# Live bid updates (Server-Sent Events, served under ASGI by auctions/streaming.py)
+# PUBSUB_BACKEND fans events out to the open streams, any class with the
+# subscribe/unsubscribe/publish/subscriber_count API of InProcessBroker works.
+
+PUBSUB_BACKEND = 'auctions.pubsub.InProcessBroker'
+PUBSUB_OPTIONS = {'queue_size': 32}
+EVENT_STREAM_HEARTBEAT = 15
+
+
+# Rate limits (auctions/ratelimit.py), token buckets per URL name checked
+# before the view runs. RATE_LIMIT_STORE keeps the buckets: LocalBucketStore
+# per process, or CacheBucketStore to share them through a Django cache
+# (RATE_LIMIT_STORE_OPTIONS = {'alias': ...}). Behind a proxy, set
+# RATE_LIMIT_IP_HEADER to the header with the client address, such as
+# 'HTTP_X_FORWARDED_FOR'.
+
+RATE_LIMIT_STORE = 'auctions.ratelimit.LocalBucketStore'
+RATE_LIMIT_STORE_OPTIONS = {'max_keys': 100000}
+RATE_LIMIT_IP_HEADER = None
+RATE_LIMITS = {
+    'listing': [
+        {'scope': 'user', 'rate': '20/m', 'burst': 10, 'methods': ['POST'], 'param': 'makebid'},
+        {'scope': 'ip', 'rate': '60/m', 'burst': 30, 'methods': ['POST']},
+        {'scope': 'listing', 'rate': '300/m', 'burst': 100, 'methods': ['POST'], 'param': 'makebid'},
+    ],
+    'listing_comments': [
+        {'scope': 'user', 'rate': '10/m', 'burst': 5, 'methods': ['POST']},
+    ],
+    'login': [
+        {'scope': 'ip', 'rate': '10/m', 'burst': 10, 'methods': ['POST']},
+        {'scope': 'post:username', 'rate': '20/h', 'burst': 5, 'methods': ['POST']},
+    ],
+    'register': [
+        {'scope': 'ip', 'rate': '10/h', 'burst': 5, 'methods': ['POST']},
+    ],
+}